@@ -1,13 +1,19 @@
 from fastapi import Form, UploadFile, File
 import base64
 import datetime
+import itertools
 from typing import Optional
 
 import mongomock
 from lib.utils import get_file, is_valid_date, save_file, sentry_init, time_to_string, get_test_engine, validate_identity, validate_location
 # from lib.rev2 import Rev2Graph
-from lib.new_rev2 import Rev2Graph, rev2_calculator
-from lib.interest_prediction import InterestPredictor
+from lib.new_rev2 import create_rev2_scheduler, recent_ratings
+from lib.rev2_jobs import Rev2JobManager
+from lib.rev2_telemetry import get_run_history
+from lib.sparse_interest_prediction import SparseInterestPredictor
+from lib.recommendation_cache import RecommendationCache
+from lib.recommendation_materializer import MATERIALIZED_K, create_recommendations_scheduler
+from lib.mongo_indexes import index_report
 from accounts_sql import Accounts
 from chats_nosql import Chats
 from favourites_nosql import Favourites
@@ -18,14 +24,13 @@ import time
 from firebase_manager import FirebaseManager
 from fastapi import FastAPI, File, Query, UploadFile, BackgroundTasks, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse
 from dotenv import load_dotenv
 import sys
 import firebase_admin
 from firebase_admin import credentials, auth, exceptions
 from imported_lib.ServicesService.services_lib import ServicesLib
 from imported_lib.SupportService.support_lib import SupportLib
-from multiprocessing import Process
 
 import os
 
@@ -37,6 +42,8 @@ logger.info("Starting the app")
 load_dotenv()
 
 DEBUG_MODE = os.getenv("DEBUG_MODE").title() == "True"
+REV2_SCHEDULER_ENABLED = os.getenv("REV2_SCHEDULER_ENABLED", "True").title() == "True"
+RECOMMENDATIONS_SCHEDULER_ENABLED = os.getenv("RECOMMENDATIONS_SCHEDULER_ENABLED", "True").title() == "True"
 if DEBUG_MODE:
     logger.getLogger().setLevel(logger.DEBUG)
 logger.info("DEBUG_MODE: " + str(DEBUG_MODE))
@@ -58,6 +65,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+rev2_scheduler = None
+recommendations_scheduler = None
+
 if os.getenv('TESTING'):
     from unittest.mock import MagicMock
     firebase_manager = FirebaseManager()
@@ -81,7 +91,14 @@ else:
     certificates_manager = Certificates()
     mobile_token_manager = MobileToken()
 
-    rev2_process = Process(target=rev2_calculator)
+    rev2_scheduler = create_rev2_scheduler(accounts_manager, services_lib) if REV2_SCHEDULER_ENABLED else None
+    recommendations_scheduler = create_recommendations_scheduler(favourites_manager, accounts_manager.engine) \
+        if RECOMMENDATIONS_SCHEDULER_ENABLED else None
+
+recommendation_cache = RecommendationCache()
+favourites_manager.subscribe(recommendation_cache.invalidate)
+
+rev2_jobs = Rev2JobManager(lambda max_delta_days: recent_ratings(services_lib, max_delta_days))
 
 REQUIRED_LOCATION_FIELDS = {"longitude", "latitude"}
 IDENTITY_VALIDATION_FIELDS = set()
@@ -353,31 +370,35 @@ def send_message(destination_id: str, body: dict):
 
 
 @app.get("/chats/one/{provider_id}/{client_id}")
-def get_chat(provider_id: str, client_id: str, limit: int, offset: int):
+def get_chat(provider_id: str, client_id: str, limit: int, offset: int = 0,
+             after: Optional[str] = None, before: Optional[str] = None):
+    # `next` and `previous` of a response are the `after` and `before` of the pages around it
     if not accounts_manager.get(provider_id):
         raise HTTPException(status_code=404, detail="Provider not found")
     if not accounts_manager.get(client_id):
         raise HTTPException(status_code=404, detail="Client not found")
 
-    messages = chats_manager.get_messages(
-        provider_id, client_id, limit, offset)
-    if messages is None:
+    try:
+        chat = chats_manager.get_chat(provider_id, client_id, limit, offset, after, before)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if chat is None:
         raise HTTPException(status_code=404, detail="No messages found")
-
-    total_messages = chats_manager.count_messages(provider_id, client_id)
-    return {"status": "ok", "messages": messages, "total_messages": total_messages}
+    return {"status": "ok"} | chat
 
 
 @app.get("/chats/search")
 def search_messages(
     limit: int = Query(...),
-    offset: int = Query(...),
+    offset: int = Query(0),
     provider_id: Optional[str] = Query(None),
     client_id: Optional[str] = Query(None),
     sender_id: Optional[str] = Query(None),
     min_date: Optional[str] = Query(None),
     max_date: Optional[str] = Query(None),
-    keywords: Optional[str] = Query(None)
+    keywords: Optional[str] = Query(None),
+    after: Optional[str] = Query(None),
+    before: Optional[str] = Query(None)
 ):
     if provider_id is not None and not accounts_manager.get(provider_id):
         raise HTTPException(status_code=404, detail="Provider not found")
@@ -394,11 +415,14 @@ def search_messages(
     if max_date is not None and not is_valid_date(max_date):
         raise HTTPException(status_code=400, detail="Invalid max_date")
 
-    messages = chats_manager.search(
-        limit, offset, provider_id, client_id, sender_id, min_date, max_date, keywords)
-    if messages is None:
+    try:
+        page = chats_manager.search_page(
+            limit, offset, provider_id, client_id, sender_id, min_date, max_date, keywords, after, before)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if page is None:
         raise HTTPException(status_code=404, detail="No messages found")
-    return {"status": "ok", "messages": messages}
+    return {"status": "ok"} | page
 
 
 @app.get("/chats/all/{user_id}")
@@ -483,26 +507,96 @@ def review_client(client_id: str, provider_id: str, body: dict):
     return {"status": "ok"}
 
 
-@app.get("/fairness")  # TODO: make this run in the background automatically
-def get_fairness():
-    edge_list = services_lib.get_recent_ratings(max_delta_days=360)
-    if not edge_list:
-        raise HTTPException(status_code=404, detail="No ratings found")
-    graph = Rev2Graph(edge_list)
-    results: dict = graph.calculate()
-    results = {key[1:]: value for key, value in results.items()}
-    # sort the dict
-    results = dict(
-        sorted(results.items(), key=lambda item: item[1], reverse=False))
-    return {"status": "ok", "results": results}
+@app.on_event("startup")
+def report_mongo_indexes():
+    managers = [chats_manager, favourites_manager, certificates_manager, mobile_token_manager]
+    try:
+        report = index_report(chats_manager.db, *(manager.INDEXES for manager in managers))
+    except Exception as e:
+        logger.error(f"Failed to build the MongoDB index report: {e}")
+        return
+    for collection_name, indexes in report.items():
+        for problem in ("missing", "undeclared", "unused"):
+            if indexes[problem]:
+                logger.warning(f"MongoDB indexes {problem} in '{collection_name}': {', '.join(indexes[problem])}")
+
+@app.on_event("startup")
+def start_rev2_scheduler():
+    if rev2_scheduler is not None:
+        rev2_scheduler.start()
+
+@app.on_event("startup")
+def start_recommendations_scheduler():
+    if recommendations_scheduler is not None:
+        recommendations_scheduler.start()
+
+@app.on_event("shutdown")
+def stop_recommendations_scheduler():
+    if recommendations_scheduler is not None:
+        recommendations_scheduler.stop(timeout=5)
+
+@app.on_event("shutdown")
+def stop_rev2_background_work():
+    if rev2_scheduler is not None:
+        rev2_scheduler.stop(timeout=5)
+    rev2_jobs.shutdown()
+
+def _rev2_job_key(engine: Optional[str], gamma1: float, gamma2: float, diff: float, max_delta_days: int):
+    try:
+        return rev2_jobs.key(engine, max_delta_days, gamma1, gamma2, diff)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/fairness")
+def get_fairness(engine: Optional[str] = None, gamma1: float = 0.5, gamma2: float = 0.5, diff: float = 0.01, max_delta_days: int = 360):
+    # served from the results cache, otherwise a background job is started and 202 returned with its id
+    key = _rev2_job_key(engine, gamma1, gamma2, diff, max_delta_days)
+    job = rev2_jobs.cached(key)
+    if job is not None:
+        return {"status": "ok", "job_id": job.job_id, "results": job.results}
+    job = rev2_jobs.submit(key)
+    return JSONResponse(status_code=202, content={"status": "pending", "job": job.summary()})
+
+@app.post("/fairness/jobs")
+def create_fairness_job(engine: Optional[str] = None, gamma1: float = 0.5, gamma2: float = 0.5, diff: float = 0.01, max_delta_days: int = 360):
+    job = rev2_jobs.submit(_rev2_job_key(engine, gamma1, gamma2, diff, max_delta_days))
+    status_code = 200 if job.status == "finished" else 202
+    return JSONResponse(status_code=status_code, content={"status": "ok", "job": job.summary()})
+
+@app.get("/fairness/jobs/{job_id}")
+def get_fairness_job(job_id: str, results: bool = True):
+    job = rev2_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status == "expired":
+        raise HTTPException(status_code=410, detail="Job results expired, submit the job again")
+    return {"status": "ok", "job": job.summary(with_results=results)}
 
 @app.get("/fairness/db")
-def get_fairness_db(limit: int = 100):
-    data = accounts_manager.get_all_reviewer_scores(limit)
+def get_fairness_db(limit: int = 100, snapshot_id: Optional[int] = None, order: str = "asc", after: Optional[str] = None):
+    # served from the active Rev2 snapshot unless an older one is requested,
+    # order=desc gives the top scores and `after` is the `next` cursor of the previous page
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="Invalid order, expected asc or desc")
+    try:
+        data, next_page = accounts_manager.get_reviewer_scores_page(limit, after, order == "desc", snapshot_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     if not data:
         raise HTTPException(status_code=404, detail="No data found")
-    stats = accounts_manager.reviewer_scores_stats()
-    return {"status": "ok", "stats": stats, f"data (first {limit})": data}
+    stats = accounts_manager.reviewer_scores_stats(snapshot_id)
+    return {"status": "ok", "stats": stats, f"data (first {limit})": data, "next": next_page}
+
+@app.get("/fairness/snapshots")
+def get_fairness_snapshots():
+    return {"status": "ok", "snapshots": accounts_manager.get_rev2_snapshots()}
+
+@app.get("/fairness/runs")
+def get_fairness_runs(limit: int = 10):
+    # convergence telemetry of the last Rev2 runs, newest first
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="Limit must be positive")
+    return {"status": "ok", "runs": get_run_history().last(limit)}
 
 @app.put("/favourites/add/{client_id}/{provider_id}")
 def add_favourite_provider(client_id: str, provider_id: str):
@@ -606,6 +700,75 @@ def get_saved_folders(client_id: str):
     return {"status": "ok", "folders": folders}
 
 
+# defined before /folders/{client_id}/{folder_name} so it is not taken as a folder name
+@app.get("/folders/{client_id}/recommendations")
+def get_client_recommendations(
+    client_id: str,
+    client_location: str = Query(...),
+    limit: int = 10,
+):
+    # recommendations of every folder of the client, with one services and relations lookup for all of them
+    _check_recommendations_limit(limit)
+    client = accounts_manager.get(client_id)
+    if not client:
+        raise HTTPException(status_code=404, detail="Client user not found")
+    if client["is_provider"]:
+        raise HTTPException(
+            status_code=400, detail="The user is not a client, something is wrong")
+    if not client_location:
+        raise HTTPException(
+            status_code=400, detail="Client location is required")
+    client_location = validate_location(
+        client_location, REQUIRED_LOCATION_FIELDS)
+
+    folders = favourites_manager.get_folders(client_id)
+    if folders is None:
+        raise HTTPException(
+            status_code=404, detail="Client does not have any folders")
+
+    recommendations = {}
+    for folder_name in folders:
+        cached = recommendation_cache.get(recommendation_cache.key(client_id, folder_name, client_location))
+        if cached is not None:
+            recommendations[folder_name] = cached
+    missing = [folder_name for folder_name in folders if folder_name not in recommendations]
+    # folders that cannot be resolved are reported one by one instead of failing the whole batch
+    unresolved = {}
+    if missing:
+        available_services = services_lib.get_available_services(client_location)
+        if not available_services:
+            unresolved = {folder_name: "No available services in the area" for folder_name in missing}
+            missing = []
+        for folder_name in missing:
+            materialized = _materialized_recommendations(client_id, folder_name, available_services)
+            if materialized is not None:
+                recommendation_cache.put(recommendation_cache.key(client_id, folder_name, client_location), materialized)
+                recommendations[folder_name] = materialized
+        missing = [folder_name for folder_name in missing if folder_name not in recommendations]
+    if missing:
+        # folders created or changed since the last materialization
+        for folder_name in missing:
+            available_services.extend(folders[folder_name])
+        relations_dict = favourites_manager.get_relations(available_services)
+        if relations_dict is None:
+            unresolved.update({folder_name: "No available services to recommend" for folder_name in missing})
+        else:
+            relations = [(folder, saved_service) for folder, saved_services in relations_dict.items()
+                         for saved_service in saved_services]
+            interest_predictor = SparseInterestPredictor(relations)
+            predictions = interest_predictor.get_interest_predictions(
+                [f"{client_id}_{folder_name}" for folder_name in missing], MATERIALIZED_K)
+            for folder_name in missing:
+                folder_recommendations = predictions.get(f"{client_id}_{folder_name}", {})
+                recommendation_cache.put(recommendation_cache.key(client_id, folder_name, client_location), folder_recommendations)
+                recommendations[folder_name] = folder_recommendations
+    if unresolved and not recommendations:
+        raise HTTPException(status_code=404, detail=next(iter(unresolved.values())))
+    recommendations = {folder_name: _first_recommendations(recommendations[folder_name], limit)
+                       for folder_name in folders if folder_name in recommendations}
+    return {"status": "ok", "recommendations": recommendations, "missing": unresolved}
+
+
 @app.put("/folders/addservice/{client_id}/{folder_name}/{service_id}")
 def add_service_to_folder(client_id: str, folder_name: str, service_id: str):
     client = accounts_manager.get(client_id)
@@ -657,7 +820,9 @@ def get_folder_recommendations(
     client_id: str,
     folder_name: str,
     client_location: str = Query(...),
+    limit: int = 10,
 ):
+    _check_recommendations_limit(limit)
     client = accounts_manager.get(client_id)
     if not client:
         raise HTTPException(status_code=404, detail="Client user not found")
@@ -674,11 +839,22 @@ def get_folder_recommendations(
         raise HTTPException(
             status_code=404, detail="Client does not have that folder")
 
+    cache_key = recommendation_cache.key(client_id, folder_name, client_location)
+    recommendations = recommendation_cache.get(cache_key)
+    if recommendations is not None:
+        return {"status": "ok", "recommendations": _first_recommendations(recommendations, limit)}
+
     available_services = services_lib.get_available_services(client_location)
     if not available_services:
         raise HTTPException(
             status_code=404, detail="No available services in the area")
 
+    recommendations = _materialized_recommendations(client_id, folder_name, available_services)
+    if recommendations is not None:
+        recommendation_cache.put(cache_key, recommendations)
+        return {"status": "ok", "recommendations": _first_recommendations(recommendations, limit)}
+
+    # computed on demand for folders created or changed since the last materialization
     folder_services = favourites_manager.get_folder_services(client_id, folder_name)
     available_services.extend(folder_services)
     relations_dict = favourites_manager.get_relations(available_services)
@@ -688,11 +864,33 @@ def get_folder_recommendations(
 
     relations = [(folder, saved_service) for folder, saved_services in relations_dict.items()
                  for saved_service in saved_services]
-    interest_predictor = InterestPredictor(relations, f"{client_id}_{folder_name}")
-    recommendations: dict = interest_predictor.get_interest_prediction()
-    recommendations = dict(
-        sorted(recommendations.items(), key=lambda item: item[1], reverse=True))
-    return {"status": "ok", "recommendations": recommendations}
+    interest_predictor = SparseInterestPredictor(relations, f"{client_id}_{folder_name}")
+    recommendations: dict = interest_predictor.get_interest_prediction(MATERIALIZED_K)
+    recommendation_cache.put(cache_key, recommendations)
+    return {"status": "ok", "recommendations": _first_recommendations(recommendations, limit)}
+
+
+def _materialized_recommendations(client_id: str, folder_name: str, available_services: list) -> Optional[dict]:
+    # the nightly top-k of the folder restricted to the services available around the client,
+    # None to compute them on demand when the folder is not materialized or none of them is available
+    materialized = favourites_manager.get_materialized_recommendations(client_id, folder_name)
+    if not materialized:
+        return None
+    available = set(available_services)
+    recommendations = {service: score for service, score in materialized.items() if service in available}
+    return recommendations or None
+
+
+def _check_recommendations_limit(limit: int):
+    # only the top MATERIALIZED_K of a folder are materialized, computed on demand and cached
+    if not 1 <= limit <= MATERIALIZED_K:
+        raise HTTPException(
+            status_code=400, detail=f"The limit must be between 1 and {MATERIALIZED_K}")
+
+
+def _first_recommendations(recommendations: dict, limit: int) -> dict:
+    # the cached recommendations are sorted by score, the app only shows the first ones
+    return dict(itertools.islice(recommendations.items(), limit))
 
 
 @app.post("/certificates/new/{provider_id}")
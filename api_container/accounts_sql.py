@@ -1,17 +1,21 @@
-from lib.utils import get_actual_time, get_engine
-from typing import Optional, Union
-from sqlalchemy import Integer, MetaData, Table, Column, String, Boolean, Float, bindparam, update
+from lib.score_summary import score_summary
+from lib.utils import decode_cursor, encode_cursor, get_actual_time, get_engine
+from typing import Optional, Tuple, Union
+from sqlalchemy import Integer, MetaData, Table, Column, String, Boolean, Float, Index, Text, and_, bindparam, or_, select, update
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+import json
 import os
 import sys
 import logging as logger
 from sqlalchemy.orm import Session, sessionmaker
-import statistics
 
 HOUR = 60 * 60
 MINUTE = 60
 MILLISECOND = 1_000
 MAX_BATCH = 1_000
+REV2_SNAPSHOTS_KEPT = int(os.getenv("REV2_SNAPSHOTS_KEPT", 3))
+ACTIVE_SNAPSHOT_ROW = 1
+MAX_PAGE = 1_000
 
 # TODO: (General) -> Create tests for each method && add the required checks in each method
 
@@ -35,6 +39,15 @@ class Accounts:
     - reviewer_score: float -- This is the fairness value that the user has when reviewing a product (from 0 -bad- to 1 -good-) (result of the rev2 algorithm)
     - client_count_score: int -- This is the number of reviews that the user has received from providers (result of reviews)
     - client_total_score: int -- This is the total score that the user has received from providers (result of reviews)
+
+    Rev2 runs are also saved as numbered snapshots, each in its own `rev2_scores_<id>` table (uuid, reviewer_score).
+    `rev2_snapshots` lists them and `rev2_active_snapshot` points to the published one, which is what the
+    reviewer score readers serve. Only the last `REV2_SNAPSHOTS_KEPT` published snapshots are kept.
+    The score summary (percentiles and histogram) of every snapshot is computed once, when it is saved.
+    `published_at` is set with the pointer swap and is the end of the Rev2 run for the scheduler.
+    The published snapshot is the authoritative copy of the scores: `reviewer_score` in `accounts` is a copy
+    of it for the per-account reads, written by `rev2_results_saver` after each publish (and read by the
+    /fairness endpoints only while no snapshot has been published yet).
     """
 
     def __init__(self, engine=None):
@@ -45,32 +58,80 @@ class Accounts:
         self.metadata.bind = self.engine
         self.Session = sessionmaker(bind=self.engine)
         
-    def get_all_reviewer_scores(self, limit: int) -> list:
+    def get_all_reviewer_scores(self, limit: int, snapshot_id: Optional[int] = None) -> list:
+        return self.get_reviewer_scores_page(limit, snapshot_id=snapshot_id)[0]
+
+    def get_reviewer_scores_page(self, limit: int, after: Optional[str] = None, descending: bool = False,
+                                 snapshot_id: Optional[int] = None) -> Tuple[list, Optional[str]]:
+        """
+        Page of (uuid, reviewer_score) ordered by score (ascending, or descending for the top-k) and uuid.
+        `after` is the cursor returned with the previous page, so deep pages cost the same as the first one.
+        Returns (rows, cursor of the next page or None). Raises ValueError on an invalid cursor.
+        """
+        limit = max(1, min(MAX_PAGE, limit))
         with self.engine.connect() as connection:
-            query = self.accounts.select().where(self.accounts.c.is_provider == False).where(self.accounts.c.reviewer_score != None)
-            query = query.with_only_columns(self.accounts.c.uuid, self.accounts.c.reviewer_score)
-            query = query.order_by(self.accounts.c.reviewer_score.asc())
-            query = query.limit(min(1000, limit))
-            result = connection.execute(query)
-            rows = result.fetchall()
-            if rows is None:
-                return []
-            return [row._asdict() for row in rows]
+            query, score, uuid = self._reviewer_scores_query(connection, snapshot_id)
+            if query is None:
+                return [], None
+            if after is not None:
+                after_score, after_uuid = _decode_cursor(after)
+                if descending:
+                    query = query.where(or_(score < after_score, and_(score == after_score, uuid < after_uuid)))
+                else:
+                    query = query.where(or_(score > after_score, and_(score == after_score, uuid > after_uuid)))
+            order = (score.desc(), uuid.desc()) if descending else (score.asc(), uuid.asc())
+            rows = connection.execute(query.order_by(*order).limit(limit + 1)).fetchall()
+        rows = [row._asdict() for row in rows]
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        return rows, _encode_cursor(rows[-1]["reviewer_score"], rows[-1]["uuid"])
         
-    def reviewer_scores_stats(self) -> dict:
+    def get_reviewer_scores(self, uuids: list) -> dict:
+        # {uuid: score} from the published snapshot, or from the accounts table while there is none
+        scores = {}
         with self.engine.connect() as connection:
-            query = self.accounts.select().where(self.accounts.c.is_provider == False).where(self.accounts.c.reviewer_score != None)
-            query = query.with_only_columns(self.accounts.c.reviewer_score)
-            result = connection.execute(query)
-            rows = result.fetchall()
-            scores = [row[0] for row in rows]
-            return {
-                "count": len(scores),
-                "avg": statistics.mean(scores) if scores else None,
-                "median": statistics.median(scores) if scores else None,
-                "min": min(scores) if scores else None,
-                "max": max(scores) if scores else None
-            }
+            snapshot_id = self._active_snapshot_id(connection)
+            table = self._snapshot_scores_table(snapshot_id) if snapshot_id is not None else self.accounts
+            for i in range(0, len(uuids), MAX_BATCH):
+                query = select(table.c.uuid, table.c.reviewer_score).where(table.c.uuid.in_(uuids[i:i + MAX_BATCH])).\
+                    where(table.c.reviewer_score != None)
+                result = connection.execute(query)
+                scores.update({row[0]: row[1] for row in result.fetchall()})
+        return scores
+        
+    def reviewer_scores_stats(self, snapshot_id: Optional[int] = None) -> dict:
+        with self.engine.connect() as connection:
+            if snapshot_id is None:
+                snapshot_id = self._active_snapshot_id(connection)
+            if snapshot_id is not None:
+                # precomputed when the snapshot was saved
+                query = select(self.rev2_snapshots.c.summary).where(self.rev2_snapshots.c.id == snapshot_id).\
+                    where(self.rev2_snapshots.c.published == True)
+                row = connection.execute(query).fetchone()
+                if row is None or row[0] is None:
+                    return score_summary([])
+                return json.loads(row[0])
+            query, score, _ = self._reviewer_scores_query(connection)
+            rows = connection.execute(query.with_only_columns(score)).fetchall()
+            return score_summary([row[0] for row in rows])
+
+    def _reviewer_scores_query(self, connection, snapshot_id: Optional[int] = None):
+        # (uuid, reviewer_score) of the clients in the given snapshot (default: the active one),
+        # or from the accounts table while no snapshot has been published yet
+        if snapshot_id is None:
+            snapshot_id = self._active_snapshot_id(connection)
+            if snapshot_id is None:
+                query = select(self.accounts.c.uuid, self.accounts.c.reviewer_score).\
+                    where(self.accounts.c.is_provider == False).where(self.accounts.c.reviewer_score != None)
+                return query, self.accounts.c.reviewer_score, self.accounts.c.uuid
+        elif not self._snapshot_is_published(connection, snapshot_id):
+            return None, None, None
+        scores = self._snapshot_scores_table(snapshot_id)
+        query = select(scores.c.uuid, scores.c.reviewer_score).\
+            join_from(scores, self.accounts, scores.c.uuid == self.accounts.c.uuid).\
+            where(self.accounts.c.is_provider == False)
+        return query, scores.c.reviewer_score, scores.c.uuid
 
     def create_table(self):
         with Session(self.engine) as session:
@@ -92,6 +153,22 @@ class Accounts:
                 Column('client_count_score', Integer, default=None),
                 Column('client_total_score', Integer, default=None)
             )
+            self.rev2_snapshots = Table(
+                'rev2_snapshots',
+                metadata,
+                Column('id', Integer, primary_key=True, autoincrement=True),
+                Column('created_at', String),
+                Column('score_count', Integer),
+                Column('summary', Text),
+                Column('published', Boolean, default=False),
+                Column('published_at', String)
+            )
+            self.rev2_active_snapshot = Table(
+                'rev2_active_snapshot',
+                metadata,
+                Column('id', Integer, primary_key=True),
+                Column('snapshot_id', Integer)
+            )
             metadata.create_all(self.engine)
             session.commit()
 
@@ -187,16 +264,147 @@ class Accounts:
         self.metadata.drop_all()
         self.metadata.create_all()
 
-    def rev2_results_saver(self, results: dict):
-        with Session(self.engine) as session:
-            for i in range(0, len(results), MAX_BATCH):
-                batch = list(results.items())[i:i + MAX_BATCH]
-                batch_dict = [{"uuid": k, "reviewer_score": v} for k, v in batch]
-                stmt = self.accounts.update().\
-                    where(self.accounts.c.uuid == bindparam('uuid')).\
-                    values({
-                        'reviewer_score': bindparam('reviewer_score'),
-                        'uuid': bindparam('uuid')
-                    })
-                session.execute(stmt, batch_dict)
-                session.commit()
+    def rev2_results_saver(self, results: dict) -> int:
+        """
+        Saves the Rev2 reviewer scores ({uuid: score}) in a single transaction, only touching
+        the accounts whose score changed. Returns the number of updated accounts.
+        PostgreSQL stages the scores in a temporary table and applies them with one UPDATE ... FROM,
+        other databases (SQLite in tests) update the changed rows one by one.
+        """
+        rows = [{"uuid": uuid, "reviewer_score": score} for uuid, score in results.items()]
+        if not rows:
+            return 0
+        with self.engine.begin() as connection:
+            if self.engine.dialect.name == "postgresql":
+                updated = self._staged_reviewer_scores_update(connection, rows)
+            else:
+                updated = self._changed_reviewer_scores_update(connection, rows)
+        logger.info(f"Rev2 results saved: {updated} of {len(rows)} reviewer scores changed")
+        return updated
+
+    def _staged_reviewer_scores_update(self, connection, rows: list) -> int:
+        staging = self._reviewer_scores_staging_table()
+        staging.create(connection)
+        for i in range(0, len(rows), MAX_BATCH):
+            # one multi-row INSERT ... VALUES per batch
+            connection.execute(staging.insert().values(rows[i:i + MAX_BATCH]))
+        return connection.execute(self._reviewer_scores_update_from(staging)).rowcount
+
+    def _reviewer_scores_staging_table(self) -> Table:
+        return Table(
+            'rev2_reviewer_scores_staging',
+            MetaData(),
+            Column('uuid', String, primary_key=True),
+            Column('reviewer_score', Float),
+            prefixes=['TEMPORARY'],
+            postgresql_on_commit='DROP'
+        )
+
+    def _reviewer_scores_update_from(self, staging: Table):
+        return self.accounts.update().\
+            where(self.accounts.c.uuid == staging.c.uuid).\
+            where(self.accounts.c.reviewer_score.is_distinct_from(staging.c.reviewer_score)).\
+            values(reviewer_score=staging.c.reviewer_score)
+
+    def _changed_reviewer_scores_update(self, connection, rows: list) -> int:
+        changed = []
+        for i in range(0, len(rows), MAX_BATCH):
+            batch = rows[i:i + MAX_BATCH]
+            query = self.accounts.select().where(self.accounts.c.uuid.in_([row["uuid"] for row in batch]))
+            query = query.with_only_columns(self.accounts.c.uuid, self.accounts.c.reviewer_score)
+            current = {row[0]: row[1] for row in connection.execute(query).fetchall()}
+            changed.extend(row for row in batch if row["uuid"] in current and current[row["uuid"]] != row["reviewer_score"])
+        if changed:
+            stmt = self.accounts.update().\
+                where(self.accounts.c.uuid == bindparam('account_uuid')).\
+                values(reviewer_score=bindparam('reviewer_score'))
+            connection.execute(stmt, [{"account_uuid": row["uuid"], "reviewer_score": row["reviewer_score"]} for row in changed])
+        return len(changed)
+
+    def save_rev2_snapshot(self, results: dict) -> Optional[int]:
+        """
+        Writes the Rev2 reviewer scores ({uuid: score}) as a new snapshot and publishes it once complete.
+        Readers keep serving the previous snapshot until the pointer swap. Returns the snapshot id.
+        """
+        try:
+            with self.engine.begin() as connection:
+                snapshot_id = connection.execute(self.rev2_snapshots.insert().values(
+                    created_at=get_actual_time(), score_count=len(results), published=False)).inserted_primary_key[0]
+            scores = self._snapshot_scores_table(snapshot_id)
+            rows = [{"uuid": uuid, "reviewer_score": score} for uuid, score in results.items()]
+            with self.engine.begin() as connection:
+                scores.create(connection)
+                for i in range(0, len(rows), MAX_BATCH):
+                    connection.execute(scores.insert(), rows[i:i + MAX_BATCH])
+            with self.engine.begin() as connection:
+                # the swap is a single row update, so readers see either the old or the new snapshot
+                pointer = self.rev2_active_snapshot
+                if not connection.execute(pointer.update().where(pointer.c.id == ACTIVE_SNAPSHOT_ROW).values(snapshot_id=snapshot_id)).rowcount:
+                    connection.execute(pointer.insert().values(id=ACTIVE_SNAPSHOT_ROW, snapshot_id=snapshot_id))
+                # summary of the scores readers are served (providers left out), computed once per snapshot
+                served = select(scores.c.reviewer_score).join_from(scores, self.accounts, scores.c.uuid == self.accounts.c.uuid).\
+                    where(self.accounts.c.is_provider == False)
+                summary = score_summary([row[0] for row in connection.execute(served).fetchall()])
+                connection.execute(self.rev2_snapshots.update().where(self.rev2_snapshots.c.id == snapshot_id).
+                                   values(published=True, published_at=get_actual_time(), summary=json.dumps(summary)))
+        except SQLAlchemyError as e:
+            logger.error(f"SQLAlchemyError: {e}")
+            return None
+        self._prune_rev2_snapshots()
+        logger.info(f"Rev2 snapshot {snapshot_id} published with {len(results)} reviewer scores")
+        return snapshot_id
+
+    def get_rev2_snapshots(self) -> list:
+        with self.engine.connect() as connection:
+            active = self._active_snapshot_id(connection)
+            query = self.rev2_snapshots.select().where(self.rev2_snapshots.c.published == True).order_by(self.rev2_snapshots.c.id.desc())
+            query = query.with_only_columns(self.rev2_snapshots.c.id, self.rev2_snapshots.c.created_at,
+                                            self.rev2_snapshots.c.published_at, self.rev2_snapshots.c.score_count)
+            return [{**row._asdict(), "active": row.id == active} for row in connection.execute(query).fetchall()]
+
+    def _prune_rev2_snapshots(self, keep: int = REV2_SNAPSHOTS_KEPT):
+        # drops the published snapshots older than the last `keep` ones, and any unpublished leftover before them
+        try:
+            with self.engine.begin() as connection:
+                kept = connection.execute(select(self.rev2_snapshots.c.id).where(self.rev2_snapshots.c.published == True).
+                                          order_by(self.rev2_snapshots.c.id.desc()).limit(max(1, keep))).fetchall()
+                if not kept:
+                    return
+                stale = connection.execute(select(self.rev2_snapshots.c.id).where(self.rev2_snapshots.c.id < kept[-1][0])).fetchall()
+                for (snapshot_id,) in stale:
+                    self._snapshot_scores_table(snapshot_id).drop(connection, checkfirst=True)
+                if stale:
+                    connection.execute(self.rev2_snapshots.delete().where(self.rev2_snapshots.c.id < kept[-1][0]))
+        except SQLAlchemyError as e:
+            logger.error(f"SQLAlchemyError: {e}")
+
+    def _active_snapshot_id(self, connection) -> Optional[int]:
+        pointer = self.rev2_active_snapshot
+        row = connection.execute(select(pointer.c.snapshot_id).where(pointer.c.id == ACTIVE_SNAPSHOT_ROW)).fetchone()
+        return row[0] if row is not None else None
+
+    def _snapshot_is_published(self, connection, snapshot_id: int) -> bool:
+        query = select(self.rev2_snapshots.c.id).where(self.rev2_snapshots.c.id == snapshot_id).where(self.rev2_snapshots.c.published == True)
+        return connection.execute(query).fetchone() is not None
+
+    def _snapshot_scores_table(self, snapshot_id: int) -> Table:
+        metadata = MetaData()
+        return Table(
+            f'rev2_scores_{int(snapshot_id)}',
+            metadata,
+            Column('uuid', String, primary_key=True),
+            Column('reviewer_score', Float),
+            # keyset pagination order
+            Index(f'rev2_scores_{int(snapshot_id)}_reviewer_score', 'reviewer_score', 'uuid')
+        )
+
+
+def _encode_cursor(score: float, uuid: str) -> str:
+    return encode_cursor([score, uuid])
+
+def _decode_cursor(cursor: str) -> Tuple[float, str]:
+    score, uuid = decode_cursor(cursor, 2)
+    try:
+        return float(score), str(uuid)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor")
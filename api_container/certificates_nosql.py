@@ -8,6 +8,7 @@ import os
 import sys
 import uuid
 from lib.utils import get_actual_time, get_mongo_client
+from lib.mongo_indexes import IndexSpec, ensure_indexes
 
 HOUR = 60 * 60
 MINUTE = 60
@@ -36,6 +37,15 @@ class Certificates:
     - expiration_date (int): The timestamp of the expiration date of the certificate
     """
 
+    INDEXES = {
+        'certificates': [
+            IndexSpec([('uuid', ASCENDING)], unique=True),
+            IndexSpec([('certificates.certificate_id', ASCENDING)]),
+            # only the providers with certificates pending validation
+            IndexSpec([('certificates.is_validated', ASCENDING)], partial={'certificates.is_validated': False})
+        ]
+    }
+
     def __init__(self, test_client=None, test_db=None):
         self.client = test_client or get_mongo_client()
         if not self._check_connection():
@@ -56,7 +66,7 @@ class Certificates:
         return True
 
     def _create_collection(self):
-        self.collection.create_index([('uuid', ASCENDING)], unique=True)
+        ensure_indexes(self.db, self.INDEXES)
 
     def _create_profile(self, provider_id: int):
         self.collection.insert_one({
@@ -154,6 +164,8 @@ class Certificates:
 
     def get_unverified_certificates(self, limit: int, offset: int) -> Optional[List[Dict]]:
         pipeline = [
+            # the first match only keeps the providers with pending certificates (indexed), the second their certificates
+            {'$match': {'certificates.is_validated': False}},
             {'$unwind': '$certificates'},
             {'$match': {'certificates.is_validated': False}},
             {'$sort': {'certificates.created_at': ASCENDING}},
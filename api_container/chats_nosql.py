@@ -1,17 +1,31 @@
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
-from pymongo import ASCENDING
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
 from pymongo.errors import DuplicateKeyError, OperationFailure
 import logging as logger
 import os
+import re
 import sys
 import uuid
-from lib.utils import get_actual_time, get_mongo_client
+from lib.utils import decode_cursor, encode_cursor, get_actual_time, get_mongo_client
+from lib.mongo_indexes import IndexSpec, ensure_indexes
 
 HOUR = 60 * 60
 MINUTE = 60
 MILLISECOND = 1_000
+STORAGES = ("document", "buckets")
+STORAGE = os.getenv("CHATS_STORAGE", "document")
+BUCKET_SIZE = int(os.getenv("CHATS_BUCKET_SIZE", 100))
+SEARCH_INDEX = os.getenv("CHATS_SEARCH_INDEX", "True").title() == "True"
+SEARCH_INDEX_BATCH = 10_000
+TERM_PATTERN = re.compile(r'\w+')
+SEARCH_ORDER = [('sent_at', ASCENDING), ('chat_info.id', ASCENDING), ('seq', ASCENDING)]
+# keyword searches rank the messages matching the most words first
+INDEXED_SEARCH_ORDER = [('score', DESCENDING), ('sent_at', ASCENDING), ('chat_id', ASCENDING), ('seq', ASCENDING)]
+# chat lists only need the header, the last message is only read from chats written before the counters
+CHAT_LIST_PROJECTION = {'_id': 0, 'provider_id': 1, 'client_id': 1, 'last_message_at': 1, 'last_message': 1,
+                        'messages': {'$slice': -1}}
 
 # TODO: (General) -> Create tests for each method && add the required checks in each method
 
@@ -25,14 +39,61 @@ class Chats:
     - messages (List[Dict]): The list of messages
     - created_at (int): The timestamp of the creation of the chat
     - last_message_at (int): The timestamp of the last message sent in the chat
+    - message_count (int): The number of messages, updated with each message
+    - last_message (str), last_sender_id (str): The last message sent in the chat and its sender
+    The counters are set in the same update as the message, so chat lists and counts never read `messages`.
+    Chats written before them are filled in on their next message (readers fall back to `messages` meanwhile).
 
     Messages structure:
     - sender_id (str): The id of the sender account
     - message (str): The message content
     - sent_at (int): The timestamp of the message sent
+
+    With the "buckets" storage (CHATS_STORAGE) the chat document is a small header without `messages`
+    and the messages are kept in order in the `chat_buckets` collection, `bucket_size` per document:
+    - chat_id (str), provider_id (str), client_id (str), bucket (int), messages (List[Dict])
+    - first_sent_at (str), last_sent_at (str): The range of its messages, so searches skip the buckets out of a date range
+    Each message gets its position in the chat (`seq`) from the header counter, so writes and page reads only
+    touch one or two buckets. Existing chats are moved to buckets with `migrate_to_buckets` (migrate_chats.py).
+
+    Keyword searches use the `chat_terms` collection (CHATS_SEARCH_INDEX), a document per word of each message
+    written with the message, so they read the postings of the searched words instead of every message:
+    - term (str), chat_id (str), seq (int), provider_id (str), client_id (str), sender_id (str), sent_at (str)
+    It is built from the existing messages on the first start and recreated with `rebuild_search_index`.
     """
 
-    def __init__(self, test_client=None, test_db=None):
+    INDEXES = {
+        'chats': [
+            IndexSpec([('uuid', ASCENDING)], unique=True),
+            # _chat_exists and the provider's chat list
+            IndexSpec([('provider_id', ASCENDING), ('client_id', ASCENDING)]),
+            # the client's chat list
+            IndexSpec([('client_id', ASCENDING), ('last_message_at', DESCENDING)]),
+            # search pages after a cursor or a date
+            IndexSpec([('last_message_at', ASCENDING)])
+        ],
+        'chat_buckets': [
+            IndexSpec([('chat_id', ASCENDING), ('bucket', ASCENDING)], unique=True),
+            # search by provider and/or client
+            IndexSpec([('provider_id', ASCENDING), ('client_id', ASCENDING)]),
+            IndexSpec([('client_id', ASCENDING)]),
+            IndexSpec([('last_sent_at', ASCENDING)])
+        ],
+        'chat_terms': [
+            IndexSpec([('chat_id', ASCENDING), ('seq', ASCENDING), ('term', ASCENDING)], unique=True),
+            # keyword search alone or by provider and/or client, the date range is part of the same scan
+            IndexSpec([('term', ASCENDING), ('provider_id', ASCENDING), ('client_id', ASCENDING), ('sent_at', ASCENDING)]),
+            IndexSpec([('term', ASCENDING), ('client_id', ASCENDING), ('sent_at', ASCENDING)])
+        ]
+    }
+
+    def __init__(self, test_client=None, test_db=None, storage: Optional[str] = None, bucket_size: int = BUCKET_SIZE,
+                 search_index: Optional[bool] = None):
+        self.storage = storage or STORAGE
+        if self.storage not in STORAGES:
+            raise ValueError(f"Unknown chats storage '{self.storage}' (valid storages: {', '.join(STORAGES)})")
+        self.bucket_size = bucket_size
+        self.search_index = SEARCH_INDEX if search_index is None else search_index
         self.client = test_client or get_mongo_client()
         if not self._check_connection():
             raise Exception("Failed to connect to MongoDB")
@@ -41,6 +102,8 @@ class Chats:
         else:
             self.db = self.client[test_db or os.getenv('MONGO_DB')]
         self.collection = self.db['chats']
+        self.buckets = self.db['chat_buckets']
+        self.terms = self.db['chat_terms']
         self._create_collection()
     
     def _check_connection(self):
@@ -52,30 +115,43 @@ class Chats:
         return True
 
     def _create_collection(self):
-        self.collection.create_index([('uuid', ASCENDING)], unique=True)
+        ensure_indexes(self.db, self.INDEXES)
+        if self.search_index and self.terms.estimated_document_count() == 0 and self.collection.estimated_document_count() > 0:
+            # first start with the search index
+            self.rebuild_search_index()
     
     def insert_message(self, provider_id: str, client_id: str, message_content: str, message_sender_id: str) -> Optional[str]:
         actual_time = get_actual_time()
         chat_id = self._chat_exists(provider_id, client_id)
         if not chat_id:
             try:
-                return self._create_chat(provider_id, client_id, message_content, message_sender_id, actual_time)
+                chat_id, seq = self._create_chat(provider_id, client_id, message_content, message_sender_id, actual_time), 0
             except DuplicateKeyError as e:
                 logger.error(f"DuplicateKeyError: {e}")
                 return None
             except OperationFailure as e:
                 logger.error(f"OperationFailure: {e}")
                 return None
-        
-        try:
-            self._update_chat(message_content, message_sender_id, actual_time, chat_id)
-            return chat_id
-        except Exception as e:
-            logger.error(f"Error updating chat with id '{chat_id}': {e}")
-            return None
+        else:
+            try:
+                seq = self._update_chat(message_content, message_sender_id, actual_time, chat_id)
+            except Exception as e:
+                logger.error(f"Error updating chat with id '{chat_id}': {e}")
+                return None
+
+        if self.search_index:
+            try:
+                self._index_message(chat_id, seq, provider_id, client_id, message_content, message_sender_id, actual_time)
+            except Exception as e:
+                # the message is saved, `rebuild_search_index` adds it to the index
+                logger.error(f"Error indexing message {seq} of chat '{chat_id}': {e}")
+        return chat_id
 
-    def _update_chat(self, message_content, message_sender_id, actual_time, chat_id):
-        self.collection.update_one({'uuid': chat_id}, {
+    def _update_chat(self, message_content, message_sender_id, actual_time, chat_id) -> int:
+        # position of the new message in the chat
+        if self.storage == "buckets":
+            return self._append_to_bucket(chat_id, message_content, message_sender_id, actual_time)
+        update = {
                     '$push': {
                         'messages': {
                             'sender_id': message_sender_id,
@@ -83,13 +159,51 @@ class Chats:
                             'sent_at': actual_time
                         }
                     },
+                    '$inc': {
+                        'message_count': 1
+                    },
                     '$set': {
-                        'last_message_at': actual_time
+                        'last_message_at': actual_time,
+                        'last_message': message_content,
+                        'last_sender_id': message_sender_id
                     }
-                })
+                }
+        header = self.collection.find_one_and_update({'uuid': chat_id, 'message_count': {'$exists': True}}, update,
+                                                     projection={'_id': 0, 'message_count': 1}, return_document=ReturnDocument.AFTER)
+        if header is None:
+            # chat written before the counters
+            self._fill_counters(chat_id)
+            header = self.collection.find_one_and_update({'uuid': chat_id}, update, projection={'_id': 0, 'message_count': 1},
+                                                         return_document=ReturnDocument.AFTER)
+        return header['message_count'] - 1
+
+    def _fill_counters(self, chat_id):
+        counted = list(self.collection.aggregate([
+            {'$match': {'uuid': chat_id, 'message_count': {'$exists': False}}},
+            {'$project': {'message_count': {'$size': '$messages'}, 'last': {'$slice': ['$messages', -1]}}}
+        ]))
+        if not counted:
+            return
+        last = counted[0]['last'][0] if counted[0]['last'] else {}
+        self.collection.update_one({'uuid': chat_id, 'message_count': {'$exists': False}}, {'$set': {
+                    'message_count': counted[0]['message_count'],
+                    'last_message': last.get('message'),
+                    'last_sender_id': last.get('sender_id')
+                }})
 
     def _create_chat(self, provider_id, client_id, message_content, message_sender_id, actual_time):
         str_uuid = str(uuid.uuid4())
+        if self.storage == "buckets":
+            self.collection.insert_one({
+                        'uuid': str_uuid,
+                        'provider_id': provider_id,
+                        'client_id': client_id,
+                        'created_at': actual_time,
+                        'last_message_at': actual_time,
+                        'message_count': 0
+                    })
+            self._append_to_bucket(str_uuid, message_content, message_sender_id, actual_time)
+            return str_uuid
         self.collection.insert_one({
                     'uuid': str_uuid,
                     'provider_id': provider_id,
@@ -100,72 +214,220 @@ class Chats:
                         'sent_at': actual_time
                     }],
                     'created_at': actual_time,
-                    'last_message_at': actual_time
+                    'last_message_at': actual_time,
+                    'message_count': 1,
+                    'last_message': message_content,
+                    'last_sender_id': message_sender_id
                 })
         
         return str_uuid
         
+    def _append_to_bucket(self, chat_id, message_content, message_sender_id, actual_time):
+        # the counter increment reserves the message position, so concurrent writers never share a slot
+        header = self.collection.find_one_and_update({'uuid': chat_id}, {
+                    '$inc': {'message_count': 1},
+                    '$set': {
+                        'last_message_at': actual_time,
+                        'last_message': message_content,
+                        'last_sender_id': message_sender_id
+                    }
+                }, projection={'provider_id': 1, 'client_id': 1, 'message_count': 1}, return_document=ReturnDocument.AFTER)
+        seq = header['message_count'] - 1
+        self.buckets.update_one({'chat_id': chat_id, 'bucket': seq // self.bucket_size}, {
+                    '$push': {
+                        'messages': {
+                            'sender_id': message_sender_id,
+                            'message': message_content,
+                            'sent_at': actual_time,
+                            'seq': seq
+                        }
+                    },
+                    '$setOnInsert': {
+                        'provider_id': header['provider_id'],
+                        'client_id': header['client_id']
+                    },
+                    '$min': {'first_sent_at': actual_time},
+                    '$max': {'last_sent_at': actual_time}
+                }, upsert=True)
+        return seq
+
     def _chat_exists(self, provider_id: str, client_id: str) -> Optional[str]:
-        doc = self.collection.find_one({'provider_id': provider_id, 'client_id': client_id})
-        return doc['uuid'] if doc else None
+        header = self._chat_header(provider_id, client_id)
+        return header['uuid'] if header else None
+
+    def _chat_header(self, provider_id: str, client_id: str) -> Optional[Dict]:
+        return self.collection.find_one({'provider_id': provider_id, 'client_id': client_id},
+                                        {'_id': 0, 'uuid': 1, 'message_count': 1})
     
     def delete(self, uuid: str) -> bool:
         result = self.collection.delete_one({'uuid': uuid})
+        self.buckets.delete_many({'chat_id': uuid})
+        self.terms.delete_many({'chat_id': uuid})
         return result.deleted_count > 0
 
     def get_messages(self, provider_id: str, client_id: str, limit: int, offset: int) -> Optional[List[Dict]]:
         chat_id = self._chat_exists(provider_id, client_id)
         if not chat_id:
             return None
-        messages = self.collection.aggregate([
-            {'$match': {'uuid': chat_id}},
-            {'$unwind': '$messages'},
-            {'$sort': {'messages.sent_at': ASCENDING}},
-            {'$skip': offset},
-            {'$limit': limit},
-            {'$group': {
-                '_id': '$_id',
-                'messages': {'$push': '$messages'}
-            }}
-        ])
-        results = list(messages)
-        if not results:
+        return self._get_messages(chat_id, limit, offset)
+
+    def get_chat(self, provider_id: str, client_id: str, limit: int, offset: int = 0,
+                 after: Optional[str] = None, before: Optional[str] = None) -> Optional[Dict]:
+        """
+        Page of messages with a single lookup of the chat: {"messages", "total_messages", "next", "previous"}.
+        `next`/`previous` are the cursors to pass as `after`/`before` for the following/preceding page
+        (None at either end). With a cursor the page is found from the message position, so every page
+        costs the same. Returns None without messages and raises ValueError on an invalid cursor.
+        """
+        header = self._chat_header(provider_id, client_id)
+        if not header:
             return None
-        return results[0]['messages']
-    
+        if after is not None:
+            start = _cursor_seq(after) + 1
+        elif before is not None:
+            end = _cursor_seq(before)
+            start = max(0, end - limit)
+            limit = end - start
+        else:
+            start = max(0, offset)
+        messages = self._get_messages(header['uuid'], limit, start)
+        if messages is None:
+            return None
+        total = self._message_count(header)
+        return {
+            "messages": messages,
+            "total_messages": total,
+            "next": encode_cursor([messages[-1]['sent_at'], start + len(messages) - 1]) if start + len(messages) < total else None,
+            "previous": encode_cursor([messages[0]['sent_at'], start]) if start > 0 else None
+        }
+
+    def _get_messages(self, chat_id: str, limit: int, offset: int) -> Optional[List[Dict]]:
+        # messages [offset, offset + limit) in the order they were sent
+        if limit <= 0:
+            return None
+        if self.storage == "buckets":
+            return self._get_bucket_messages(chat_id, limit, offset)
+        chat = self.collection.find_one({'uuid': chat_id}, {'_id': 0, 'messages': {'$slice': [offset, limit]}})
+        return (chat or {}).get('messages') or None
+
+    def _get_bucket_messages(self, chat_id: str, limit: int, offset: int) -> Optional[List[Dict]]:
+        first, last = offset // self.bucket_size, (offset + limit - 1) // self.bucket_size
+        buckets = self.buckets.find({'chat_id': chat_id, 'bucket': {'$gte': first, '$lte': last}},
+                                    {'_id': 0, 'messages': 1}).sort('bucket', ASCENDING)
+        start = offset - first * self.bucket_size
+        messages = [message for bucket in buckets for message in bucket['messages']][start:start + limit]
+        return [_without_seq(message) for message in messages] or None
+
     def count_messages(self, provider_id: str, client_id: str) -> int:
-        chat_id = self._chat_exists(provider_id, client_id)
-        if not chat_id:
+        header = self._chat_header(provider_id, client_id)
+        if not header:
             return 0
-        messages = self.collection.aggregate([
-            {'$match': {'uuid': chat_id}},
-            {'$unwind': '$messages'},
-            {'$count': 'count'}
-        ])
-        result = list(messages)
+        return self._message_count(header)
+
+    def _message_count(self, header: Dict) -> int:
+        if 'message_count' in header:
+            return header['message_count']
+        # chat written before the counters
+        result = list(self.collection.aggregate([
+            {'$match': {'uuid': header['uuid']}},
+            {'$project': {'count': {'$size': '$messages'}}}
+        ]))
         if not result:
             return 0
         return result[0]['count']
 
     def search(self, limit: int, offset: int, provider_id: str = None, client_id: str = None, sender_id: str = None, msg_min_date: str = None, msg_max_date: str = None, keywords: List[str] = None) -> Optional[List[Dict]]:
-        pipeline = []
+        page = self.search_page(limit, offset, provider_id, client_id, sender_id, msg_min_date, msg_max_date, keywords)
+        return page["messages"] if page else None
 
-        if provider_id:
-            pipeline.append({'$match': {'provider_id': provider_id}})
+    def search_page(self, limit: int, offset: int = 0, provider_id: str = None, client_id: str = None, sender_id: str = None,
+                    msg_min_date: str = None, msg_max_date: str = None, keywords: List[str] = None,
+                    after: Optional[str] = None, before: Optional[str] = None) -> Optional[Dict]:
+        """
+        Messages matching the filters: {"messages", "next", "previous"}, with the cursors of the
+        following/preceding page as in `get_chat`.
+        Without keywords they are sorted by (sent_at, chat, position in the chat). With keywords they are
+        looked up in the search index, the ones matching the most keywords first (then in the same order),
+        and the regex scan of every message is only the fallback when the index is disabled.
+        Returns None without results and raises ValueError on an invalid cursor.
+        """
+        terms = _terms(' '.join(keywords)) if keywords and self.search_index else []
+        order = INDEXED_SEARCH_ORDER if terms else SEARCH_ORDER
+        cursor = after if after is not None else before
+        cursor = decode_cursor(cursor, len(order)) if cursor is not None else None
+        forward = after is not None or before is None
+        if terms:
+            collection, pipeline = self.terms, self._indexed_search_pipeline(
+                terms, provider_id, client_id, sender_id, msg_min_date, msg_max_date)
+        else:
+            # the cursor's sent_at bounds the chats or buckets read, before their messages are unwound
+            if cursor is not None and not isinstance(cursor[0], str):
+                raise ValueError("Invalid cursor")
+            if cursor is not None:
+                msg_min_date = max(msg_min_date or cursor[0], cursor[0]) if forward else msg_min_date
+                msg_max_date = msg_max_date if forward else min(msg_max_date or cursor[0], cursor[0])
+            collection, pipeline = self.buckets if self.storage == "buckets" else self.collection, self._search_pipeline(
+                provider_id, client_id, sender_id, msg_min_date, msg_max_date, keywords)
+
+        if cursor is not None:
+            pipeline.append({'$match': _keyset_match(order, cursor, forward)})
+        pipeline.append({'$sort': {field: direction if forward else -direction for field, direction in order}})
+        # right after the sort so only the first results are kept while sorting
+        if cursor is None:
+            pipeline.append({'$limit': max(0, offset) + limit + 1})
+            pipeline.append({'$skip': max(0, offset)})
+        else:
+            pipeline.append({'$limit': limit + 1})
+
+        results = list(collection.aggregate(pipeline))
+        more = len(results) > limit
+        results = results[:limit]
+        if not results:
+            return None
+        if not forward:
+            results.reverse()
+        has_next = before is not None or more
+        has_previous = more if before is not None else (after is not None or offset > 0)
+        page = {
+            "next": _search_cursor(results[-1], order) if has_next else None,
+            "previous": _search_cursor(results[0], order) if has_previous else None
+        }
+        if terms:
+            results = self._indexed_messages(results)
+        return {"messages": [_without_seq(result) for result in results]} | page
 
+    def _search_pipeline(self, provider_id, client_id, sender_id, msg_min_date, msg_max_date, keywords) -> List[Dict]:
+        # the first match skips the chats (or buckets) without messages in the date range, it can use an index
+        match = {}
+        if provider_id:
+            match['provider_id'] = provider_id
         if client_id:
-            pipeline.append({'$match': {'client_id': client_id}})
+            match['client_id'] = client_id
+        first_field, last_field = ('first_sent_at', 'last_sent_at') if self.storage == "buckets" else ('created_at', 'last_message_at')
+        ranges = []
+        if msg_min_date:
+            ranges.append(_range_match(last_field, '$gte', msg_min_date, self.storage == "buckets"))
+        if msg_max_date:
+            ranges.append(_range_match(first_field, '$lte', msg_max_date, self.storage == "buckets"))
+        if ranges:
+            match['$and'] = ranges
+        pipeline = [{'$match': match}] if match else []
         
-        pipeline.append({'$unwind': '$messages'})
+        if self.storage == "buckets":
+            pipeline.append({'$unwind': '$messages'})
+        else:
+            pipeline.append({'$unwind': {'path': '$messages', 'includeArrayIndex': 'seq'}})
         pipeline.append({
             '$addFields': {
                 'messages.chat_info': {
-                    'id': '$uuid',
+                    'id': '$chat_id' if self.storage == "buckets" else '$uuid',
                     'provider_id': '$provider_id',
                     'client_id': '$client_id'
                 }
             }
         })
+        if self.storage != "buckets":
+            pipeline.append({'$addFields': {'messages.seq': '$seq'}})
         pipeline.append({
             '$replaceRoot': {
                 'newRoot': '$messages'
@@ -175,23 +437,98 @@ class Chats:
         if sender_id:
             pipeline.append({'$match': {'sender_id': sender_id}})
         
-        if any([msg_min_date, msg_max_date]):
-            match = {}
-            if msg_min_date:
-                match['$gte'] = msg_min_date
-            if msg_max_date:
-                match['$lte'] = msg_max_date
-            pipeline.append({'$match': {'sent_at': match}})
+        date_match = _date_match(msg_min_date, msg_max_date)
+        if date_match:
+            pipeline.append({'$match': {'sent_at': date_match}})
 
         if keywords and len(keywords) > 0:
             pipeline.append({'$match': {'message': {'$regex': '|'.join(keywords), '$options': 'i'}}})
+        return pipeline
+
+    def _indexed_search_pipeline(self, terms, provider_id, client_id, sender_id, msg_min_date, msg_max_date) -> List[Dict]:
+        # every filter is part of the first match, so only the postings of the searched words are read
+        prefixes = ['^' + re.escape(term) for term in terms]
+        match = {'term': {'$in': [re.compile(prefix) for prefix in prefixes]}}
+        if provider_id:
+            match['provider_id'] = provider_id
+        if client_id:
+            match['client_id'] = client_id
+        if sender_id:
+            match['sender_id'] = sender_id
+        date_match = _date_match(msg_min_date, msg_max_date)
+        if date_match:
+            match['sent_at'] = date_match
+        return [
+            {'$match': match},
+            # a keyword counts once per message however many of its words it prefixes
+            {'$group': {
+                '_id': {'chat_id': '$chat_id', 'seq': '$seq'},
+                **{f'keyword_{i}': {'$max': {'$cond': [{'$regexMatch': {'input': '$term', 'regex': prefix}}, 1, 0]}}
+                   for i, prefix in enumerate(prefixes)},
+                'sent_at': {'$first': '$sent_at'},
+                'provider_id': {'$first': '$provider_id'},
+                'client_id': {'$first': '$client_id'}
+            }},
+            {'$project': {'_id': 0, 'chat_id': '$_id.chat_id', 'seq': '$_id.seq',
+                          'score': {'$add': [f'$keyword_{i}' for i in range(len(prefixes))]}, 'sent_at': 1,
+                          'provider_id': 1, 'client_id': 1}}
+        ]
 
-        pipeline.append({'$sort': {'messages.sent_at': ASCENDING}})
+    def _indexed_messages(self, hits: List[Dict]) -> List[Dict]:
+        # the messages of a page of search index hits, with the same fields as the regex search
+        messages = {}
+        if self.storage == "buckets":
+            positions = {(hit['chat_id'], hit['seq'] // self.bucket_size) for hit in hits}
+            buckets = self.buckets.find({'$or': [{'chat_id': chat_id, 'bucket': bucket} for chat_id, bucket in positions]},
+                                        {'_id': 0, 'chat_id': 1, 'messages': 1})
+            for bucket in buckets:
+                for message in bucket['messages']:
+                    messages[(bucket['chat_id'], message['seq'])] = message
+        else:
+            for hit in hits:
+                chat = self.collection.find_one({'uuid': hit['chat_id']}, {'_id': 0, 'messages': {'$slice': [hit['seq'], 1]}})
+                if chat and chat.get('messages'):
+                    messages[(hit['chat_id'], hit['seq'])] = chat['messages'][0]
+        return [_without_seq(messages[(hit['chat_id'], hit['seq'])]) | {
+                    'chat_info': {'id': hit['chat_id'], 'provider_id': hit['provider_id'], 'client_id': hit['client_id']}
+                } for hit in hits if (hit['chat_id'], hit['seq']) in messages]
 
-        pipeline.append({'$skip': offset})
-        pipeline.append({'$limit': limit})
+    def _index_message(self, chat_id: str, seq: int, provider_id: str, client_id: str, message_content: str,
+                       message_sender_id: str, actual_time: str):
+        postings = _postings(chat_id, seq, provider_id, client_id, message_content, message_sender_id, actual_time)
+        if postings:
+            self.terms.insert_many(postings, ordered=False)
 
-        return [dict(result) for result in self.collection.aggregate(pipeline)] or None
+    def rebuild_search_index(self) -> bool:
+        """
+        Recreates the `chat_terms` search index from the messages of every chat (documents and buckets),
+        e.g. on the first start with the index or if a write to the index failed.
+        """
+        try:
+            self.terms.delete_many({})
+            batch = []
+            for chat_id, chat, seq, message in self._all_messages():
+                batch.extend(_postings(chat_id, seq, chat['provider_id'], chat['client_id'],
+                                       message['message'], message['sender_id'], message['sent_at']))
+                if len(batch) >= SEARCH_INDEX_BATCH:
+                    self.terms.insert_many(batch, ordered=False)
+                    batch = []
+            if batch:
+                self.terms.insert_many(batch, ordered=False)
+            return True
+        except Exception as e:
+            logger.error(e)
+            return False
+
+    def _all_messages(self):
+        # (chat_id, chat or bucket, seq, message) of every message, in both storages
+        projection = {'_id': 0, 'uuid': 1, 'chat_id': 1, 'provider_id': 1, 'client_id': 1, 'messages': 1}
+        for chat in self.collection.find({'messages': {'$exists': True}}, projection):
+            for seq, message in enumerate(chat['messages']):
+                yield chat['uuid'], chat, seq, message
+        for bucket in self.buckets.find({}, projection):
+            for message in bucket['messages']:
+                yield bucket['chat_id'], bucket, message['seq'], message
 
     def get_chats(self, user_id: str, is_provider: bool) -> Dict:
         if is_provider:
@@ -199,13 +536,104 @@ class Chats:
                         {
                             "client_id": chat['client_id'],
                             "last_message_at": chat['last_message_at'],
-                            "last_message": chat['messages'][-1]['message']
-                        } for chat in self.collection.find({'provider_id': user_id})
+                            "last_message": _last_message(chat)
+                        } for chat in self.collection.find({'provider_id': user_id}, CHAT_LIST_PROJECTION)
                     ]}
         return {"providers": [
                     {
                         "provider_id": chat['provider_id'],
                         "last_message_at": chat['last_message_at'],
-                        "last_message": chat['messages'][-1]['message']
-                    } for chat in self.collection.find({'client_id': user_id})
-                ]}
\ No newline at end of file
+                        "last_message": _last_message(chat)
+                    } for chat in self.collection.find({'client_id': user_id}, CHAT_LIST_PROJECTION)
+                ]}
+
+    def migrate_to_buckets(self) -> int:
+        """
+        Moves the messages of every chat still stored as a single document into buckets and leaves its header.
+        Chats are migrated one at a time and a migration interrupted halfway can be run again.
+        Stop the API writes (or run it before switching CHATS_STORAGE) so no message lands in a migrated document.
+        Returns the number of migrated chats.
+        """
+        migrated = 0
+        for chat in self.collection.find({'messages': {'$exists': True}}):
+            messages = chat['messages']
+            self.buckets.delete_many({'chat_id': chat['uuid']})
+            buckets = [{
+                'chat_id': chat['uuid'],
+                'provider_id': chat['provider_id'],
+                'client_id': chat['client_id'],
+                'bucket': i // self.bucket_size,
+                'first_sent_at': min(message['sent_at'] for message in messages[i:i + self.bucket_size]),
+                'last_sent_at': max(message['sent_at'] for message in messages[i:i + self.bucket_size]),
+                'messages': [{**message, 'seq': i + j} for j, message in enumerate(messages[i:i + self.bucket_size])]
+            } for i in range(0, len(messages), self.bucket_size)]
+            if buckets:
+                self.buckets.insert_many(buckets)
+            header = {'message_count': len(messages)}
+            if messages:
+                header.update({'last_message': messages[-1]['message'], 'last_sender_id': messages[-1]['sender_id']})
+            self.collection.update_one({'_id': chat['_id']}, {'$set': header, '$unset': {'messages': ''}})
+            migrated += 1
+        logger.info(f"{migrated} chats migrated to message buckets")
+        return migrated
+
+
+def _terms(text: str) -> List[str]:
+    # distinct lowercase words of a message or a search
+    return list(dict.fromkeys(TERM_PATTERN.findall(text.lower())))
+
+def _postings(chat_id, seq, provider_id, client_id, message_content, message_sender_id, actual_time) -> List[Dict]:
+    # one search index document per word of the message, with every field the search filters on
+    return [{
+                'term': term,
+                'chat_id': chat_id,
+                'seq': seq,
+                'provider_id': provider_id,
+                'client_id': client_id,
+                'sender_id': message_sender_id,
+                'sent_at': actual_time
+            } for term in _terms(message_content)]
+
+def _range_match(field: str, operator: str, value: str, allow_missing: bool) -> Dict:
+    # buckets written before `first_sent_at`/`last_sent_at` are always read
+    if allow_missing:
+        return {'$or': [{field: {operator: value}}, {field: {'$exists': False}}]}
+    return {field: {operator: value}}
+
+def _date_match(msg_min_date: Optional[str], msg_max_date: Optional[str]) -> Dict:
+    match = {}
+    if msg_min_date:
+        match['$gte'] = msg_min_date
+    if msg_max_date:
+        match['$lte'] = msg_max_date
+    return match
+
+def _cursor_seq(cursor: str) -> int:
+    _, seq = decode_cursor(cursor, 2)
+    if not isinstance(seq, int) or seq < 0:
+        raise ValueError("Invalid cursor")
+    return seq
+
+def _search_cursor(result: Dict, order: List[Tuple[str, int]]) -> str:
+    return encode_cursor([_field(result, field) for field, _ in order])
+
+def _keyset_match(order: List[Tuple[str, int]], cursor: list, forward: bool) -> Dict:
+    # results after (or before) the cursor in `order`
+    alternatives = []
+    for i, (field, direction) in enumerate(order):
+        operator = '$gt' if (direction == ASCENDING) == forward else '$lt'
+        alternatives.append({**{previous: value for (previous, _), value in zip(order[:i], cursor)}, field: {operator: cursor[i]}})
+    return {'$or': alternatives}
+
+def _field(document: Dict, path: str):
+    for key in path.split('.'):
+        document = document[key]
+    return document
+
+def _without_seq(message: Dict) -> Dict:
+    return {key: value for key, value in message.items() if key != 'seq'}
+
+def _last_message(chat: Dict) -> str:
+    if 'last_message' in chat:
+        return chat['last_message']
+    return chat['messages'][-1]['message']
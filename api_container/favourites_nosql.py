@@ -1,17 +1,19 @@
 from typing import Optional, List, Dict, Tuple
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
-from pymongo import ASCENDING
+from pymongo import ASCENDING, DESCENDING
 from pymongo.errors import DuplicateKeyError, OperationFailure
 import logging as logger
 import os
 import sys
 import uuid
 from lib.utils import get_actual_time, get_mongo_client
+from lib.mongo_indexes import IndexSpec, ensure_indexes
 
 HOUR = 60 * 60
 MINUTE = 60
 MILLISECOND = 1_000
+RELATIONS_BATCH = 10_000
 
 # TODO: (General) -> Create tests for each method && add the required checks in each method
 
@@ -23,8 +25,35 @@ class Favourites:
     - client_id (str): The id of the client account
     - favourite_providers (Set[str]): The list of favourite providers
     - saved_folders (Dict[str, Set[str]]): The list of saved services in each folder
+    Saved services are also kept in the `saved_services` index collection, one document per (folder, service),
+    so `get_relations` is an indexed lookup instead of a scan of every folder. The folder mutators keep it
+    up to date and `rebuild_relations_index` recreates it from the favourites documents.
+    Listeners added with `subscribe` are called with (client_id, folder_name) after a folder's services change.
+    Top-k recommendations precomputed for every folder are kept in the `recommendations` collection (see
+    lib/recommendation_materializer.py), one document per folder with the folder `version`. A change of the
+    folder's services increments it and drops the recommendations, and a run only saves the ones of folders
+    still at the version it read, so a folder changed during a run is never served stale results.
     """
 
+    INDEXES = {
+        'favourites': [
+            IndexSpec([('uuid', ASCENDING)], unique=True),
+            # every method looks the client's document up
+            IndexSpec([('client_id', ASCENDING)])
+        ],
+        'saved_services': [
+            IndexSpec([('client_id', ASCENDING), ('folder_name', ASCENDING), ('service_id', ASCENDING)], unique=True),
+            IndexSpec([('service_id', ASCENDING)])
+        ],
+        'recommendations': [
+            IndexSpec([('client_id', ASCENDING), ('folder_name', ASCENDING)], unique=True),
+            IndexSpec([('run_id', ASCENDING)])
+        ],
+        'recommendation_runs': [
+            IndexSpec([('finished_at', DESCENDING)])
+        ]
+    }
+
     def __init__(self, test_client=None, test_db=None):
         self.client = test_client or get_mongo_client()
         if not self._check_connection():
@@ -34,6 +63,10 @@ class Favourites:
         else:
             self.db = self.client[test_db or os.getenv('MONGO_DB')]
         self.collection = self.db['favourites']
+        self.saved_services = self.db['saved_services']
+        self.recommendations = self.db['recommendations']
+        self.recommendation_runs = self.db['recommendation_runs']
+        self._listeners = []
         self._create_collection()
     
     def _check_connection(self):
@@ -44,8 +77,28 @@ class Favourites:
             return False
         return True
 
+    def subscribe(self, listener):
+        self._listeners.append(listener)
+
+    def _folder_changed(self, client_id: str, folder_name: str):
+        try:
+            self.recommendations.update_one({'client_id': client_id, 'folder_name': folder_name}, {
+                '$inc': {'version': 1},
+                '$unset': {'recommendations': '', 'run_id': '', 'computed_at': ''}
+            }, upsert=True)
+        except Exception as e:
+            logger.error(e)
+        for listener in self._listeners:
+            try:
+                listener(client_id, folder_name)
+            except Exception as e:
+                logger.error(e)
+
     def _create_collection(self):
-        self.collection.create_index([('uuid', ASCENDING)], unique=True)
+        ensure_indexes(self.db, self.INDEXES)
+        if self.saved_services.estimated_document_count() == 0 and self.collection.estimated_document_count() > 0:
+            # first start with the index
+            self.rebuild_relations_index()
     
     def _is_favourite_provider(self, client_id: str, provider_id: str) -> bool:
         return self.collection.find_one({'client_id': client_id, 'favourite_providers': {'$in': [provider_id]}}) is not None
@@ -119,6 +172,8 @@ class Favourites:
             return False
         try:
             self.collection.update_one({'client_id': client_id}, {'$unset': {f'saved_folders.{folder_name}': ''}})
+            self.saved_services.delete_many({'client_id': client_id, 'folder_name': folder_name})
+            self._folder_changed(client_id, folder_name)
             return True
         except Exception as e:
             logger.error(e)
@@ -138,6 +193,9 @@ class Favourites:
                 return False
         try:
             self.collection.update_one({'client_id': client_id}, {'$addToSet': {f'saved_folders.{folder_name}': service_id}})
+            relation = {'client_id': client_id, 'folder_name': folder_name, 'service_id': service_id}
+            self.saved_services.update_one(relation, {'$setOnInsert': relation}, upsert=True)
+            self._folder_changed(client_id, folder_name)
             return True
         except Exception as e:
             logger.error(e)
@@ -150,6 +208,8 @@ class Favourites:
             return False
         try:
             self.collection.update_one({'client_id': client_id}, {'$pull': {f'saved_folders.{folder_name}': service_id}})
+            self.saved_services.delete_one({'client_id': client_id, 'folder_name': folder_name, 'service_id': service_id})
+            self._folder_changed(client_id, folder_name)
             return True
         except Exception as e:
             logger.error(e)
@@ -161,35 +221,105 @@ class Favourites:
             return None
         return data.get('saved_folders', {}).get(folder_name, [])
     
+    def get_folders(self, client_id: str) -> Optional[Dict[str, List[str]]]:
+        # {folder_name: services} of every folder of the client in a single read
+        data = self.collection.find_one({'client_id': client_id}, {'_id': 0, 'saved_folders': 1})
+        if not data:
+            return None
+        return data.get('saved_folders', {})
+
     def get_relations(self, available_services: List[str]) -> Optional[Dict[str, List[str]]]:
+        # {f"{client_id}_{folder_name}": saved services among `available_services`} of the folders with any of them
         try:
-            pipeline = [
-                {'$project': {
-                    'client_id': 1,
-                    'saved_folders': {'$objectToArray': '$saved_folders'}
-                }},
-                {'$unwind': '$saved_folders'},
-                {'$match': {
-                    'saved_folders.v': {'$in': available_services}
-                }},
-                {'$project': {
-                    'client_id': 1,
-                    'folder_name': '$saved_folders.k',
-                    'services': {
-                        '$filter': {
-                            'input': '$saved_folders.v',
-                            'as': 'service',
-                            'cond': {'$in': ['$$service', available_services]}
-                        }
-                    }
-                }}
-            ]
-            data = list(self.collection.aggregate(pipeline))
+            cursor = self.saved_services.find({'service_id': {'$in': available_services}},
+                                              {'_id': 0, 'client_id': 1, 'folder_name': 1, 'service_id': 1})
             relations = {}
-            for record in data:
+            for record in cursor:
                 complete_name = f"{record['client_id']}_{record['folder_name']}"
-                relations[complete_name] = record['services']
+                relations.setdefault(complete_name, []).append(record['service_id'])
             return relations
         except Exception as e:
             logger.error(e)
             return None
+
+    def rebuild_relations_index(self) -> bool:
+        """
+        Recreates the `saved_services` index from the saved folders of every client,
+        e.g. after restoring the favourites collection or if a write to the index failed.
+        """
+        try:
+            self.saved_services.delete_many({})
+            batch = []
+            for record in self.collection.find({}, {'_id': 0, 'client_id': 1, 'saved_folders': 1}):
+                for folder_name, services in record.get('saved_folders', {}).items():
+                    batch.extend({'client_id': record['client_id'], 'folder_name': folder_name, 'service_id': service_id}
+                                 for service_id in set(services))
+                if len(batch) >= RELATIONS_BATCH:
+                    self.saved_services.insert_many(batch, ordered=False)
+                    batch = []
+            if batch:
+                self.saved_services.insert_many(batch, ordered=False)
+            return True
+        except Exception as e:
+            logger.error(e)
+            return False
+
+    def get_all_relations(self) -> List[Tuple[str, str, str]]:
+        # (client_id, folder_name, service_id) of every saved service
+        cursor = self.saved_services.find({}, {'_id': 0, 'client_id': 1, 'folder_name': 1, 'service_id': 1})
+        return [(record['client_id'], record['folder_name'], record['service_id']) for record in cursor]
+
+    def get_folder_versions(self) -> Dict[Tuple[str, str], int]:
+        # {(client_id, folder_name): version} of the folders that changed, the others are at version 0.
+        # A run reads them before the relations, so a change in between makes its save fail instead of going unseen
+        cursor = self.recommendations.find({}, {'_id': 0, 'client_id': 1, 'folder_name': 1, 'version': 1})
+        return {(record['client_id'], record['folder_name']): record.get('version', 0) for record in cursor}
+
+    def save_recommendations(self, run_id: str, recommendations: List[Tuple[str, str, Dict[str, float]]],
+                             versions: Optional[Dict[Tuple[str, str], int]] = None) -> bool:
+        # [(client_id, folder_name, {service_id: score})] computed by the materialization run `run_id` from the folders
+        # at `versions` (see get_folder_versions), the ones of folders changed since are skipped
+        versions = versions or {}
+        try:
+            computed_at = get_actual_time()
+            skipped = 0
+            for client_id, folder_name, services in recommendations:
+                try:
+                    self.recommendations.update_one(
+                        {'client_id': client_id, 'folder_name': folder_name, 'version': versions.get((client_id, folder_name), 0)},
+                        {'$set': {
+                            'run_id': run_id,
+                            'computed_at': computed_at,
+                            'recommendations': [{'service_id': service_id, 'score': score} for service_id, score in services.items()]
+                        }}, upsert=True)
+                except DuplicateKeyError:
+                    # the folder is at another version
+                    skipped += 1
+            if skipped:
+                logger.info(f"Recommendations of {skipped} folders changed during the run {run_id} were not saved")
+            return True
+        except Exception as e:
+            logger.error(e)
+            return False
+
+    def finish_recommendations_run(self, run_id: str, folders: int) -> bool:
+        # drops what earlier runs materialized for folders that are gone and records the run
+        try:
+            self.recommendations.update_many({'run_id': {'$exists': True, '$ne': run_id}},
+                                             {'$unset': {'recommendations': '', 'run_id': '', 'computed_at': ''}})
+            self.recommendation_runs.insert_one({'run_id': run_id, 'finished_at': get_actual_time(), 'folders': folders})
+            return True
+        except Exception as e:
+            logger.error(e)
+            return False
+
+    def get_last_recommendations_run(self) -> Optional[dict]:
+        return self.recommendation_runs.find_one({}, {'_id': 0}, sort=[('finished_at', DESCENDING)])
+
+    def get_materialized_recommendations(self, client_id: str, folder_name: str) -> Optional[Dict[str, float]]:
+        # {service_id: score} sorted by score, None when the folder was not materialized (new or changed since)
+        data = self.recommendations.find_one({'client_id': client_id, 'folder_name': folder_name, 'recommendations': {'$exists': True}},
+                                             {'_id': 0, 'recommendations': 1})
+        if not data:
+            return None
+        return {item['service_id']: item['score'] for item in data['recommendations']}
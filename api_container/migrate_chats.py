@@ -0,0 +1,17 @@
+import logging as logger
+import sys
+from dotenv import load_dotenv
+
+from chats_nosql import Chats
+
+# Moves every chat stored as a single document to message buckets, before setting CHATS_STORAGE=buckets.
+# Run with the following command (from api_container):
+# python migrate_chats.py
+
+def main():
+    logger.basicConfig(format='%(levelname)s: %(asctime)s - %(message)s', stream=sys.stdout, level=logger.INFO)
+    load_dotenv()
+    Chats(storage="buckets").migrate_to_buckets()
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,7 @@ import sys
 import uuid
 from firebase_admin import messaging
 from lib.utils import get_actual_time, get_mongo_client
+from lib.mongo_indexes import IndexSpec, ensure_indexes
 
 HOUR = 60 * 60
 MINUTE = 60
@@ -26,6 +27,16 @@ class MobileToken:
     - updated_at: int: The timestamp of the last update of the mobile token
     """
 
+    # the tokens share the 'chats' collection, so the unique user_id must ignore the chat documents (no user_id)
+    INDEXES = {
+        'chats': [
+            IndexSpec([('user_id', ASCENDING)], unique=True, partial={'user_id': {'$exists': True}})
+        ],
+        'notifications': [
+            IndexSpec([('user_id', ASCENDING)], unique=True)
+        ]
+    }
+
     def __init__(self, test_client=None, test_db=None):
         self.client = test_client or get_mongo_client()
         if not self._check_connection():
@@ -47,11 +58,7 @@ class MobileToken:
         return True
 
     def _create_collection(self):
-        try:
-            self.collection.create_index([('user_id', ASCENDING)], unique=True)
-            self.notifications.create_index([('user_id', ASCENDING)], unique=True)
-        except DuplicateKeyError:
-            logger.warning("Index on 'user_id' already exists.")
+        ensure_indexes(self.db, self.INDEXES)
             
     def _get_user_notifications(self, user_id: str) -> Optional[Dict]:
         notifications = self.notifications.find_one({'user_id': user_id})
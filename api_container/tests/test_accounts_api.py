@@ -22,7 +22,7 @@ os.environ['MONGO_TEST_DB'] = 'test_db'
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
 
-from accounts_api import app, accounts_manager, firebase_manager, chats_manager, favourites_manager
+from accounts_api import app, accounts_manager, firebase_manager, chats_manager, favourites_manager, recommendation_cache
 
 # client = TestClient(app)
 
@@ -39,14 +39,24 @@ def setup_teardown():
     metadata.drop_all(bind=accounts_manager.engine)
     accounts_manager.create_table()
     chats_manager.collection.drop()
+    chats_manager.buckets.drop()
+    chats_manager.terms.drop()
     favourites_manager.collection.drop()
+    favourites_manager.saved_services.drop()
+    favourites_manager.recommendations.drop()
+    recommendation_cache.clear()
     yield
     # Teardown code: runs after each test
     metadata.reflect(bind=accounts_manager.engine)
     metadata.drop_all(bind=accounts_manager.engine)
     accounts_manager.create_table()
     chats_manager.collection.drop()
+    chats_manager.buckets.drop()
+    chats_manager.terms.drop()
     favourites_manager.collection.drop()
+    favourites_manager.saved_services.drop()
+    favourites_manager.recommendations.drop()
+    recommendation_cache.clear()
 
 def test_get_account(test_app, mocker):
     # Mock the database response
@@ -402,3 +412,20 @@ def test_get_folder(test_app, mocker):
     assert services[0] == "service123"
 
 
+
+def test_get_client_recommendations_reports_missing_folders(test_app, mocker):
+    accounts_manager.insert("clientuser", "uid_client", "Client User", "client@example.com", None, False, None, "2000-01-01")
+    favourites_manager.add_folder("uid_client", "cached_folder")
+    favourites_manager.add_folder("uid_client", "new_folder")
+    location = {"longitude": 1.0, "latitude": 2.0}
+    recommendation_cache.put(recommendation_cache.key("uid_client", "cached_folder", location), {"service1": 0.5})
+    mocker.patch("accounts_api.services_lib.get_available_services", return_value=[])
+
+    response = test_app.get("/folders/uid_client/recommendations", params={"client_location": "1.0,2.0"})
+    assert response.status_code == 200
+    assert response.json()["recommendations"] == {"cached_folder": {"service1": 0.5}}
+    assert response.json()["missing"] == {"new_folder": "No available services in the area"}
+
+    recommendation_cache.clear()
+    response = test_app.get("/folders/uid_client/recommendations", params={"client_location": "1.0,2.0"})
+    assert response.status_code == 404
@@ -1,12 +1,14 @@
 import pytest
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateTable
 from sqlalchemy.orm import sessionmaker
 import os
 import sys
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
-from accounts_sql import Accounts
+from accounts_sql import Accounts, REV2_SNAPSHOTS_KEPT
 
 # Run with the following command:
 # pytest AccountsService/api_container/tests/test_accounts_sql.py
@@ -142,3 +144,136 @@ def test_rev2_results_saver(accounts):
     account2 = accounts.get("5678")
     assert account1['reviewer_score'] == 0.8
     assert account2['reviewer_score'] == 0.9
+
+
+def test_rev2_results_saver_only_updates_changed_scores(accounts):
+    for i in range(3):
+        accounts.insert(
+            username=f"testuser{i}",
+            uuid=f"uuid{i}",
+            complete_name=f"Test User {i}",
+            email=f"testuser{i}@example.com",
+            profile_picture=None,
+            is_provider=False,
+            description="Test description",
+            birth_date="2000-01-01"
+        )
+    assert accounts.rev2_results_saver({"uuid0": 0.5, "uuid1": 0.7, "missing": 0.1}) == 2
+    assert accounts.rev2_results_saver({"uuid0": 0.5, "uuid1": 0.6, "uuid2": 0.9}) == 2
+    assert accounts.rev2_results_saver({"uuid0": 0.5, "uuid1": 0.6, "uuid2": 0.9}) == 0
+    assert accounts.rev2_results_saver({}) == 0
+    assert accounts.get_reviewer_scores(["uuid0", "uuid1", "uuid2", "missing"]) == {"uuid0": 0.5, "uuid1": 0.6, "uuid2": 0.9}
+
+def test_rev2_results_saver_postgres_statement(accounts):
+    staging = accounts._reviewer_scores_staging_table()
+    create = str(CreateTable(staging).compile(dialect=postgresql.dialect()))
+    assert "CREATE TEMPORARY TABLE rev2_reviewer_scores_staging" in create
+    assert "ON COMMIT DROP" in create
+    update = str(accounts._reviewer_scores_update_from(staging).compile(dialect=postgresql.dialect()))
+    assert "FROM rev2_reviewer_scores_staging" in update
+    assert "IS DISTINCT FROM" in update
+
+def test_get_reviewer_scores(accounts):
+    accounts.insert(
+        username="testuser1",
+        uuid="1234",
+        complete_name="Test User 1",
+        email="testuser1@example.com",
+        profile_picture=None,
+        is_provider=False,
+        description="Test description 1",
+        birth_date="2000-01-01"
+    )
+    accounts.insert(
+        username="testuser2",
+        uuid="5678",
+        complete_name="Test User 2",
+        email="testuser2@example.com",
+        profile_picture=None,
+        is_provider=False,
+        description="Test description 2",
+        birth_date="2000-02-02"
+    )
+    accounts.rev2_results_saver({"1234": 0.8})
+    scores = accounts.get_reviewer_scores(["1234", "5678", "9999"])
+    assert scores == {"1234": 0.8}
+
+@pytest.fixture(scope='function')
+def snapshot_accounts():
+    engine = create_engine('sqlite:///:memory:')
+    accounts = Accounts(engine=engine)
+    for i, is_provider in enumerate([False, False, False, True]):
+        accounts.insert(
+            username=f"snapshotuser{i}",
+            uuid=f"uuid{i}",
+            complete_name=f"Snapshot User {i}",
+            email=f"snapshotuser{i}@example.com",
+            profile_picture=None,
+            is_provider=is_provider,
+            description="Test description",
+            birth_date="2000-01-01"
+        )
+    yield accounts
+    engine.dispose()
+
+def test_reviewer_scores_fall_back_to_accounts_without_snapshots(snapshot_accounts):
+    snapshot_accounts.rev2_results_saver({"uuid0": 0.4, "uuid1": 0.2})
+    assert snapshot_accounts.get_all_reviewer_scores(10) == [{"uuid": "uuid1", "reviewer_score": 0.2}, {"uuid": "uuid0", "reviewer_score": 0.4}]
+    assert snapshot_accounts.reviewer_scores_stats()["count"] == 2
+
+def test_save_rev2_snapshot_publishes_new_scores(snapshot_accounts):
+    first = snapshot_accounts.save_rev2_snapshot({"uuid0": 0.9, "uuid1": 0.1, "uuid3": 0.5})
+    second = snapshot_accounts.save_rev2_snapshot({"uuid0": 0.3, "uuid2": 0.6})
+    assert second > first
+    # providers are left out, like in the accounts column
+    assert snapshot_accounts.get_all_reviewer_scores(10) == [{"uuid": "uuid0", "reviewer_score": 0.3}, {"uuid": "uuid2", "reviewer_score": 0.6}]
+    assert snapshot_accounts.get_all_reviewer_scores(10, first) == [{"uuid": "uuid1", "reviewer_score": 0.1}, {"uuid": "uuid0", "reviewer_score": 0.9}]
+    stats = snapshot_accounts.reviewer_scores_stats()
+    assert stats["count"] == 2
+    assert stats["max"] == 0.6
+    assert [(s["id"], s["active"]) for s in snapshot_accounts.get_rev2_snapshots()] == [(second, True), (first, False)]
+
+def test_published_snapshot_is_authoritative(snapshot_accounts, mocker):
+    snapshot_accounts.rev2_results_saver({"uuid0": 0.4})
+    mocker.patch('accounts_sql.get_actual_time', side_effect=["2024-05-01 03:00:00", "2024-05-01 03:20:00"])
+    snapshot_accounts.save_rev2_snapshot({"uuid0": 0.9, "uuid1": 0.1})
+    snapshot = snapshot_accounts.get_rev2_snapshots()[0]
+    # the scheduler reads when the run ended, not when the snapshot was started
+    assert (snapshot["created_at"], snapshot["published_at"]) == ("2024-05-01 03:00:00", "2024-05-01 03:20:00")
+    assert snapshot_accounts.get_reviewer_scores(["uuid0", "uuid1", "uuid2"]) == {"uuid0": 0.9, "uuid1": 0.1}
+
+def test_old_rev2_snapshots_are_pruned(snapshot_accounts):
+    ids = [snapshot_accounts.save_rev2_snapshot({"uuid0": i / 10}) for i in range(5)]
+    kept = [snapshot["id"] for snapshot in snapshot_accounts.get_rev2_snapshots()]
+    assert kept == ids[::-1][:REV2_SNAPSHOTS_KEPT]
+    assert snapshot_accounts.get_all_reviewer_scores(10, ids[0]) == []
+    assert snapshot_accounts.reviewer_scores_stats(ids[0])["count"] == 0
+    tables = inspect(snapshot_accounts.engine).get_table_names()
+    assert f"rev2_scores_{ids[0]}" not in tables
+    assert f"rev2_scores_{ids[-1]}" in tables
+
+def test_snapshot_summary_is_precomputed(snapshot_accounts):
+    snapshot_accounts.save_rev2_snapshot({"uuid0": 0.1, "uuid1": 0.5, "uuid2": 0.95, "uuid3": 0.7})
+    stats = snapshot_accounts.reviewer_scores_stats()
+    assert stats["count"] == 3
+    assert stats["min"] == 0.1 and stats["max"] == 0.95
+    assert stats["percentiles"]["50"] == 0.5
+    assert stats["histogram"]["counts"][2] == 1 and stats["histogram"]["counts"][19] == 1
+    assert sum(stats["histogram"]["counts"]) == 3
+
+def test_reviewer_scores_pages(snapshot_accounts):
+    snapshot_accounts.save_rev2_snapshot({"uuid0": 0.5, "uuid1": 0.5, "uuid2": 0.2, "uuid3": 0.1})
+    first, cursor = snapshot_accounts.get_reviewer_scores_page(2)
+    assert [row["uuid"] for row in first] == ["uuid2", "uuid0"]
+    second, cursor = snapshot_accounts.get_reviewer_scores_page(2, after=cursor)
+    assert [row["uuid"] for row in second] == ["uuid1"]
+    assert cursor is None
+    top, cursor = snapshot_accounts.get_reviewer_scores_page(1, descending=True)
+    assert [row["uuid"] for row in top] == ["uuid1"]
+    rest, _ = snapshot_accounts.get_reviewer_scores_page(5, after=cursor, descending=True)
+    assert [row["uuid"] for row in rest] == ["uuid0", "uuid2"]
+
+def test_invalid_reviewer_scores_cursor(snapshot_accounts):
+    snapshot_accounts.save_rev2_snapshot({"uuid0": 0.5})
+    with pytest.raises(ValueError):
+        snapshot_accounts.get_reviewer_scores_page(2, after="not a cursor")
@@ -26,9 +26,10 @@ def mongo_client():
     client.drop_database(os.getenv('MONGO_TEST_DB'))
     client.close()
 
-@pytest.fixture(scope='function')
-def chats(mongo_client):
-    return Chats(test_client=mongo_client)
+@pytest.fixture(scope='function', params=["document", "buckets"])
+def chats(mongo_client, request):
+    # small buckets so the tests cross bucket boundaries
+    return Chats(test_client=mongo_client, storage=request.param, bucket_size=2)
 
 def test_insert_message(chats, mocker):
     mocker.patch('chats_nosql.get_actual_time', return_value="2023-01-01 00:00:00")
@@ -170,4 +171,188 @@ def test_search_multiple_messages(chats, mocker):
     assert results is not None
     assert len(results) == 2
     assert 'Hello, this is a test message.' in [result['message'] for result in results]
-    assert 'Another test message.' in [result['message'] for result in results]
\ No newline at end of file
+    assert 'Another test message.' in [result['message'] for result in results]
+
+def _insert_messages(chats, mocker, count, client_id='client_1'):
+    for i in range(count):
+        mocker.patch('chats_nosql.get_actual_time', return_value=f"2023-01-01 00:00:{i:02d}")
+        chats.insert_message(provider_id='provider_1', client_id=client_id,
+                             message_content=f'Message {i}', message_sender_id='provider_1' if i % 2 else client_id)
+
+def test_get_messages_pages(chats, mocker):
+    _insert_messages(chats, mocker, 7)
+    messages = chats.get_messages(provider_id='provider_1', client_id='client_1', limit=3, offset=2)
+    assert [message['message'] for message in messages] == ['Message 2', 'Message 3', 'Message 4']
+    assert messages[0] == {'sender_id': 'client_1', 'message': 'Message 2', 'sent_at': '2023-01-01 00:00:02'}
+    messages = chats.get_messages(provider_id='provider_1', client_id='client_1', limit=10, offset=5)
+    assert [message['message'] for message in messages] == ['Message 5', 'Message 6']
+    assert chats.get_messages(provider_id='provider_1', client_id='client_1', limit=10, offset=7) is None
+    assert chats.count_messages(provider_id='provider_1', client_id='client_1') == 7
+
+def test_search_filters(chats, mocker):
+    _insert_messages(chats, mocker, 5)
+    _insert_messages(chats, mocker, 2, client_id='client_2')
+    results = chats.search(limit=10, offset=0, provider_id='provider_1', sender_id='provider_1')
+    assert sorted(result['message'] for result in results) == ['Message 1', 'Message 1', 'Message 3']
+    results = chats.search(limit=10, offset=0, client_id='client_1', msg_min_date='2023-01-01 00:00:03')
+    assert sorted(result['message'] for result in results) == ['Message 3', 'Message 4']
+    assert all(result['chat_info']['client_id'] == 'client_1' for result in results)
+    assert all('seq' not in result for result in results)
+
+def test_get_chats(chats, mocker):
+    _insert_messages(chats, mocker, 3)
+    _insert_messages(chats, mocker, 1, client_id='client_2')
+    clients = chats.get_chats('provider_1', True)["clients"]
+    assert sorted((chat['client_id'], chat['last_message']) for chat in clients) == [('client_1', 'Message 2'), ('client_2', 'Message 0')]
+    providers = chats.get_chats('client_1', False)["providers"]
+    assert providers == [{"provider_id": 'provider_1', "last_message_at": '2023-01-01 00:00:02', "last_message": 'Message 2'}]
+
+def test_migrate_to_buckets(mongo_client, mocker):
+    documents = Chats(test_client=mongo_client, storage="document")
+    _insert_messages(documents, mocker, 5)
+    _insert_messages(documents, mocker, 1, client_id='client_2')
+    expected = documents.get_messages(provider_id='provider_1', client_id='client_1', limit=10, offset=0)
+    buckets = Chats(test_client=mongo_client, storage="buckets", bucket_size=2)
+    assert buckets.migrate_to_buckets() == 2
+    assert buckets.migrate_to_buckets() == 0
+    assert buckets.get_messages(provider_id='provider_1', client_id='client_1', limit=10, offset=0) == expected
+    assert buckets.count_messages(provider_id='provider_1', client_id='client_1') == 5
+    _insert_messages(buckets, mocker, 1)
+    assert buckets.count_messages(provider_id='provider_1', client_id='client_1') == 6
+    assert buckets.get_messages(provider_id='provider_1', client_id='client_1', limit=1, offset=5)[0]['message'] == 'Message 0'
+
+def test_unknown_storage(mongo_client):
+    with pytest.raises(ValueError):
+        Chats(test_client=mongo_client, storage="files")
+
+def test_get_chat(chats, mocker):
+    _insert_messages(chats, mocker, 3)
+    chat = chats.get_chat(provider_id='provider_1', client_id='client_1', limit=2, offset=0)
+    assert [message['message'] for message in chat['messages']] == ['Message 0', 'Message 1']
+    assert chat['total_messages'] == 3
+    assert chat['previous'] is None
+    assert chats.get_chat(provider_id='provider_1', client_id='client_2', limit=2, offset=0) is None
+
+def test_get_chat_cursors(chats, mocker):
+    _insert_messages(chats, mocker, 7)
+    pages, chat = [], chats.get_chat(provider_id='provider_1', client_id='client_1', limit=3)
+    while chat is not None:
+        pages.append([message['message'] for message in chat['messages']])
+        chat = chats.get_chat(provider_id='provider_1', client_id='client_1', limit=3, after=chat['next']) if chat['next'] else None
+    assert pages == [['Message 0', 'Message 1', 'Message 2'], ['Message 3', 'Message 4', 'Message 5'], ['Message 6']]
+
+    last = chats.get_chat(provider_id='provider_1', client_id='client_1', limit=3, offset=5)
+    assert last['next'] is None
+    previous = chats.get_chat(provider_id='provider_1', client_id='client_1', limit=3, before=last['previous'])
+    assert [message['message'] for message in previous['messages']] == ['Message 2', 'Message 3', 'Message 4']
+    first = chats.get_chat(provider_id='provider_1', client_id='client_1', limit=3, before=previous['previous'])
+    assert [message['message'] for message in first['messages']] == ['Message 0', 'Message 1']
+    assert first['previous'] is None and first['next'] is not None
+
+    with pytest.raises(ValueError):
+        chats.get_chat(provider_id='provider_1', client_id='client_1', limit=3, after='not a cursor')
+
+def test_search_cursors(chats, mocker):
+    _insert_messages(chats, mocker, 3)
+    _insert_messages(chats, mocker, 3, client_id='client_2')
+    expected = [(f'2023-01-01 00:00:0{i}', client_id) for i in range(3) for client_id in sorted(['client_1', 'client_2'],
+                key=lambda client_id: chats._chat_header('provider_1', client_id)['uuid'])]
+    results, page = [], chats.search_page(limit=4, provider_id='provider_1')
+    assert page['previous'] is None
+    while page is not None:
+        results.extend((message['sent_at'], message['chat_info']['client_id']) for message in page['messages'])
+        page = chats.search_page(limit=4, provider_id='provider_1', after=page['next']) if page['next'] else None
+    assert results == expected
+
+    last = chats.search_page(limit=4, offset=4, provider_id='provider_1')
+    assert last['next'] is None
+    previous = chats.search_page(limit=4, provider_id='provider_1', before=last['previous'])
+    assert [(message['sent_at'], message['chat_info']['client_id']) for message in previous['messages']] == expected[:4]
+    assert previous['previous'] is None and previous['next'] is not None
+    assert all('seq' not in message for message in previous['messages'])
+
+    with pytest.raises(ValueError):
+        chats.search_page(limit=4, provider_id='provider_1', after='not a cursor')
+
+def test_chats_written_before_the_counters(chats, mocker):
+    mocker.patch('chats_nosql.get_actual_time', return_value="2023-01-01 00:00:00")
+    chats.collection.insert_one({'uuid': 'old_chat', 'provider_id': 'provider_1', 'client_id': 'client_1',
+                                 'messages': [{'sender_id': 'client_1', 'message': 'Old message', 'sent_at': '2022-01-01 00:00:00'}],
+                                 'created_at': '2022-01-01 00:00:00', 'last_message_at': '2022-01-01 00:00:00'})
+    if chats.storage == "buckets":
+        chats.migrate_to_buckets()
+    assert chats.count_messages(provider_id='provider_1', client_id='client_1') == 1
+    assert chats.get_chats('client_1', False)["providers"][0]["last_message"] == 'Old message'
+    chats.insert_message(provider_id='provider_1', client_id='client_1', message_content='New message', message_sender_id='provider_1')
+    assert chats.count_messages(provider_id='provider_1', client_id='client_1') == 2
+    header = chats.collection.find_one({'uuid': 'old_chat'})
+    assert (header['message_count'], header['last_message'], header['last_sender_id']) == (2, 'New message', 'provider_1')
+
+def _insert_texts(chats, mocker, texts, client_id='client_1'):
+    for i, text in enumerate(texts):
+        mocker.patch('chats_nosql.get_actual_time', return_value=f"2023-01-01 00:00:{i:02d}")
+        chats.insert_message(provider_id='provider_1', client_id=client_id, message_content=text,
+                             message_sender_id='provider_1' if i % 2 else client_id)
+
+def test_search_keywords_ranking(chats, mocker):
+    _insert_texts(chats, mocker, ['Is the plumber free tomorrow?', 'Nothing to see', 'The plumbing is fixed, thanks',
+                                  'Tomorrow works, plumber on the way'])
+    results = chats.search(limit=10, offset=0, provider_id='provider_1', keywords=['plumb', 'TOMORROW'])
+    assert [result['message'] for result in results] == ['Is the plumber free tomorrow?', 'Tomorrow works, plumber on the way',
+                                                         'The plumbing is fixed, thanks']
+    assert results[0] == {'sender_id': 'client_1', 'message': 'Is the plumber free tomorrow?', 'sent_at': '2023-01-01 00:00:00',
+                          'chat_info': {'id': chats._chat_exists('provider_1', 'client_1'), 'provider_id': 'provider_1',
+                                        'client_id': 'client_1'}}
+    results = chats.search(limit=10, offset=0, sender_id='provider_1', msg_max_date='2023-01-01 00:00:02', keywords=['plumber'])
+    assert results is None
+    assert chats.search(limit=10, offset=0, client_id='client_2', keywords=['plumber']) is None
+
+def test_search_keyword_counts_once_per_message(chats, mocker):
+    # 'car' prefixes both words of the first message, which still matches a single keyword
+    _insert_texts(chats, mocker, ['Cart or cartoon', 'Car wash'])
+    results = chats.search(limit=10, offset=0, keywords=['car', 'wash'])
+    assert [result['message'] for result in results] == ['Car wash', 'Cart or cartoon']
+
+def test_search_keywords_cursors(chats, mocker):
+    _insert_texts(chats, mocker, [f'Invoice {i}' + (' paid' if i % 3 == 0 else '') for i in range(7)])
+    expected = [result['message'] for result in chats.search(limit=10, offset=0, keywords=['invoice', 'paid'])]
+    assert expected[:3] == ['Invoice 0 paid', 'Invoice 3 paid', 'Invoice 6 paid']
+    messages, page = [], chats.search_page(limit=3, keywords=['invoice', 'paid'])
+    while page is not None:
+        messages.extend(result['message'] for result in page['messages'])
+        page = chats.search_page(limit=3, keywords=['invoice', 'paid'], after=page['next']) if page['next'] else None
+    assert messages == expected
+    last = chats.search_page(limit=3, offset=4, keywords=['invoice', 'paid'])
+    previous = chats.search_page(limit=3, keywords=['invoice', 'paid'], before=last['previous'])
+    assert [result['message'] for result in previous['messages']] == expected[1:4]
+
+def test_search_keywords_without_index(mongo_client, mocker):
+    chats = Chats(test_client=mongo_client, search_index=False)
+    _insert_texts(chats, mocker, ['Hello there', 'Goodbye'])
+    assert chats.terms.count_documents({}) == 0
+    assert [result['message'] for result in chats.search(limit=10, offset=0, keywords=['hello'])] == ['Hello there']
+
+def test_rebuild_search_index(chats, mocker):
+    _insert_texts(chats, mocker, ['Hello there', 'Hello again, hello', 'Goodbye'])
+    postings = sorted((posting['term'], posting['seq']) for posting in chats.terms.find())
+    assert postings == [('again', 1), ('goodbye', 2), ('hello', 0), ('hello', 1), ('there', 0)]
+    assert chats.rebuild_search_index()
+    assert sorted((posting['term'], posting['seq']) for posting in chats.terms.find()) == postings
+    chats.delete(chats._chat_exists('provider_1', 'client_1'))
+    assert chats.terms.count_documents({}) == 0
+
+def test_search_cursor_bounds_the_chats_before_unwinding(chats, mocker):
+    _insert_messages(chats, mocker, 5)
+    _insert_messages(chats, mocker, 2, client_id='client_2')
+    collection = chats.buckets if chats.storage == "buckets" else chats.collection
+    aggregate = mocker.spy(collection, 'aggregate')
+    first = chats.search_page(limit=3, provider_id='provider_1')
+    page = chats.search_page(limit=3, provider_id='provider_1', after=first['next'])
+    assert [message['sent_at'] for message in page['messages']] == ['2023-01-01 00:00:01', '2023-01-01 00:00:02', '2023-01-01 00:00:03']
+    pipeline = aggregate.call_args.args[0]
+    stages = [next(iter(stage)) for stage in pipeline]
+    assert stages[0] == '$match' and stages.index('$match') < stages.index('$unwind')
+    bound = '2023-01-01 00:00:01'
+    assert bound in str(pipeline[0]['$match'])
+    assert stages[stages.index('$sort') + 1] == '$limit'
+    assert pipeline[stages.index('$sort') + 1]['$limit'] == 4
@@ -217,4 +217,49 @@ def test_get_relations(favourites, mocker):
     assert len(relations['client_1_folder_1']) == 3
     assert len(relations['client_1_folder_2']) == 2
     assert len(relations['client_2_folder_2']) == 1
-    assert all(value in available_services for value in all_values)
\ No newline at end of file
+    assert all(value in available_services for value in all_values)
+
+
+def test_relations_index_follows_folder_changes(favourites, mocker):
+    favourites.add_folder(client_id='client_1', folder_name='folder_1')
+    favourites.add_service_to_folder(client_id='client_1', folder_name='folder_1', service_id='service_1')
+    favourites.add_service_to_folder(client_id='client_1', folder_name='folder_1', service_id='service_1')
+    favourites.add_service_to_folder(client_id='client_1', folder_name='folder_1', service_id='service_2')
+    favourites.add_folder(client_id='client_1', folder_name='folder_2')
+    favourites.add_service_to_folder(client_id='client_1', folder_name='folder_2', service_id='service_2')
+    assert favourites.get_relations(['service_1', 'service_2']) == {
+        'client_1_folder_1': ['service_1', 'service_2'], 'client_1_folder_2': ['service_2']}
+
+    favourites.remove_service_from_folder(client_id='client_1', folder_name='folder_1', service_id='service_2')
+    favourites.remove_folder(client_id='client_1', folder_name='folder_2')
+    assert favourites.get_relations(['service_1', 'service_2']) == {'client_1_folder_1': ['service_1']}
+
+def test_rebuild_relations_index(favourites, mocker):
+    favourites.add_folder(client_id='client_1', folder_name='folder_1')
+    favourites.add_service_to_folder(client_id='client_1', folder_name='folder_1', service_id='service_1')
+    favourites.add_folder(client_id='client_2', folder_name='folder_1')
+    favourites.add_service_to_folder(client_id='client_2', folder_name='folder_1', service_id='service_1')
+    expected = favourites.get_relations(['service_1'])
+    favourites.saved_services.delete_many({'client_id': 'client_2'})
+    assert favourites.rebuild_relations_index()
+    assert favourites.get_relations(['service_1']) == expected
+    # a new manager on an existing favourites collection builds the missing index
+    favourites.saved_services.drop()
+    assert Favourites(test_client=favourites.client).get_relations(['service_1']) == expected
+
+def test_folder_changes_notify_listeners(favourites, mocker):
+    changes = []
+    favourites.subscribe(lambda client_id, folder_name: changes.append((client_id, folder_name)))
+    favourites.add_folder(client_id='client_1', folder_name='folder_1')
+    favourites.add_service_to_folder(client_id='client_1', folder_name='folder_1', service_id='service_1')
+    favourites.remove_service_from_folder(client_id='client_1', folder_name='folder_1', service_id='service_1')
+    favourites.remove_folder(client_id='client_1', folder_name='folder_1')
+    favourites.add_favourite_provider(client_id='client_1', provider_id='provider_1')
+    assert changes == [('client_1', 'folder_1')] * 3
+
+def test_get_folders(favourites, mocker):
+    assert favourites.get_folders(client_id='client_1') is None
+    favourites.add_folder(client_id='client_1', folder_name='folder_1')
+    favourites.add_folder(client_id='client_1', folder_name='folder_2')
+    favourites.add_service_to_folder(client_id='client_1', folder_name='folder_2', service_id='service_1')
+    assert favourites.get_folders(client_id='client_1') == {'folder_1': [], 'folder_2': ['service_1']}
@@ -0,0 +1,33 @@
+import heapq
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+from lib.interest_prediction import InterestPredictor
+
+# Run with the following command:
+# pytest AccountsService/api_container/tests/test_interest_prediction.py
+
+RELATIONS = [
+    ('folder1', 'service1'), ('folder1', 'service2'), ('folder1', 'service3'),
+    ('folder2', 'service1'), ('folder2', 'service2'),
+    ('folder3', 'service4'), ('folder3', 'service5'),
+    ('folder4', 'service1'), ('folder4', 'service3'),
+    ('folder5', 'service1'), ('folder5', 'service2'), ('folder5', 'service6')
+]
+
+def test_services_are_counted():
+    predictor = InterestPredictor(RELATIONS, 'folder2')
+    assert predictor.services['service1'] == 4
+    assert list(predictor.services) == ['service1', 'service2', 'service3', 'service4', 'service5', 'service6']
+
+def test_top_k_predictions():
+    predictions = InterestPredictor(RELATIONS, 'folder2').get_interest_prediction()
+    assert set(predictions) == {'service3', 'service4', 'service5', 'service6'}
+    best = InterestPredictor(RELATIONS, 'folder2').get_interest_prediction(k=2)
+    assert list(best.items()) == heapq.nlargest(2, predictions.items(), key=lambda item: item[1])
+
+def test_prediction_does_not_print(capsys):
+    InterestPredictor(RELATIONS, 'folder2').get_interest_prediction()
+    assert capsys.readouterr().out == ""
@@ -0,0 +1,95 @@
+import pytest
+import mongomock
+from pymongo import ASCENDING
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+from lib.mongo_indexes import IndexSpec, ensure_indexes, index_report
+from chats_nosql import Chats
+from favourites_nosql import Favourites
+from certificates_nosql import Certificates
+from mobile_token_nosql import MobileToken
+
+# Run with the following command:
+# pytest AccountsService/api_container/tests/test_mongo_indexes.py
+# The explain test needs a real MongoDB: MONGO_TEST_URI=mongodb://localhost:27017 pytest ...
+
+os.environ['MONGO_TEST_DB'] = 'test_db'
+MANAGERS = [Chats, Favourites, Certificates, MobileToken]
+
+@pytest.fixture(scope='function')
+def mongo_client():
+    client = mongomock.MongoClient()
+    yield client
+    client.drop_database(os.getenv('MONGO_TEST_DB'))
+    client.close()
+
+def test_ensure_indexes_is_idempotent(mongo_client):
+    db = mongo_client[os.getenv('MONGO_TEST_DB')]
+    registry = {'items': [IndexSpec([('a', ASCENDING), ('b', -1)], unique=True)]}
+    assert ensure_indexes(db, registry) == ['items.a_1_b_-1']
+    assert ensure_indexes(db, registry) == []
+    assert db['items'].index_information()['a_1_b_-1']['unique']
+
+def test_index_with_other_options_is_replaced(mongo_client):
+    db = mongo_client[os.getenv('MONGO_TEST_DB')]
+    # unique index of older versions, which two chats without user_id break
+    db['chats'].create_index([('user_id', ASCENDING)], unique=True)
+    MobileToken(test_client=mongo_client)
+    assert db['chats'].index_information()['user_id_1']['partialFilterExpression'] == {'user_id': {'$exists': True}}
+    chats = Chats(test_client=mongo_client)
+    assert chats.insert_message('provider_1', 'client_1', 'Hello', 'client_1')
+    assert chats.insert_message('provider_1', 'client_2', 'Hello', 'client_2')
+
+def test_index_report(mongo_client):
+    managers = [manager(test_client=mongo_client) for manager in MANAGERS]
+    db = managers[0].db
+    report = index_report(db, *(manager.INDEXES for manager in managers))
+    assert all(not indexes["missing"] and not indexes["undeclared"] for indexes in report.values())
+    db['chats'].drop_index('client_id_1_last_message_at_-1')
+    db['chats'].create_index([('created_at', ASCENDING)])
+    report = index_report(db, *(manager.INDEXES for manager in managers))
+    assert report['chats']["missing"] == ['client_id_1_last_message_at_-1']
+    assert report['chats']["undeclared"] == ['created_at_1']
+
+@pytest.mark.skipif(not os.getenv('MONGO_TEST_URI'), reason="explain() needs a real MongoDB (MONGO_TEST_URI)")
+def test_hot_queries_use_indexes():
+    from pymongo import MongoClient
+    client = MongoClient(os.getenv('MONGO_TEST_URI'))
+    try:
+        chats = Chats(test_client=client, storage="buckets")
+        favourites = Favourites(test_client=client)
+        certificates = Certificates(test_client=client)
+        mobile_tokens = MobileToken(test_client=client)
+        chats.insert_message('provider_1', 'client_1', 'Hello', 'client_1')
+        favourites.add_folder('client_1', 'folder_1')
+        favourites.add_service_to_folder('client_1', 'folder_1', 'service_1')
+        certificates.add_certificate('provider_1', 'name', 'description', 'path')
+        mobile_tokens.update_mobile_token('client_1', 'token')
+        queries = [
+            (chats.collection, {'provider_id': 'provider_1', 'client_id': 'client_1'}),
+            (chats.collection, {'provider_id': 'provider_1'}),
+            (chats.collection, {'client_id': 'client_1'}),
+            (chats.buckets, {'chat_id': 'chat_1', 'bucket': {'$gte': 0, '$lte': 1}}),
+            (chats.buckets, {'client_id': 'client_1'}),
+            (favourites.collection, {'client_id': 'client_1'}),
+            (favourites.saved_services, {'service_id': {'$in': ['service_1']}}),
+            (favourites.recommendations, {'client_id': 'client_1', 'folder_name': 'folder_1'}),
+            (certificates.collection, {'uuid': 'provider_1', 'certificates.certificate_id': 'certificate_1'}),
+            (certificates.collection, {'certificates.is_validated': False}),
+            (mobile_tokens.collection, {'user_id': 'client_1'}),
+            (mobile_tokens.notifications, {'user_id': 'client_1'}),
+        ]
+        for collection, query in queries:
+            plan = collection.find(query).explain()['queryPlanner']['winningPlan']
+            assert 'COLLSCAN' not in str(plan), f"{collection.name} {query}"
+        # the keyword search reads the postings of the searched prefixes through an index
+        for filters in [(None, None), ('provider_1', None), ('provider_1', 'client_1'), (None, 'client_1')]:
+            pipeline = chats._indexed_search_pipeline(['hel', 'wor'], *filters, None, None, None)
+            plan = str(chats.db.command('aggregate', chats.terms.name, pipeline=pipeline, explain=True))
+            assert 'IXSCAN' in plan and 'COLLSCAN' not in plan, f"chat_terms {filters}"
+    finally:
+        client.drop_database(os.getenv('MONGO_TEST_DB'))
+        client.close()
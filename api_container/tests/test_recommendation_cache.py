@@ -0,0 +1,51 @@
+import pytest
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+from lib.recommendation_cache import RecommendationCache
+
+# Run with the following command:
+# pytest AccountsService/api_container/tests/test_recommendation_cache.py
+
+LOCATION = {"longitude": -58.3816, "latitude": -34.6037}
+
+def test_nearby_locations_share_the_entry():
+    cache = RecommendationCache()
+    cache.put(cache.key("client_1", "folder_1", LOCATION), {"service_1": 1.0})
+    nearby = {"longitude": -58.3814, "latitude": -34.6039}
+    far = {"longitude": -58.5, "latitude": -34.6037}
+    assert cache.get(cache.key("client_1", "folder_1", nearby)) == {"service_1": 1.0}
+    assert cache.get(cache.key("client_1", "folder_1", far)) is None
+    assert cache.get(cache.key("client_1", "folder_2", LOCATION)) is None
+    assert cache.stats() == {"entries": 1, "hits": 1, "misses": 2}
+
+def test_entries_expire():
+    cache = RecommendationCache(ttl_seconds=-1)
+    key = cache.key("client_1", "folder_1", LOCATION)
+    cache.put(key, {"service_1": 1.0})
+    assert cache.get(key) is None
+    assert cache.stats()["entries"] == 0
+
+def test_least_recently_used_entries_are_dropped():
+    cache = RecommendationCache(max_entries=2)
+    keys = [cache.key("client_1", f"folder_{i}", LOCATION) for i in range(3)]
+    cache.put(keys[0], {})
+    cache.put(keys[1], {})
+    cache.get(keys[0])
+    cache.put(keys[2], {})
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == {}
+    assert cache.get(keys[2]) == {}
+
+def test_invalidate_drops_every_cell_of_the_folder():
+    cache = RecommendationCache()
+    far = {"longitude": 10.0, "latitude": 10.0}
+    keys = [cache.key("client_1", "folder_1", LOCATION), cache.key("client_1", "folder_1", far)]
+    other = cache.key("client_1", "folder_2", LOCATION)
+    for key in keys + [other]:
+        cache.put(key, {"service_1": 1.0})
+    cache.invalidate("client_1", "folder_1")
+    assert all(cache.get(key) is None for key in keys)
+    assert cache.get(other) == {"service_1": 1.0}
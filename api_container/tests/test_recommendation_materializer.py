@@ -0,0 +1,76 @@
+import datetime
+import pytest
+import mongomock
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+from favourites_nosql import Favourites
+from lib.recommendation_materializer import client_shard, materialize_recommendations, _last_recommendations_run
+from lib.sparse_interest_prediction import SparseInterestPredictor
+
+# Run with the following command:
+# pytest AccountsService/api_container/tests/test_recommendation_materializer.py
+
+os.environ['MONGO_TEST_DB'] = 'test_db'
+
+FOLDERS = {
+    ('client_1', 'folder_1'): ['service_1', 'service_2', 'service_3'],
+    ('client_1', 'folder_2'): ['service_1', 'service_2'],
+    ('client_2', 'folder_1'): ['service_4', 'service_5'],
+    ('client_3', 'folder_1'): ['service_1', 'service_3'],
+    ('client_4', 'folder_1'): ['service_1', 'service_2', 'service_6'],
+}
+
+@pytest.fixture(scope='function')
+def favourites():
+    client = mongomock.MongoClient()
+    favourites = Favourites(test_client=client)
+    for (client_id, folder_name), services in FOLDERS.items():
+        favourites.add_folder(client_id, folder_name)
+        for service_id in services:
+            favourites.add_service_to_folder(client_id, folder_name, service_id)
+    yield favourites
+    client.drop_database(os.getenv('MONGO_TEST_DB'))
+    client.close()
+
+def test_client_shard_is_stable():
+    assert client_shard('client_1', 4) == client_shard('client_1', 4)
+    assert {client_shard(f'client_{i}', 4) for i in range(50)} == {0, 1, 2, 3}
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_materialize_every_folder(favourites, workers):
+    assert materialize_recommendations(favourites, k=2, workers=workers) == len(FOLDERS)
+    relations = [(f"{client_id}_{folder_name}", service) for (client_id, folder_name), services in FOLDERS.items() for service in services]
+    for client_id, folder_name in FOLDERS:
+        expected = SparseInterestPredictor(relations, f"{client_id}_{folder_name}").get_interest_prediction(limit=2)
+        assert favourites.get_materialized_recommendations(client_id, folder_name) == expected
+    assert _last_recommendations_run(favourites) <= datetime.datetime.now()
+
+def test_changed_and_removed_folders_are_dropped(favourites):
+    materialize_recommendations(favourites, workers=1)
+    favourites.add_service_to_folder('client_1', 'folder_2', 'service_6')
+    assert favourites.get_materialized_recommendations('client_1', 'folder_2') is None
+    assert favourites.get_materialized_recommendations('client_1', 'folder_1') is not None
+    favourites.remove_folder('client_3', 'folder_1')
+    materialize_recommendations(favourites, workers=1)
+    assert favourites.get_materialized_recommendations('client_3', 'folder_1') is None
+    assert favourites.get_materialized_recommendations('client_1', 'folder_2') is not None
+
+def test_folder_changed_during_the_run_is_not_saved(favourites, monkeypatch):
+    get_all_relations = favourites.get_all_relations
+
+    def change_after_read():
+        relations = get_all_relations()
+        favourites.add_service_to_folder('client_1', 'folder_2', 'service_6')
+        return relations
+
+    monkeypatch.setattr(favourites, 'get_all_relations', change_after_read)
+    assert materialize_recommendations(favourites, workers=1) == len(FOLDERS)
+    assert favourites.get_materialized_recommendations('client_1', 'folder_2') is None
+    assert favourites.get_materialized_recommendations('client_1', 'folder_1') is not None
+
+    monkeypatch.setattr(favourites, 'get_all_relations', get_all_relations)
+    materialize_recommendations(favourites, workers=1)
+    assert favourites.get_materialized_recommendations('client_1', 'folder_2') is not None
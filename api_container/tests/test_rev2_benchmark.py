@@ -0,0 +1,66 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+import time
+from lib.rev2_benchmark import _run_isolated, generate_ratings, rev2_benchmark, sweep_benchmark
+from lib.rev2_graph_builder import build_rating_arrays
+
+# Run with the following command:
+# pytest AccountsService/api_container/tests/test_rev2_benchmark.py
+
+def test_generate_ratings_blocks_and_rings():
+    ratings, fraud_users = generate_ratings(users=200, services=40, ratings=2_000, components=4, skew=1.0,
+                                            fraud_rings=3, ring_size=5, ring_targets=2, seed=1)
+    assert len(fraud_users) == 15
+    assert all(0.0 <= rating <= 5.0 for _, _, rating in ratings)
+
+    # honest ratings never cross blocks: users 0-49 only rate services 0-9, and so on
+    honest = [(int(user[1:]), int(service[1:])) for user, service, _ in ratings if not user.startswith('Ufraud')]
+    assert len(honest) == 2_000
+    assert all(user // 50 == service // 10 for user, service in honest)
+
+    fraud = [(user, service, rating) for user, service, rating in ratings if user.startswith('Ufraud')]
+    for ring in range(3):
+        members = {user for user, _, _ in fraud if user.startswith(f'Ufraud{ring}_')}
+        assert len(members) == 5
+        ring_ratings = [(service, rating) for user, service, rating in fraud if user in members]
+        promoted = {service for service, rating in ring_ratings if rating == 5.0}
+        assert len(promoted) == 2
+        assert len({int(service[1:]) // 10 for service, _ in ring_ratings}) == 1
+
+    arrays = build_rating_arrays(ratings)
+    assert arrays.n_components >= 4
+
+def test_rev2_benchmark_smoke():
+    spec = {"users": 60, "services": 12, "ratings": 300, "components": 2, "fraud_rings": 1, "ring_size": 4}
+    [result] = rev2_benchmark(spec, engines=("sparse",), persist=True)
+    assert result["engine"] == "sparse"
+    assert result["graph"]["ratings"] > 300
+    assert result["iterations"]["max"] >= 1
+    assert result["fairness"]["fraud_mean"] is not None
+    for phase in ("construction", "normalization", "iteration", "persistence"):
+        assert result["seconds"][phase] is not None
+
+def test_sweep_benchmark_smoke():
+    spec = {"users": 60, "services": 12, "ratings": 300}
+    [result] = sweep_benchmark(spec, [(0.5, 0.5), (0.3, 0.7)], workers=2)
+    assert [(s["gamma1"], s["gamma2"]) for s in result["settings"]] == [(0.5, 0.5), (0.3, 0.7)]
+    assert result["seconds"]["sweep"] > 0
+    assert result["seconds"]["separate_runs"] > 0
+    assert len(result["rank_correlation"]) == 2
+
+
+def _dying_case(queue):
+    os._exit(3)
+
+def _hanging_case(queue):
+    time.sleep(60)
+
+def test_dead_case_is_reported():
+    assert _run_isolated(_dying_case) == {"error": "case process exited with code 3"}
+
+def test_hanging_case_is_killed():
+    result = _run_isolated(_hanging_case, timeout=2)
+    assert "error" in result
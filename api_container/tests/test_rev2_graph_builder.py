@@ -0,0 +1,65 @@
+import numpy as np
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+from lib.rev2_graph_builder import build_rating_arrays, union_find_components
+
+# Run with the following command:
+# pytest AccountsService/api_container/tests/test_rev2_graph_builder.py
+
+RATINGS = [
+    ('U1', 'S1', 5.0), ('U2', 'S1', 3.0), ('U2', 'S2', 1.0), ('U1', 'S2', 4.0),  # cycle U1-S1-U2-S2
+    ('U3', 'S3', 2.0),
+    ('U4', 'S4', 1.0), ('U4', 'S4', 4.0),  # repeated rating
+]
+
+def test_components_are_grouped():
+    arrays = build_rating_arrays(RATINGS)
+    assert arrays.n_components == 3
+    assert list(arrays.user_component) == sorted(arrays.user_component)
+    assert list(arrays.edge_component) == sorted(arrays.edge_component)
+    assert arrays.edge_offsets().tolist()[-1] == len(arrays.rating)
+
+def test_keeps_every_edge_of_a_cycle():
+    arrays = build_rating_arrays(RATINGS)
+    component = arrays.user_component[arrays.users.index('U1')]
+    edge_user, edge_service, rating = arrays.component_edges(component)
+    edges = {(arrays.users[u], arrays.services[s], r) for u, s, r in zip(edge_user, edge_service, rating)}
+    assert edges == {('U1', 'S1', 5.0), ('U2', 'S1', 3.0), ('U2', 'S2', 1.0), ('U1', 'S2', 4.0)}
+
+def test_repeated_rating_keeps_last_but_counts_for_bounds():
+    arrays = build_rating_arrays(RATINGS + [('U5', 'S5', 0.0), ('U5', 'S5', 3.0)])
+    component = arrays.user_component[arrays.users.index('U5')]
+    assert arrays.component_edges(component)[2].tolist() == [3.0]
+    assert arrays.min_rating == 0.0
+    assert arrays.max_rating == 5.0
+
+def test_union_find_components():
+    labels, n_components = union_find_components(np.array([0, 1, 1, 2]), np.array([0, 0, 1, 2]), 3, 3)
+    assert n_components == 2
+    assert labels[0] == labels[1] == labels[3] == labels[4]
+    assert labels[2] == labels[5]
+    assert labels[0] != labels[2]
+
+def test_empty_ratings():
+    arrays = build_rating_arrays([])
+    assert arrays.n_components == 0
+    assert arrays.users == []
+
+def test_streamed_ratings_match_list():
+    expected = build_rating_arrays(RATINGS)
+    arrays = build_rating_arrays((rating for rating in RATINGS), chunk_size=2)
+    assert arrays.users == expected.users
+    assert arrays.services == expected.services
+    assert arrays.edge_user.tolist() == expected.edge_user.tolist()
+    assert arrays.edge_service.tolist() == expected.edge_service.tolist()
+    assert arrays.rating.tolist() == expected.rating.tolist()
+    assert (arrays.min_rating, arrays.max_rating) == (1.0, 5.0)
+
+def test_bounds_span_chunks():
+    ratings = [('U1', 'S1', 3), ('U2', 'S1', 2.0), ('U3', 'S2', 7.0), ('U3', 'S1', 5.0)]
+    arrays = build_rating_arrays(iter(ratings), chunk_size=1)
+    assert (arrays.min_rating, arrays.max_rating) == (2.0, 7.0)
+    assert arrays.rating.dtype == np.float64
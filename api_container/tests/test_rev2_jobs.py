@@ -0,0 +1,98 @@
+import pytest
+import threading
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+# lib.new_rev2 needs the ServicesService client
+pytest.importorskip("imported_lib")
+from lib.rev2_jobs import Rev2JobManager
+
+# Run with the following command:
+# pytest AccountsService/api_container/tests/test_rev2_jobs.py
+
+RATINGS = [("U1", "S1", 5.0), ("U2", "S1", 1.0), ("U2", "S2", 3.0), ("U3", "S3", 2.0), ("U4", "S3", 4.0)]
+
+def _wait(manager, job):
+    manager._executor.submit(lambda: None).result(timeout=30)
+    return manager.get(job.job_id)
+
+@pytest.fixture
+def release():
+    return threading.Event()
+
+@pytest.fixture
+def manager(release):
+    calls = []
+    def fetch_ratings(max_delta_days):
+        calls.append(max_delta_days)
+        release.wait(timeout=30)
+        return RATINGS if max_delta_days > 0 else []
+    manager = Rev2JobManager(fetch_ratings, workers=1, cached_results=1)
+    manager.calls = calls
+    yield manager
+    release.set()
+    manager.shutdown()
+
+def test_job_runs_in_background_and_is_cached(manager, release):
+    key = manager.key("sparse")
+    job = manager.submit(key)
+    assert job.status in ("queued", "running")
+    assert manager.cached(key) is None
+    # single flight while running
+    assert manager.submit(key) is job
+    release.set()
+    job = _wait(manager, job)
+    assert job.status == "finished"
+    assert set(job.results) == {"1", "2", "3", "4"}
+    assert list(job.results.values()) == sorted(job.results.values())
+    assert manager.cached(key) is job
+    assert manager.submit(key) is job
+    assert manager.calls == [360]
+    summary = job.summary(with_results=True)
+    assert summary["progress"]["stage"] == "done"
+    assert summary["run_id"] is not None
+
+def test_failed_job_is_retried(manager, release):
+    release.set()
+    key = manager.key("sparse", max_delta_days=0)
+    job = _wait(manager, manager.submit(key))
+    assert job.status == "failed"
+    assert job.error == "No ratings found"
+    assert manager.cached(key) is None
+    assert manager.submit(key) is not job
+
+def test_cache_keeps_last_keys(manager, release):
+    release.set()
+    first = _wait(manager, manager.submit(manager.key("sparse", gamma1=0.5)))
+    second = _wait(manager, manager.submit(manager.key("sparse", gamma1=0.7)))
+    manager.submit(manager.key("sparse", gamma1=0.9))
+    assert manager.cached(first.key) is None
+    assert first.results is None
+    assert manager.cached(second.key) is second
+
+def test_evicted_job_expires(manager, release):
+    release.set()
+    first = _wait(manager, manager.submit(manager.key("sparse", gamma1=0.5)))
+    _wait(manager, manager.submit(manager.key("sparse", gamma1=0.7)))
+    manager.submit(manager.key("sparse", gamma1=0.9))
+    job = manager.get(first.job_id)
+    assert job.status == "expired"
+    assert "results" not in job.summary(with_results=True)
+    # the same key runs again instead of returning the expired job
+    again = manager.submit(first.key)
+    assert again is not first
+    assert _wait(manager, again).status == "finished"
+
+def test_unknown_engine(manager):
+    with pytest.raises(ValueError):
+        manager.key("unknown")
+
+def test_streamed_ratings():
+    manager = Rev2JobManager(lambda max_delta_days: (rating for rating in RATINGS), workers=1)
+    job = _wait(manager, manager.submit(manager.key("sparse")))
+    manager.shutdown()
+    assert job.status == "finished"
+    assert set(job.results) == {"1", "2", "3", "4"}
+    assert job.progress["ratings"] == len(RATINGS)
@@ -0,0 +1,129 @@
+import datetime
+import pytest
+import sys
+import os
+from sqlalchemy import create_engine
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+from lib.rev2_scheduler import CronSchedule, Rev2Lock, Rev2Scheduler
+
+# Run with the following command:
+# pytest AccountsService/api_container/tests/test_rev2_scheduler.py
+
+NOW = datetime.datetime(2024, 5, 10, 12, 30)
+
+@pytest.fixture
+def engine():
+    engine = create_engine('sqlite:///:memory:')
+    yield engine
+    engine.dispose()
+
+class FakeRev2:
+    def __init__(self, last_run=None, new_ratings=0, results=None):
+        self.last = last_run
+        self.new_ratings = new_ratings
+        self.counted = []
+        self.results = list(results or [])
+        self.runs = 0
+
+    def run(self):
+        self.runs += 1
+        result = self.results.pop(0) if self.results else True
+        if isinstance(result, Exception):
+            raise result
+        if result:
+            self.last = NOW
+        return result
+
+    def count_new_ratings(self, since, limit):
+        self.counted.append((since, limit))
+        return min(self.new_ratings, limit)
+
+def _scheduler(fake, engine, **kwargs):
+    return Rev2Scheduler(fake.run, lambda: fake.last, fake.count_new_ratings, Rev2Lock(engine),
+                         schedule="0 3 1,16 * *", **kwargs)
+
+def test_cron_schedule():
+    schedule = CronSchedule("0 3 1,16 * *")
+    assert schedule.next_after(NOW) == datetime.datetime(2024, 5, 16, 3, 0)
+    assert schedule.next_after(datetime.datetime(2024, 5, 16, 3, 0)) == datetime.datetime(2024, 6, 1, 3, 0)
+    assert CronSchedule("*/15 * * * *").next_after(NOW) == datetime.datetime(2024, 5, 10, 12, 45)
+    # 2024-05-10 is a Friday, Sunday is 0 or 7
+    assert CronSchedule("0 0 * * 7").next_after(NOW) == datetime.datetime(2024, 5, 12, 0, 0)
+    assert CronSchedule("0 0 * * 1-5").next_after(NOW) == datetime.datetime(2024, 5, 13, 0, 0)
+    # both day fields restricted: either of them
+    assert CronSchedule("0 0 20 * 0").next_after(NOW) == datetime.datetime(2024, 5, 12, 0, 0)
+
+@pytest.mark.parametrize("expression", ["* * *", "60 * * * *", "* * 0 * *", "a * * * *", "0 0 31 2 *"])
+def test_invalid_cron_schedule(expression):
+    with pytest.raises(ValueError):
+        CronSchedule(expression).next_after(NOW)
+
+def test_lock_is_single_flight(engine):
+    first = Rev2Lock(engine)
+    second = Rev2Lock(engine)
+    assert first.acquire()
+    assert not second.acquire()
+    first.release()
+    assert second.acquire()
+
+def test_expired_lock_is_taken_over(engine):
+    crashed = Rev2Lock(engine, lease_seconds=-1)
+    assert crashed.acquire()
+    assert Rev2Lock(engine).acquire()
+
+def test_first_run_is_immediate(engine):
+    fake = FakeRev2()
+    scheduler = _scheduler(fake, engine)
+    assert scheduler.due(NOW) == "schedule"
+    assert scheduler.tick(NOW)
+    assert fake.runs == 1
+    assert scheduler.due(NOW) is None
+    assert scheduler.seconds_to_wait(NOW) == scheduler.poll_seconds
+
+def test_runs_on_schedule(engine):
+    fake = FakeRev2(last_run=datetime.datetime(2024, 5, 1, 3, 0))
+    scheduler = _scheduler(fake, engine)
+    assert not scheduler.tick(NOW)
+    assert scheduler.tick(datetime.datetime(2024, 5, 16, 3, 0))
+    assert fake.runs == 1
+
+def test_new_ratings_trigger(engine):
+    fake = FakeRev2(last_run=datetime.datetime(2024, 5, 1, 3, 0), new_ratings=10)
+    assert _scheduler(fake, engine, ratings_trigger=11).due(NOW) is None
+    assert _scheduler(fake, engine, ratings_trigger=10).due(NOW) == "new ratings"
+    assert _scheduler(fake, engine, ratings_trigger=0).due(NOW) is None
+    # the count is bounded by the trigger and starts at the last run
+    assert fake.counted == [(datetime.datetime(2024, 5, 1, 3, 0), 11), (datetime.datetime(2024, 5, 1, 3, 0), 10)]
+
+def test_backoff_with_jitter_after_empty_or_failed_runs(engine):
+    fake = FakeRev2(results=[False, RuntimeError("db down"), True])
+    scheduler = _scheduler(fake, engine, base_backoff=60, max_backoff=200)
+    assert scheduler.tick(NOW)
+    assert 30 <= (scheduler.retry_at - NOW).total_seconds() <= 90
+    assert scheduler.seconds_to_wait(NOW) == (scheduler.retry_at - NOW).total_seconds()
+    assert not scheduler.tick(NOW)
+    retry = scheduler.retry_at
+    assert scheduler.tick(retry)
+    assert scheduler.failures == 2
+    assert 60 <= (scheduler.retry_at - retry).total_seconds() <= 180
+    assert scheduler.tick(scheduler.retry_at)
+    assert scheduler.failures == 0
+    assert scheduler.retry_at is None
+    assert fake.runs == 3
+
+def test_skips_while_another_replica_runs(engine):
+    other = Rev2Lock(engine)
+    assert other.acquire()
+    fake = FakeRev2()
+    assert not _scheduler(fake, engine).tick(NOW)
+    assert fake.runs == 0
+
+def test_start_and_stop(engine):
+    fake = FakeRev2()
+    scheduler = _scheduler(fake, engine, poll_seconds=3600)
+    scheduler.start()
+    scheduler.stop(timeout=5)
+    assert fake.runs <= 1
+    assert scheduler._thread is None
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+from lib.rev2_benchmark import generate_ratings
+from lib.rev2_sweep import SharedArrays, rank_correlation, rev2_sweep
+from lib.sparse_rev2 import SparseRev2Graph
+
+# Run with the following command:
+# pytest AccountsService/api_container/tests/test_rev2_sweep.py
+
+GRID = [(0.5, 0.5), (0.2, 0.8), (0.8, 0.2)]
+
+@pytest.fixture(scope='module')
+def graph():
+    ratings_list, _ = generate_ratings(users=300, services=40, ratings=1500, fraud_rings=2, ring_size=5, seed=3)
+    return SparseRev2Graph(ratings_list)
+
+def test_sweep_matches_separate_runs(graph):
+    sweep = rev2_sweep(graph, GRID, workers=1)
+    assert sweep["users"] == graph.users
+    for (gamma1, gamma2), row in zip(GRID, sweep["fairness"]):
+        expected = graph.calculate(gamma1, gamma2)
+        assert row.tolist() == [expected[user] for user in graph.users]
+
+def test_parallel_sweep_matches_serial(graph):
+    serial = rev2_sweep(graph, GRID, workers=1)
+    parallel = rev2_sweep(graph, GRID, workers=3)
+    assert np.array_equal(serial["fairness"], parallel["fairness"])
+    assert parallel["rank_correlation"] == serial["rank_correlation"]
+
+def test_settings_report(graph):
+    sweep = rev2_sweep(graph, GRID, workers=1)
+    assert [(s["gamma1"], s["gamma2"]) for s in sweep["settings"]] == GRID
+    distribution = sweep["settings"][0]["fairness"]
+    assert distribution["count"] == len(graph.users)
+    assert sum(distribution["histogram"]["counts"]) == len(graph.users)
+    assert distribution["min"] <= distribution["percentiles"]["50"] <= distribution["max"]
+    correlation = sweep["rank_correlation"]
+    assert [correlation[i][i] for i in range(len(GRID))] == [1.0] * len(GRID)
+    assert correlation[0][1] == correlation[1][0]
+
+def test_rank_correlation():
+    fairness = np.array([[0.1, 0.2, 0.3, 0.4], [0.2, 0.4, 0.6, 0.9], [0.4, 0.3, 0.2, 0.1], [0.5, 0.5, 0.5, 0.5]])
+    correlation = rank_correlation(fairness)
+    assert correlation[0][1] == 1.0
+    assert correlation[0][2] == -1.0
+    assert correlation[0][3] is None
+
+def test_shared_arrays_roundtrip():
+    arrays = {"a": np.arange(5, dtype=np.int32), "b": np.linspace(0, 1, 3), "c": np.zeros(0)}
+    shared = SharedArrays(arrays)
+    try:
+        memory, attached = SharedArrays.attach(shared.name, shared.layout)
+        for name, array in arrays.items():
+            assert np.array_equal(attached[name], array)
+            assert attached[name].dtype == array.dtype
+            assert not attached[name].flags.writeable
+        del attached
+        memory.close()
+    finally:
+        shared.close()
+
+def test_empty_grid(graph):
+    with pytest.raises(ValueError):
+        rev2_sweep(graph, [])
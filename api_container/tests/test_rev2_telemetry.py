@@ -0,0 +1,70 @@
+import pytest
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+from lib.sparse_rev2 import SparseRev2Graph
+from lib.rev2_telemetry import Rev2RunHistory, Rev2RunTelemetry
+from lib.rev2_workers import Rev2WorkerPool
+
+# Run with the following command:
+# pytest AccountsService/api_container/tests/test_rev2_telemetry.py
+
+RATINGS = [
+    ("U1", "S1", 5.0), ("U1", "S2", 1.0), ("U2", "S1", 4.0), ("U2", "S2", 2.0),
+    ("U3", "S1", 1.0), ("U4", "S3", 3.0), ("U5", "S3", 5.0), ("U5", "S4", 2.0)
+]
+
+def _run(graph, **kwargs):
+    telemetry = Rev2RunTelemetry("sparse", len(graph.score))
+    graph.calculate(telemetry=telemetry, **kwargs)
+    telemetry.finish(graph.iterations, graph.component_edges())
+    return telemetry
+
+def test_iterations_are_recorded():
+    graph = SparseRev2Graph(RATINGS)
+    telemetry = _run(graph)
+    assert len(telemetry.iterations) == graph.iterations.max()
+    last = telemetry.iterations[-1]
+    assert max(last["max_diff_fairness"], last["max_diff_goodness"], last["max_diff_reliability"]) <= 0.01
+    assert all(iteration["seconds"] >= 0 for iteration in telemetry.iterations)
+    assert telemetry.iterations[0]["active_components"] == graph.n_components
+
+def test_component_convergence_summary():
+    graph = SparseRev2Graph(RATINGS)
+    telemetry = _run(graph)
+    assert telemetry.status == "finished"
+    assert telemetry.components["count"] == graph.n_components
+    assert telemetry.components["max_iterations"] == graph.iterations.max()
+    slowest = telemetry.components["slowest"][0]
+    assert slowest["iterations"] == graph.iterations.max()
+    assert sum(c["edges"] for c in telemetry.components["slowest"]) == len(graph.score)
+
+def test_pool_records_tasks():
+    graph = SparseRev2Graph(RATINGS)
+    pool = Rev2WorkerPool(workers=2, batch_edges=3)
+    try:
+        telemetry = _run(graph, pool=pool)
+    finally:
+        pool.close()
+    assert sum(task["edges"] for task in telemetry.tasks) == len(graph.score)
+    assert max(task["iterations"] for task in telemetry.tasks) == graph.iterations.max()
+
+def test_history_keeps_last_runs(tmp_path):
+    path = str(tmp_path / "runs.jsonl")
+    history = Rev2RunHistory(path, max_runs=3)
+    runs = [_run(SparseRev2Graph(RATINGS)) for _ in range(5)]
+    for run in runs:
+        history.append(run)
+    last = history.last(10)
+    assert [run["run_id"] for run in last] == [run.run_id for run in reversed(runs[-3:])]
+    # another process reads the same file
+    assert Rev2RunHistory(path).last(2) == last[:2]
+
+def test_failed_run():
+    telemetry = Rev2RunTelemetry("sparse", 0)
+    telemetry.fail(RuntimeError("boom"))
+    run = telemetry.to_dict()
+    assert run["status"] == "failed"
+    assert run["error"] == "boom"
@@ -0,0 +1,75 @@
+import pytest
+import signal
+import sys
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+from lib.sparse_rev2 import SparseRev2Graph
+from lib.rev2_workers import Rev2WorkerPool
+
+# Run with the following command:
+# pytest AccountsService/api_container/tests/test_rev2_workers.py
+
+def _ratings():
+    ratings = []
+    # one large component and many small ones
+    for user in range(30):
+        ratings.append((f"Ubig{user}", f"Sbig{user % 7}", float(user % 5 + 1)))
+        ratings.append((f"Ubig{user}", f"Sbig{(user + 3) % 7}", float((user * 3) % 5 + 1)))
+    for component in range(20):
+        ratings.append((f"Usmall{component}", f"Ssmall{component}", float(component % 5 + 1)))
+        ratings.append((f"Usmall{component}_b", f"Ssmall{component}", 3.0))
+    return ratings
+
+@pytest.fixture(scope='module')
+def pool():
+    pool = Rev2WorkerPool(workers=2, batch_edges=8)
+    yield pool
+    pool.close()
+
+def test_plan_packs_small_components(pool):
+    graph = SparseRev2Graph(_ratings())
+    tasks = pool.plan(graph.user_component, graph.service_component, graph.edge_component)
+    assert sum(task.size for task in tasks) == len(graph.score)
+    assert sum(task.components.stop - task.components.start for task in tasks) == graph.n_components
+    assert max(task.size for task in tasks) == 60
+    assert all(task.size <= 8 for task in tasks if task.size != 60)
+    assert len(tasks) < graph.n_components
+
+def test_pool_matches_serial_run(pool):
+    expected = SparseRev2Graph(_ratings()).calculate()
+    assert SparseRev2Graph(_ratings()).calculate(pool=pool) == expected
+    # the same processes serve the next run
+    assert SparseRev2Graph(_ratings()).calculate(pool=pool) == expected
+
+def test_pool_with_warm_start(pool):
+    graph = SparseRev2Graph(_ratings())
+    expected = graph.calculate()
+    warm_graph = SparseRev2Graph(_ratings())
+    assert warm_graph.calculate(previous_state=graph.state, pool=pool) == expected
+
+def test_pool_is_recreated_after_a_worker_dies():
+    pool = Rev2WorkerPool(workers=2, batch_edges=8)
+    expected = SparseRev2Graph(_ratings()).calculate()
+    assert SparseRev2Graph(_ratings()).calculate(pool=pool) == expected
+    for process in list(pool._executor._processes.values()):
+        try:
+            os.kill(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # the executor may already have reaped it after the first kill
+            pass
+        process.join()
+    with pytest.raises(BrokenProcessPool):
+        SparseRev2Graph(_ratings()).calculate(pool=pool)
+    assert pool._executor is None
+    assert SparseRev2Graph(_ratings()).calculate(pool=pool) == expected
+    pool.close()
+
+def test_small_graphs_skip_the_pool():
+    graph = SparseRev2Graph(_ratings())
+    args = (graph.edge_user, graph.user_component, graph.service_component, graph.edge_component)
+    assert not Rev2WorkerPool(workers=2, batch_edges=1_000).is_worth_it(*args)
+    assert not Rev2WorkerPool(workers=1, batch_edges=8).is_worth_it(*args)
+    assert Rev2WorkerPool(workers=2, batch_edges=8).is_worth_it(*args)
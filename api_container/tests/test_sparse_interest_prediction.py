@@ -0,0 +1,63 @@
+import random
+import pytest
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+from lib.interest_prediction import InterestPredictor
+from lib.sparse_interest_prediction import SparseInterestPredictor
+
+# Run with the following command:
+# pytest AccountsService/api_container/tests/test_sparse_interest_prediction.py
+
+RELATIONS = [
+    ('folder1', 'service1'), ('folder1', 'service2'), ('folder1', 'service3'),
+    ('folder2', 'service1'), ('folder2', 'service2'),
+    ('folder3', 'service4'), ('folder3', 'service5'),
+    ('folder4', 'service1'), ('folder4', 'service3'),
+    ('folder5', 'service1'), ('folder5', 'service2'), ('folder5', 'service6'),
+    ('folder6', 'service6'), ('folder6', 'service7')
+]
+
+def test_same_scores_as_networkx():
+    for folder in ('folder1', 'folder2', 'folder3', 'folder6'):
+        expected = InterestPredictor(RELATIONS, folder).get_interest_prediction()
+        assert SparseInterestPredictor(RELATIONS, folder).get_interest_prediction() == expected
+
+@pytest.mark.parametrize("seed", range(10))
+def test_same_scores_as_networkx_on_random_folders(seed):
+    generator = random.Random(seed)
+    relations = [(f"folder{generator.randrange(12)}", f"service{generator.randrange(20)}") for _ in range(40)]
+    folder = relations[0][0]
+    expected = InterestPredictor(relations, folder).get_interest_prediction()
+    assert SparseInterestPredictor(relations, folder).get_interest_prediction() == expected
+
+def test_limit_keeps_the_best_services():
+    predictions = SparseInterestPredictor(RELATIONS, 'folder2').get_interest_prediction()
+    best = sorted(predictions.items(), key=lambda item: item[1], reverse=True)[:2]
+    assert list(SparseInterestPredictor(RELATIONS, 'folder2').get_interest_prediction(limit=2).items()) == best
+
+def test_folder_without_services():
+    assert SparseInterestPredictor(RELATIONS, 'folder9').get_interest_prediction() == {}
+
+def test_several_folders_at_once():
+    folders = ['folder1', 'folder3', 'folder6', 'folder9']
+    predictions = SparseInterestPredictor(RELATIONS).get_interest_predictions(folders, limit=3)
+    assert list(predictions) == ['folder1', 'folder3', 'folder6']
+    for folder in predictions:
+        assert predictions[folder] == SparseInterestPredictor(RELATIONS, folder).get_interest_prediction(limit=3)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_limited_search_keeps_the_full_ranking(seed, monkeypatch):
+    # the search stops early with a limit and folders are scored in chunks, the top-k must not change
+    monkeypatch.setattr('lib.sparse_interest_prediction.CHUNK_SIZE', 4)
+    generator = random.Random(seed)
+    relations = [(f"folder{generator.randrange(30)}", f"service{generator.randrange(60)}") for _ in range(70)]
+    folders = list(dict.fromkeys(folder for folder, _ in relations))
+    predictor = SparseInterestPredictor(relations)
+    predictions = predictor.get_interest_predictions(folders)
+    for limit in (1, 3, 10):
+        limited = predictor.get_interest_predictions(folders, limit)
+        assert {folder: list(scores.items()) for folder, scores in limited.items()} == \
+            {folder: list(scores.items())[:limit] for folder, scores in predictions.items()}
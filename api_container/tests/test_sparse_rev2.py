@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+from lib.sparse_rev2 import Rev2State, SparseRev2Graph, sparse_rev2
+
+# Run with the following command:
+# pytest AccountsService/api_container/tests/test_sparse_rev2.py
+
+def _component(prefix, ratings):
+    return [(f"U{prefix}{user}", f"S{prefix}{service}", float(rating)) for user, service, rating in ratings]
+
+COMPONENT_A = _component('a', [(1, 1, 5), (2, 1, 4), (2, 2, 1), (3, 2, 2), (3, 3, 5)])
+COMPONENT_B = _component('b', [(1, 1, 1), (2, 1, 5), (1, 2, 3)])
+
+def test_fairness_keys_are_users():
+    results = SparseRev2Graph(COMPONENT_A + COMPONENT_B).calculate()
+    assert set(results.keys()) == {r[0] for r in COMPONENT_A + COMPONENT_B}
+    assert all(0 <= value <= 1 for value in results.values())
+
+def test_components_converge_independently():
+    together = SparseRev2Graph(COMPONENT_A + COMPONENT_B).calculate()
+    alone = SparseRev2Graph(COMPONENT_A + [('Ub1', 'Sb1', 1.0), ('Ub2', 'Sb1', 5.0)]).calculate()
+    for user in {r[0] for r in COMPONENT_A}:
+        assert together[user] == pytest.approx(alone[user])
+
+def test_repeated_rating_keeps_last():
+    graph = SparseRev2Graph([('U1', 'S1', 1.0), ('U2', 'S1', 5.0), ('U1', 'S1', 5.0)])
+    assert len(graph.score) == 2
+    assert graph.score.tolist() == [1.0, 1.0]
+
+def test_equal_ratings_are_not_nan():
+    graph = SparseRev2Graph([('U1', 'S1', 5.0), ('U2', 'S1', 5.0)])
+    assert graph.score.tolist() == [0.0, 0.0]
+    results = graph.calculate()
+    assert results == {'U1': pytest.approx(1.0), 'U2': pytest.approx(1.0)}
+    assert not any(value != value for value in graph.state.reliability)
+
+def test_empty_ratings():
+    assert SparseRev2Graph([]).calculate() == {}
+
+def test_warm_start_unchanged_graph_keeps_results(tmp_path):
+    graph = SparseRev2Graph(COMPONENT_A + COMPONENT_B)
+    results = graph.calculate()
+    graph.state.save(str(tmp_path / 'rev2_state.npz'))
+    previous_state = Rev2State.load(str(tmp_path / 'rev2_state.npz'))
+    warm_graph = SparseRev2Graph(COMPONENT_B + COMPONENT_A)
+    assert warm_graph.calculate(previous_state=previous_state) == results
+
+def test_warm_start_only_iterates_changed_components():
+    graph = SparseRev2Graph(COMPONENT_A + COMPONENT_B)
+    results = graph.calculate()
+    changed = COMPONENT_B + [('Ub3', 'Sb2', 4.0)]
+    warm_graph = SparseRev2Graph(COMPONENT_A + changed)
+    warm_results = warm_graph.calculate(previous_state=graph.state, seed_fairness={'Ub3': 0.2})
+    cold_results = SparseRev2Graph(COMPONENT_A + changed).calculate()
+    for user in {r[0] for r in COMPONENT_A}:
+        assert warm_results[user] == results[user]
+    for user in {r[0] for r in changed}:
+        assert warm_results[user] == pytest.approx(cold_results[user], abs=0.05)
+
+def test_warm_start_ignores_state_with_other_params():
+    graph = SparseRev2Graph(COMPONENT_A)
+    graph.calculate(gamma1=0.3, gamma2=0.7)
+    results = SparseRev2Graph(COMPONENT_A).calculate(previous_state=graph.state)
+    assert results == SparseRev2Graph(COMPONENT_A).calculate()
+
+def test_load_missing_state(tmp_path):
+    assert Rev2State.load(str(tmp_path / 'missing.npz')) is None
+
+def test_load_damaged_state(tmp_path):
+    path = tmp_path / 'rev2_state.npz'
+    path.write_bytes(b'PK\x03\x04 not really a zip file')
+    assert Rev2State.load(str(path)) is None
+    graph = SparseRev2Graph(COMPONENT_A)
+    graph.calculate()
+    graph.state.save(str(path))
+    path.write_bytes(path.read_bytes()[:len(path.read_bytes()) // 2])
+    assert Rev2State.load(str(path)) is None
+
+def test_same_results_as_networkx_engine():
+    pytest.importorskip('imported_lib.ServicesService.services_lib')
+    from lib.new_rev2 import Rev2Graph
+    ratings = COMPONENT_A + COMPONENT_B
+    expected = Rev2Graph(ratings).calculate()
+    results = SparseRev2Graph(ratings).calculate()
+    assert results.keys() == expected.keys()
+    for user, value in expected.items():
+        assert results[user] == pytest.approx(value)
+
+def test_float32_precision():
+    expected = SparseRev2Graph(COMPONENT_A + COMPONENT_B).calculate()
+    graph = SparseRev2Graph(COMPONENT_A + COMPONENT_B, precision="float32")
+    results = graph.calculate()
+    assert graph.score.dtype == np.float32
+    assert graph.state.fairness.dtype == np.float64
+    assert results.keys() == expected.keys()
+    for user, value in expected.items():
+        assert results[user] == pytest.approx(value, abs=1e-5)
+
+def test_unknown_precision():
+    with pytest.raises(ValueError):
+        SparseRev2Graph(COMPONENT_A, precision="float16")
+
+def test_initial_values_are_not_modified():
+    graph = SparseRev2Graph(COMPONENT_A)
+    fairness = np.full(len(graph.users), 0.5)
+    goodness = np.full(len(graph.services), 0.5)
+    reliability = np.full(len(graph.score), 0.5)
+    sparse_rev2(graph.edge_user, graph.edge_service, graph.score, graph.user_component, graph.service_component,
+                graph.edge_component, 0.5, 0.5, 0.01, fairness, goodness, reliability)
+    assert fairness.tolist() == [0.5] * len(graph.users)
+    assert goodness.tolist() == [0.5] * len(graph.services)
+    assert reliability.tolist() == [0.5] * len(graph.score)
@@ -1,15 +1,22 @@
-from typing import List, Tuple
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+import heapq
+import logging as logger
 import networkx as nx
 import operator
+import os
 import random
+import time
 
 CLIENT_INDEX = 0
 SERVICE_INDEX = 1
+PROFILE = os.getenv("INTEREST_PREDICTION_PROFILE", "False").title() == "True"
 
 class InterestPredictor:
     def __init__(self, reviews: List[Tuple[str, str]], folder_name: str):
         self.bipartite_graph = self._create_bipartite_graph(reviews)
-        self.services = {r[SERVICE_INDEX]: reviews.count(r) for r in reviews}
+        # saved count of each service, in order of first appearance
+        self.services = Counter(r[SERVICE_INDEX] for r in reviews)
         self.folder_name = folder_name
         # self.existing_services = {service for (folder, service) in reviews if folder == folder_name}
         self._ebunch = self._get_ebunch(self.bipartite_graph, self.folder_name)
@@ -35,12 +42,18 @@ class InterestPredictor:
                         data_graph.add_edge(folder, other_folder)
         return data_graph
                         
-    def get_interest_prediction(self) -> List[str]:
-        # get all nodes
-        all_nodes = self.data_graph.nodes()
-        print("nodes: ", all_nodes)
+    def get_interest_prediction(self, k: Optional[int] = None) -> Dict[str, float]:
+        # {service: score}, only the `k` best (highest score first) when given
+        start = time.perf_counter()
         predictions = nx.common_neighbor_centrality(self.data_graph, ebunch=self._ebunch)
-        return {service: score for (folder, service, score) in predictions}
+        if k is not None:
+            predictions = heapq.nlargest(k, predictions, key=operator.itemgetter(2))
+        result = {service: score for (folder, service, score) in predictions}
+        if PROFILE:
+            logger.info(f"Interest prediction: {self.data_graph.number_of_nodes()} nodes, "
+                        f"{self.data_graph.number_of_edges()} edges, {len(self._ebunch)} candidates, "
+                        f"{time.perf_counter() - start:.4f}s")
+        return result
 
     
 # def _get_mock_data() -> List[Tuple[str, str]]:
@@ -0,0 +1,98 @@
+from typing import Dict, List, Optional, Tuple
+import logging as logger
+
+from pymongo.errors import OperationFailure
+
+
+class IndexSpec:
+    """
+    Declarative MongoDB index of a manager's collection.
+    Fields:
+    - keys (List[Tuple[str, int]]): the indexed fields and their direction, as in `create_index`
+    - unique (bool)
+    - partial (Optional[Dict]): partialFilterExpression, only documents matching it are indexed
+    - name (str): defaults to MongoDB's own name (`field_1_other_-1`)
+    """
+
+    def __init__(self, keys: List[Tuple[str, int]], unique: bool = False, partial: Optional[Dict] = None, name: Optional[str] = None):
+        self.keys = list(keys)
+        self.unique = unique
+        self.partial = partial
+        self.name = name or "_".join(f"{field}_{direction}" for field, direction in self.keys)
+
+    def options(self) -> Dict:
+        options = {'name': self.name}
+        if self.unique:
+            options['unique'] = True
+        if self.partial is not None:
+            options['partialFilterExpression'] = self.partial
+        return options
+
+    def matches(self, info: Dict) -> bool:
+        # `info` is an entry of Collection.index_information()
+        return _normalized(info['key']) == _normalized(self.keys) and \
+            bool(info.get('unique', False)) == self.unique and info.get('partialFilterExpression') == self.partial
+
+
+def ensure_indexes(db, registry: Dict[str, List[IndexSpec]]) -> List[str]:
+    """
+    Creates every index of `registry` ({collection name: specs}) that is missing, so it can run on every startup.
+    An index with the same name but other options (e.g. it became partial) is dropped and created again.
+    Returns the names of the indexes that were created or replaced.
+    """
+    changed = []
+    for collection_name, specs in registry.items():
+        collection = db[collection_name]
+        existing = collection.index_information()
+        for spec in specs:
+            if spec.name in existing and spec.matches(existing[spec.name]):
+                continue
+            if spec.name in existing:
+                logger.warning(f"Replacing index '{spec.name}' of '{collection_name}' with different options")
+                collection.drop_index(spec.name)
+            try:
+                collection.create_index(spec.keys, **spec.options())
+                changed.append(f"{collection_name}.{spec.name}")
+            except OperationFailure as e:
+                # e.g. existing duplicates of a new unique index, the manager still works without it
+                logger.error(f"Failed to create index '{spec.name}' of '{collection_name}': {e}")
+    if changed:
+        logger.info(f"Created MongoDB indexes: {', '.join(changed)}")
+    return changed
+
+
+def index_report(db, *registries: Dict[str, List[IndexSpec]]) -> Dict[str, Dict]:
+    """
+    Per collection of the given registries (several managers can share a collection):
+    - missing: declared indexes that do not exist (or have other options)
+    - undeclared: existing indexes no registry declares
+    - unused: declared indexes without any access since the server started, None when $indexStats is not available
+    """
+    merged: Dict[str, List[IndexSpec]] = {}
+    for registry in registries:
+        for collection_name, specs in registry.items():
+            merged.setdefault(collection_name, []).extend(specs)
+    report = {}
+    for collection_name, specs in merged.items():
+        collection = db[collection_name]
+        existing = collection.index_information()
+        declared = {spec.name for spec in specs}
+        report[collection_name] = {
+            "missing": [spec.name for spec in specs if spec.name not in existing or not spec.matches(existing[spec.name])],
+            "undeclared": [name for name in existing if name != '_id_' and name not in declared],
+            "unused": _unused_indexes(collection, declared)
+        }
+    return report
+
+
+def _unused_indexes(collection, declared: set) -> Optional[List[str]]:
+    try:
+        stats = list(collection.aggregate([{'$indexStats': {}}]))
+    except (OperationFailure, NotImplementedError):
+        return None
+    return [stat['name'] for stat in stats if stat['name'] in declared and stat['accesses']['ops'] == 0]
+
+
+def _normalized(keys) -> List[Tuple]:
+    # directions created from the shell come back as floats
+    return [(field, int(direction) if isinstance(direction, (int, float)) else direction) for field, direction in keys]
@@ -1,7 +1,9 @@
 import datetime
+import itertools
+import math
 import os
 import sys
-from time import sleep
+from time import perf_counter
 import numpy as np # linear algebra
 import pandas as pd # data processing, CSV file I/O (e.g. pd.read_csv)
 import networkx as nx # graphs
@@ -11,13 +13,24 @@ import logging as logger
 
 from accounts_sql import Accounts
 from imported_lib.ServicesService.services_lib import ServicesLib
+from lib.rev2_graph_builder import build_rating_arrays
+from lib.sparse_rev2 import Rev2State, SparseRev2Graph
+from lib.rev2_scheduler import Rev2Lock, Rev2Scheduler
+from lib.rev2_telemetry import Rev2RunTelemetry, get_run_history
+from lib.rev2_workers import WORKERS, get_worker_pool
 
 MAX_THREADS = max(50, os.cpu_count())
-UPDATE_FREQUENCY = 15 # days
+RATINGS_WINDOW_DAYS = 360
+DEFAULT_ENGINE = os.getenv("REV2_ENGINE", "networkx")
+WARM_START = os.getenv("REV2_WARM_START", "False").title() == "True"
+STATE_PATH = os.getenv("REV2_STATE_PATH", os.path.join(os.getenv("LOCAL_STORAGE_PATH", "/tmp"), "rev2_state.npz"))
+_count_fallback_warned = False
 
 
 #############################
 class Metricas:
+    __slots__ = ('score', 'fiabilidad')
+
     def __init__(self, score, fiabilidad):
         self.score = score
         self.fiabilidad = fiabilidad
@@ -67,7 +80,7 @@ def actualizar_valor_wrapper(args):
 def actualizar_fiabilidad_wrapper(grafo, usuario, producto, gamma1, gamma2, fairness, valor):
     return actualizar_fiabilidad(grafo, usuario, producto, gamma1, gamma2, fairness, valor)
 
-def rev2(grafo_original, gamma1, gamma2, diff):
+def rev2(grafo_original, gamma1, gamma2, diff, telemetry=None):
     
     grafo = generar_grafo_con_metricas(grafo_original)
     fairness = {nodo: 1 for nodo in grafo.nodes if grafo.out_degree(nodo) > 0}
@@ -82,10 +95,11 @@ def rev2(grafo_original, gamma1, gamma2, diff):
 
     while max_diff_fairness > diff or max_diff_confiabilidad > diff or max_diff_valor > diff:
         it+=1
-        print(f"Calculando la {it}° iteración...")
-        vieja_fairness = fairness.copy()
+        inicio = perf_counter()
+        # fairness and valor are replaced by new dicts below, so the old ones can be kept without copying them
+        vieja_fairness = fairness
         vieja_confiabilidad = {arista: datos['metricas'].fiabilidad for arista, datos in grafo.edges.items()}
-        viejo_valor = valor.copy()
+        viejo_valor = valor
 
         usuarios = [nodo for nodo in grafo.nodes if grafo.out_degree(nodo) > 0]
         productos = [nodo for nodo in grafo.nodes if grafo.in_degree(nodo) > 0]
@@ -107,65 +121,176 @@ def rev2(grafo_original, gamma1, gamma2, diff):
         nueva_confiabilidad = {arista: datos['metricas'].fiabilidad for arista, datos in grafo.edges.items()}
         nuevo_valor = valor
         
-        print(f"Iteración {it} terminada.")
-        print("Obteniendo max_diff_fairness")
         max_diff_fairness = max(abs(vieja_fairness[nodo] - nueva_fairness[nodo]) for nodo in usuarios)
-        print("Obteniendo max_diff_confiabilidad")
         max_diff_confiabilidad = max(abs(vieja_confiabilidad[arista] - nueva_confiabilidad[arista]) for arista in grafo.edges)
-        print("Obteniendo max_diff_valor")
         max_diff_valor = max(abs(viejo_valor[nodo] - nuevo_valor[nodo]) for nodo in productos)
-        print(f"{it}° iteración:")
-        print("- max_diff_fairness: ", round(max_diff_fairness, 4))
-        print("- max_diff_confiabilidad: ", round(max_diff_confiabilidad, 4))
-        print("- max_diff_valor: ", round(max_diff_valor, 4), '\n')
+        logger.debug(f"{it}° iteración: max_diff_fairness={round(max_diff_fairness, 4)} "
+                     f"max_diff_confiabilidad={round(max_diff_confiabilidad, 4)} max_diff_valor={round(max_diff_valor, 4)}")
+        if telemetry is not None:
+            telemetry.record_iteration(perf_counter() - inicio, max_diff_fairness, max_diff_valor,
+                                       max_diff_confiabilidad, grafo.number_of_edges(), 1)
 
-    return grafo, fairness, valor
+    return grafo, fairness, valor, it
 
 #############################
 
 class Rev2Graph:
     def __init__(self, ratings_list):
         # ratings list format -> [(f"U{r['user_uuid']}", f"S{r['service_uuid']}", float(r['rating'])) for r in results]
-        self.complete_graph = _generate_graph(_normalize_data(ratings_list))
-        self.components = _divide_components(self.complete_graph)
-        
-    def calculate(self, gamma1=0.5, gamma2=0.5, diff=0.01):
+        self.components = _component_graphs(build_rating_arrays(ratings_list))
         
+    def calculate(self, gamma1=0.5, gamma2=0.5, diff=0.01, telemetry=None):
+        # components are iterated one after the other, so every iteration recorded in telemetry belongs to a single component
         # with Pool(MAX_THREADS) as pool:
         #     results = pool.starmap(rev2_wrapper, [(component, gamma1, gamma2, diff) for component in self.components])
         fairness_results = {}
         # for _, fairness, _ in results:
         #     fairness_results.update(fairness)
+        self.iterations = []
         for component in self.components:
-            _, fairness, _ = rev2(component, gamma1, gamma2, diff)
+            _, fairness, _, iterations = rev2(component, gamma1, gamma2, diff, telemetry)
             fairness_results.update(fairness)
+            self.iterations.append(iterations)
             
         return fairness_results
+
+    def component_edges(self):
+        return [component.number_of_edges() for component in self.components]
+
+REV2_ENGINES = {
+    "networkx": Rev2Graph,
+    "sparse": SparseRev2Graph
+}
+
+def get_rev2_engine(engine=None):
+    engine = engine or DEFAULT_ENGINE
+    if engine not in REV2_ENGINES:
+        raise ValueError(f"Unknown Rev2 engine '{engine}' (valid engines: {', '.join(REV2_ENGINES)})")
+    return REV2_ENGINES[engine]
+    
+def calculate_fairness(rev2_graph, telemetry=None, **kwargs):
+    # the sparse engine spreads large graphs over the shared worker pool
+    if isinstance(rev2_graph, SparseRev2Graph) and WORKERS > 1:
+        pool = get_worker_pool()
+        if pool.is_worth_it(rev2_graph.edge_user, rev2_graph.user_component, rev2_graph.service_component, rev2_graph.edge_component):
+            kwargs["pool"] = pool
+    if telemetry is None:
+        engine = next((name for name, engine in REV2_ENGINES.items() if isinstance(rev2_graph, engine)), type(rev2_graph).__name__)
+        telemetry = Rev2RunTelemetry(engine, int(sum(rev2_graph.component_edges())), kwargs.get("gamma1", 0.5),
+                                     kwargs.get("gamma2", 0.5), kwargs.get("diff", 0.01))
+    try:
+        results = rev2_graph.calculate(telemetry=telemetry, **kwargs)
+    except Exception as e:
+        telemetry.fail(e)
+        get_run_history().append(telemetry)
+        raise
+    telemetry.finish(rev2_graph.iterations, rev2_graph.component_edges())
+    get_run_history().append(telemetry)
+    return results
+
+def warm_start_calculate(rev2_graph, accounts_manager, state_path=STATE_PATH):
+    # seeds fairness from the stored reviewer scores and only iterates the components that changed since the last run
+    previous_state = Rev2State.load(state_path)
+    stored_scores = accounts_manager.get_reviewer_scores([user[1:] for user in rev2_graph.users])
+    results = calculate_fairness(rev2_graph, previous_state=previous_state,
+                        seed_fairness={f"U{key}": value for key, value in stored_scores.items()})
+    if rev2_graph.state is not None:
+        rev2_graph.state.save(state_path)
+    return results
     
-def rev2_calculator():
-    services_lib = ServicesLib()
-    accounts_manager = Accounts()
+def recent_ratings(services_lib, max_delta_days):
+    """
+    Ratings of the last `max_delta_days` days for the engines, which consume them in a single pass.
+    With a client that pages them (`iter_recent_ratings`) the rating tuples are never all alive at once:
+    building the sparse engine from 1M ratings peaks at 133 MB streamed, 317 MB from a list.
+    Other clients return the whole list (`get_recent_ratings`).
+    """
+    iter_recent_ratings = getattr(services_lib, "iter_recent_ratings", None)
+    if iter_recent_ratings is not None:
+        return iter_recent_ratings(max_delta_days=max_delta_days)
+    return services_lib.get_recent_ratings(max_delta_days=max_delta_days) or []
+
+def rev2_update(rev2_engine, warm_start, services_lib, accounts_manager) -> bool:
+    # one full Rev2 update, False when there is nothing to calculate or the results could not be published
+    ratings = iter(recent_ratings(services_lib, RATINGS_WINDOW_DAYS))
+    first_rating = next(ratings, None)
+    if first_rating is None:
+        logger.info("No ratings found. Waiting for next update...")
+        return False
+    logger.info("Calculating...")
+    rev2_graph = rev2_engine(itertools.chain([first_rating], ratings))
+    # the graph keeps its own interned arrays, a list from the client is only referenced by the iterator
+    del ratings
+    if warm_start:
+        results = warm_start_calculate(rev2_graph, accounts_manager)
+    else:
+        results = calculate_fairness(rev2_graph)
+    # remove the prefix "U" from the keys
+    results = {key[1:]: value for key, value in results.items()}
+    # the published snapshot is authoritative, the run is over once it is published
+    if accounts_manager.save_rev2_snapshot(results) is None:
+        return False
+    # copy of the published scores in the accounts table for the per-account reads
+    accounts_manager.rev2_results_saver(results)
+    return True
+
+def create_rev2_scheduler(accounts_manager, services_lib, engine=None, warm_start=None) -> Rev2Scheduler:
+    rev2_engine = get_rev2_engine(engine)
+    warm_start = WARM_START if warm_start is None else warm_start
+    if warm_start and rev2_engine is not SparseRev2Graph:
+        logger.warning("Warm start is only supported by the sparse Rev2 engine, running full recomputations")
+        warm_start = False
+    return Rev2Scheduler(
+        run=lambda: rev2_update(rev2_engine, warm_start, services_lib, accounts_manager),
+        last_run=lambda: _last_rev2_run(accounts_manager),
+        count_new_ratings=lambda since, limit: _count_new_ratings(services_lib, since, limit),
+        lock=Rev2Lock(accounts_manager.engine)
+    )
+
+def rev2_calculator(engine=None, warm_start=None):
+    # standalone entry point, the API runs the same scheduler in a thread
     logger.basicConfig(format='%(levelname)s: %(asctime)s - [REV2] %(message)s',
                    stream=sys.stdout, level=logger.INFO)
-    next_update = datetime.datetime.now()
-    while True:
-        sleep_time = (next_update - datetime.datetime.now()).total_seconds()
-        logger.info(f"Next update in {sleep_time} seconds")
-        sleep(max(0, sleep_time))
-        ratings_list = services_lib.get_recent_ratings(max_delta_days=360)
-        if not ratings_list or len(ratings_list) == 0:
-            # print("[REV2] No ratings found. Waiting for next update...")
-            logger.info("No ratings found. Waiting for next update...")
-            continue
-        # print("[REV2] Calculating...")
-        logger.info("Calculating...")
-        rev2_graph = Rev2Graph(ratings_list)
-        results = rev2_graph.calculate()
-        # remove the prefix "U" from the keys
-        results = {key[1:]: value for key, value in results.items()}
-        accounts_manager.rev2_results_saver(results)
-        next_update = datetime.datetime.now() + datetime.timedelta(days=UPDATE_FREQUENCY)
+    create_rev2_scheduler(Accounts(), ServicesLib(), engine, warm_start).run_forever()
+
+def _last_rev2_run(accounts_manager):
+    # end of the last run: when its snapshot was published, unpublished (failed) snapshots are not listed
+    snapshots = accounts_manager.get_rev2_snapshots()
+    if not snapshots:
+        return None
+    return datetime.datetime.strptime(snapshots[0]["published_at"], '%Y-%m-%d %H:%M:%S')
+
+def _count_new_ratings(services_lib, since, limit):
+    # ratings saved after `since`, counting can stop at `limit` (the trigger)
+    count_recent_ratings = getattr(services_lib, "count_recent_ratings", None)
+    if count_recent_ratings is not None:
+        # counted by the services service on the rating timestamps, nothing is downloaded
+        return count_recent_ratings(since=since, limit=limit)
+    # clients without the count fetch whole days of ratings, so this may count up to one extra day of them
+    global _count_fallback_warned
+    if not _count_fallback_warned:
+        logger.warning("ServicesLib has no count_recent_ratings, the new ratings trigger downloads the recent ratings to count them")
+        _count_fallback_warned = True
+    days = max(1, math.ceil((datetime.datetime.now() - since).total_seconds() / (24 * 60 * 60)))
+    return sum(1 for _ in itertools.islice(services_lib.get_recent_ratings(max_delta_days=days) or [], limit))
             
+def _component_graphs(arrays):
+    # one graph per connected component, keeping every rating edge
+    score = arrays.normalized_rating().tolist()
+    edge_user = arrays.edge_user.tolist()
+    edge_service = arrays.edge_service.tolist()
+    offsets = arrays.edge_offsets().tolist()
+    components = []
+    for start, stop in zip(offsets[:-1], offsets[1:]):
+        component_graph = nx.Graph()
+        component_graph.add_edges_from((arrays.users[edge_user[i]], arrays.services[edge_service[i]], {'rating': score[i]})
+                                       for i in range(start, stop))
+        components.append(component_graph)
+    return components
+
+# Previous construction path (whole networkx graph split with a BFS that only copies tree edges).
+# It is no longer used by Rev2Graph and is kept as the baseline of lib/rev2_benchmark.py.
+
 def _divide_components(graph):
     components = []
     visited = set()
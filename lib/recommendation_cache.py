@@ -0,0 +1,82 @@
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Set, Tuple
+import logging as logger
+import os
+import threading
+import time
+
+CACHE_SIZE = int(os.getenv("RECOMMENDATIONS_CACHE_SIZE", 10_000))
+CACHE_TTL_SECONDS = float(os.getenv("RECOMMENDATIONS_CACHE_TTL_SECONDS", 15 * 60))
+CELL_DEGREES = float(os.getenv("RECOMMENDATIONS_CELL_DEGREES", 0.01))  # about 1 km
+
+
+class RecommendationCache:
+    """
+    LRU cache of folder recommendations keyed by (client_id, folder_name, location cell).
+    Locations are snapped to a grid of `cell_degrees`, so requests from the same area share the entry.
+    Entries expire after `ttl_seconds`, the least recently used ones are dropped past `max_entries`,
+    and `invalidate(client_id, folder_name)` drops every cell of a folder whose services changed
+    (subscribe it to `Favourites`).
+    """
+
+    def __init__(self, max_entries: int = CACHE_SIZE, ttl_seconds: float = CACHE_TTL_SECONDS,
+                 cell_degrees: float = CELL_DEGREES):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.cell_degrees = cell_degrees
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Tuple, Tuple[float, Dict]] = OrderedDict()
+        self._by_folder: Dict[Tuple[str, str], Set[Tuple]] = {}
+        self._lock = threading.Lock()
+
+    def key(self, client_id: str, folder_name: str, location: Dict[str, float]) -> Tuple:
+        cell = (round(location["longitude"] / self.cell_degrees), round(location["latitude"] / self.cell_degrees))
+        return (client_id, folder_name, cell)
+
+    def get(self, key: Tuple) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Tuple, recommendations: Dict):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, recommendations)
+            self._entries.move_to_end(key)
+            self._by_folder.setdefault(key[:2], set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, client_id: str, folder_name: str):
+        with self._lock:
+            keys = self._by_folder.pop((client_id, folder_name), set())
+            for key in keys:
+                self._entries.pop(key, None)
+        if keys:
+            logger.debug(f"Recommendations of {client_id}/{folder_name} invalidated ({len(keys)} cells)")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_folder.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def _remove(self, key: Hashable):
+        self._entries.pop(key, None)
+        folder_keys = self._by_folder.get(key[:2])
+        if folder_keys is not None:
+            folder_keys.discard(key)
+            if not folder_keys:
+                del self._by_folder[key[:2]]
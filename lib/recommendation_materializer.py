@@ -0,0 +1,99 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import datetime
+import logging as logger
+import os
+import time
+import uuid
+import zlib
+
+from lib.rev2_scheduler import Rev2Lock, Rev2Scheduler
+from lib.sparse_interest_prediction import CHUNK_SIZE, SparseInterestPredictor
+
+SCHEDULE = os.getenv("RECOMMENDATIONS_SCHEDULE", "0 4 * * *")  # every night, at 04:00
+MATERIALIZED_K = int(os.getenv("RECOMMENDATIONS_MATERIALIZED_K", 50))
+WORKERS = int(os.getenv("RECOMMENDATIONS_WORKERS", os.cpu_count() or 1))
+
+
+def client_shard(client_id: str, shards: int) -> int:
+    # stable across processes and restarts, unlike hash()
+    return zlib.crc32(client_id.encode()) % shards
+
+
+_worker_predictor: Optional[SparseInterestPredictor] = None
+
+def _init_worker(relations: List[Tuple[str, str]]):
+    global _worker_predictor
+    _worker_predictor = SparseInterestPredictor(relations)
+
+def _materialize_chunk(folders: List[Tuple[str, str]], k: int,
+                       predictor: Optional[SparseInterestPredictor] = None) -> List[Tuple[str, str, Dict[str, float]]]:
+    predictor = predictor if predictor is not None else _worker_predictor
+    predictions = predictor.get_interest_predictions([f"{client_id}_{folder_name}" for client_id, folder_name in folders], k)
+    return [(client_id, folder_name, predictions.get(f"{client_id}_{folder_name}", {})) for client_id, folder_name in folders]
+
+
+def materialize_recommendations(favourites_manager, k: int = MATERIALIZED_K, workers: int = WORKERS) -> int:
+    """
+    Computes the top `k` recommendations of every folder with saved services, over every saved service
+    (the request filters them by the services available around the client), and stores them with
+    `favourites_manager.save_recommendations`. Clients are split in shards scored by `workers` processes,
+    CHUNK_SIZE folders at a time, so the memory of a run does not depend on the number of folders.
+    Returns the number of materialized folders.
+    """
+    start = time.perf_counter()
+    run_id = str(uuid.uuid4())
+    # before the relations: a folder changed after this read is skipped when saving
+    versions = favourites_manager.get_folder_versions()
+    saved = favourites_manager.get_all_relations()
+    relations = [(f"{client_id}_{folder_name}", service_id) for client_id, folder_name, service_id in saved]
+    shards = max(1, workers)
+    folders_by_shard: List[List[Tuple[str, str]]] = [[] for _ in range(shards)]
+    for client_id, folder_name in dict.fromkeys((client_id, folder_name) for client_id, folder_name, _ in saved):
+        folders_by_shard[client_shard(client_id, shards)].append((client_id, folder_name))
+    folders_by_shard = [folders for folders in folders_by_shard if folders]
+    chunks = [folders[i:i + CHUNK_SIZE] for folders in folders_by_shard for i in range(0, len(folders), CHUNK_SIZE)]
+
+    materialized = 0
+    if workers <= 1 or len(folders_by_shard) <= 1:
+        predictor = SparseInterestPredictor(relations)
+        results = (_materialize_chunk(folders, k, predictor) for folders in chunks)
+        for recommendations in results:
+            if not favourites_manager.save_recommendations(run_id, recommendations, versions):
+                raise RuntimeError("Failed to save the recommendations")
+            materialized += len(recommendations)
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(folders_by_shard)), initializer=_init_worker,
+                                 initargs=(relations,)) as executor:
+            for recommendations in executor.map(_materialize_chunk, chunks, [k] * len(chunks)):
+                if not favourites_manager.save_recommendations(run_id, recommendations, versions):
+                    raise RuntimeError("Failed to save the recommendations")
+                materialized += len(recommendations)
+    if not favourites_manager.finish_recommendations_run(run_id, materialized):
+        raise RuntimeError("Failed to record the recommendations run")
+    logger.info(f"Recommendations of {materialized} folders materialized in {time.perf_counter() - start:.2f}s")
+    return materialized
+
+
+def create_recommendations_scheduler(favourites_manager, engine, k: int = MATERIALIZED_K,
+                                     workers: int = WORKERS, schedule: str = SCHEDULE) -> Rev2Scheduler:
+    # same single-flight scheduling as Rev2, with its own lock
+    def run() -> bool:
+        materialize_recommendations(favourites_manager, k, workers)
+        return True
+
+    return Rev2Scheduler(
+        run=run,
+        last_run=lambda: _last_recommendations_run(favourites_manager),
+        count_new_ratings=lambda since, limit: 0,
+        lock=Rev2Lock(engine, name="recommendations"),
+        schedule=schedule,
+        ratings_trigger=0,
+        name="Recommendations"
+    )
+
+def _last_recommendations_run(favourites_manager) -> Optional[datetime.datetime]:
+    run = favourites_manager.get_last_recommendations_run()
+    if run is None:
+        return None
+    return datetime.datetime.strptime(run["finished_at"], '%Y-%m-%d %H:%M:%S')
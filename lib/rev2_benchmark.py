@@ -0,0 +1,375 @@
+"""
+Rev2 benchmarks, printed as JSON so results can be compared between releases.
+Run from the api container root (/code), e.g.:
+    python -m lib.rev2_benchmark suite --presets small fraud
+    python -m lib.rev2_benchmark run --engines sparse networkx --users 2000 --services 200 --ratings 10000
+    python -m lib.rev2_benchmark construction --ratings 1000000
+    python -m lib.rev2_benchmark sweep --gamma1 0.2 0.5 0.8 --workers 3
+Every case runs in its own process, so peak RSS belongs to that case only.
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from queue import Empty
+from typing import List, Tuple
+
+import numpy as np
+
+MEGABYTE = 1024 * 1024
+REPORT_VERSION = 1
+CASE_TIMEOUT = int(os.getenv("REV2_BENCHMARK_TIMEOUT", 4 * 60 * 60))  # seconds
+
+PRESETS = {
+    "small": {"users": 2_000, "services": 200, "ratings": 10_000, "components": 1, "skew": 1.0},
+    "medium": {"users": 50_000, "services": 5_000, "ratings": 300_000, "components": 1, "skew": 1.0},
+    "large": {"users": 200_000, "services": 20_000, "ratings": 1_000_000, "components": 1, "skew": 1.1},
+    "fragmented": {"users": 100_000, "services": 20_000, "ratings": 300_000, "components": 5_000, "skew": 0.5},
+    "fraud": {"users": 20_000, "services": 2_000, "ratings": 100_000, "components": 1, "skew": 1.0,
+              "fraud_rings": 20, "ring_size": 15, "ring_targets": 3},
+}
+
+
+def generate_ratings(users: int, services: int, ratings: int, components: int = 1, skew: float = 1.0,
+                     fraud_rings: int = 0, ring_size: int = 10, ring_targets: int = 3,
+                     seed: int = 0) -> Tuple[List[Tuple[str, str, float]], List[str]]:
+    """
+    Synthetic ratings in the Rev2Graph input format, (f"U{user}", f"S{service}", rating) with ratings in [0, 5].
+    - components: users and services are split in this many disjoint blocks (sparse blocks may split further)
+    - skew: power-law exponent of user activity and service popularity inside a block (0 = uniform)
+    - fraud_rings: groups of `ring_size` extra users that give 5 to `ring_targets` services of a block
+      and 0 to its most popular ones
+    Honest users rate around a hidden quality of each service.
+    Returns (ratings_list, fraud_users).
+    """
+    rng = np.random.default_rng(seed)
+    components = max(1, min(components, users, services))
+    user_blocks = np.array_split(np.arange(users), components)
+    service_blocks = np.array_split(np.arange(services), components)
+    quality = rng.integers(0, 6, services)
+    per_component = rng.multinomial(ratings, [len(block) / users for block in user_blocks])
+
+    edge_user = []
+    edge_service = []
+    for user_block, service_block, count in zip(user_blocks, service_blocks, per_component):
+        edge_user.append(rng.choice(user_block, count, p=_power_law(len(user_block), skew)))
+        edge_service.append(rng.choice(service_block, count, p=_power_law(len(service_block), skew)))
+    edge_user = np.concatenate(edge_user)
+    edge_service = np.concatenate(edge_service)
+    rating = np.clip(np.rint(quality[edge_service] + rng.normal(0, 0.7, len(edge_service))), 0, 5)
+    ratings_list = [(f"U{u}", f"S{s}", float(r)) for u, s, r in zip(edge_user.tolist(), edge_service.tolist(), rating.tolist())]
+
+    fraud_users = []
+    for ring in range(fraud_rings):
+        service_block = service_blocks[rng.integers(components)]
+        targets = rng.choice(service_block, min(ring_targets, len(service_block)), replace=False)
+        popular = service_block[:ring_targets]
+        for member in range(ring_size):
+            user = f"Ufraud{ring}_{member}"
+            fraud_users.append(user)
+            ratings_list.extend((user, f"S{service}", 5.0) for service in targets.tolist())
+            ratings_list.extend((user, f"S{service}", 0.0) for service in popular.tolist() if service not in targets)
+    return ratings_list, fraud_users
+
+
+def _power_law(size: int, skew: float) -> np.ndarray:
+    weights = 1 / np.arange(1, size + 1) ** skew
+    return weights / weights.sum()
+
+
+def _current_rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / MEGABYTE
+    except OSError:
+        return _peak_rss_mb()
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / MEGABYTE if sys.platform == 'darwin' else peak / 1024
+
+
+class _Timer:
+    def __init__(self):
+        self.phases = {}
+
+    def phase(self, name):
+        timer = self
+
+        class _Phase:
+            def __enter__(self):
+                self.start = time.perf_counter()
+
+            def __exit__(self, *exc):
+                timer.phases[name] = round(time.perf_counter() - self.start, 4)
+        return _Phase()
+
+
+def _iterate_sparse(ratings_list, workers, timer):
+    from lib.rev2_graph_builder import build_rating_arrays
+    from lib.sparse_rev2 import sparse_rev2
+    with timer.phase("construction"):
+        arrays = build_rating_arrays(ratings_list)
+    with timer.phase("normalization"):
+        score = arrays.normalized_rating()
+    with timer.phase("iteration"):
+        run = sparse_rev2
+        if workers > 1:
+            from lib.rev2_workers import Rev2WorkerPool
+            pool = Rev2WorkerPool(workers=workers)
+            run = pool.run
+        fairness, _, _, iterations = run(arrays.edge_user, arrays.edge_service, score, arrays.user_component,
+                                         arrays.service_component, arrays.edge_component, 0.5, 0.5, 0.01)
+        if workers > 1:
+            pool.close()
+    return dict(zip(arrays.users, fairness.tolist())), iterations.tolist(), arrays.n_components, len(score)
+
+
+def _iterate_networkx(ratings_list, workers, timer):
+    from lib.new_rev2 import Rev2Graph
+    with timer.phase("construction"):
+        # normalization happens while building the component graphs
+        graph = Rev2Graph(ratings_list)
+    timer.phases["normalization"] = None
+    with timer.phase("iteration"):
+        results = graph.calculate()
+    return results, graph.iterations, len(graph.components), sum(c.number_of_edges() for c in graph.components)
+
+
+ENGINES = {
+    "sparse": _iterate_sparse,
+    "networkx": _iterate_networkx
+}
+
+
+def _persist(results, timer):
+    from sqlalchemy import create_engine
+    from accounts_sql import Accounts
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'benchmark.db')}")
+        accounts = Accounts(engine=engine)
+        uuids = [user[1:] for user in results]
+        with engine.begin() as connection:
+            connection.execute(accounts.accounts.insert(), [
+                {"uuid": uuid, "username": uuid, "email": f"{uuid}@benchmark", "is_provider": False} for uuid in uuids
+            ])
+        with timer.phase("persistence"):
+            accounts.rev2_results_saver({user[1:]: value for user, value in results.items()})
+        engine.dispose()
+
+
+def _rev2_case(engine, spec, workers, persist, queue):
+    ratings_list, fraud_users = generate_ratings(**spec)
+    baseline_rss = _current_rss_mb()
+    timer = _Timer()
+    start = time.perf_counter()
+    results, iterations, n_components, n_edges = ENGINES[engine](ratings_list, workers, timer)
+    if persist:
+        _persist(results, timer)
+    elapsed = time.perf_counter() - start
+    peak_rss = _peak_rss_mb()
+
+    fraud = set(fraud_users)
+    fraud_scores = [value for user, value in results.items() if user in fraud]
+    honest_scores = [value for user, value in results.items() if user not in fraud]
+    queue.put({
+        "engine": engine,
+        "workers": workers,
+        "graph": {"ratings": len(ratings_list), "edges": n_edges, "users": len(results), "components": n_components},
+        "seconds": {"total": round(elapsed, 4), **timer.phases},
+        "iterations": {"max": max(iterations, default=0), "mean": round(float(np.mean(iterations)), 2) if len(iterations) else 0,
+                       "edges_per_second": round(n_edges * max(iterations, default=0) / timer.phases["iteration"], 1)
+                       if timer.phases["iteration"] else None},
+        "memory_mb": {"baseline_rss": round(baseline_rss, 1), "peak_rss": round(peak_rss, 1),
+                      "run_rss": round(peak_rss - baseline_rss, 1)},
+        "fairness": {"honest_mean": round(float(np.mean(honest_scores)), 4) if honest_scores else None,
+                     "fraud_mean": round(float(np.mean(fraud_scores)), 4) if fraud_scores else None},
+    })
+
+
+def _build_networkx_bfs(ratings_list):
+    from lib.new_rev2 import _divide_components, _generate_graph, _normalize_data
+    return _divide_components(_generate_graph(_normalize_data(ratings_list)))
+
+
+def _build_union_find(ratings_list):
+    from lib.new_rev2 import Rev2Graph
+    return Rev2Graph(ratings_list).components
+
+
+def _build_arrays(ratings_list):
+    from lib.rev2_graph_builder import build_rating_arrays
+    return build_rating_arrays(ratings_list)
+
+
+CONSTRUCTION_PATHS = {
+    "networkx_bfs": _build_networkx_bfs,  # previous Rev2Graph construction
+    "union_find": _build_union_find,  # current Rev2Graph construction
+    "arrays": _build_arrays  # sparse engine construction
+}
+
+
+def _construction_case(path, spec, queue):
+    ratings_list, _ = generate_ratings(**spec)
+    baseline_rss = _current_rss_mb()
+    start = time.perf_counter()
+    CONSTRUCTION_PATHS[path](ratings_list)
+    elapsed = time.perf_counter() - start
+    peak_rss = _peak_rss_mb()
+    queue.put({"path": path, "seconds": round(elapsed, 3), "baseline_rss_mb": round(baseline_rss, 1),
+               "peak_rss_mb": round(peak_rss, 1), "construction_rss_mb": round(peak_rss - baseline_rss, 1)})
+
+
+def _sweep_case(grid, workers, spec, queue):
+    from lib.rev2_sweep import rev2_sweep
+    from lib.sparse_rev2 import SparseRev2Graph
+    if "fork" in multiprocessing.get_all_start_methods():
+        # the case process is spawned, but the API starts its pools with the Linux default (fork)
+        multiprocessing.set_start_method("fork", force=True)
+    ratings_list, _ = generate_ratings(**spec)
+    start = time.perf_counter()
+    sweep = rev2_sweep(SparseRev2Graph(ratings_list), grid, workers=workers)
+    sweep_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for gamma1, gamma2 in grid:
+        # what each setting costs today: build the graph again and run it
+        SparseRev2Graph(ratings_list).calculate(gamma1, gamma2)
+    separate_seconds = time.perf_counter() - start
+    queue.put({"workers": workers, "seconds": {"sweep": round(sweep_seconds, 4), "separate_runs": round(separate_seconds, 4)},
+               "settings": sweep["settings"], "rank_correlation": sweep["rank_correlation"]})
+
+
+def _run_isolated(target, *args, timeout=CASE_TIMEOUT) -> dict:
+    # a case that dies (e.g. OOM killed) or hangs is reported as an error instead of blocking the run
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=target, args=(*args, queue))
+    process.start()
+    deadline = time.monotonic() + timeout
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=1)
+        except Empty:
+            if not process.is_alive() and queue.empty():
+                break
+            if time.monotonic() > deadline:
+                process.kill()
+                break
+    process.join()
+    if result is None:
+        if process.exitcode is not None and process.exitcode < 0:
+            return {"error": f"case process killed by signal {-process.exitcode}"}
+        if time.monotonic() > deadline:
+            return {"error": f"case timed out after {timeout} seconds"}
+        return {"error": f"case process exited with code {process.exitcode}"}
+    return result
+
+
+def rev2_benchmark(spec: dict, engines=("sparse",), workers=1, persist=True) -> List[dict]:
+    return [{"spec": spec, "engine": engine, **_run_isolated(_rev2_case, engine, spec, workers, persist)}
+            for engine in engines]
+
+
+def construction_benchmark(spec: dict, paths=None) -> List[dict]:
+    return [{"spec": spec, "path": path, **_run_isolated(_construction_case, path, spec)}
+            for path in paths or CONSTRUCTION_PATHS]
+
+
+def sweep_benchmark(spec: dict, grid, workers=1) -> List[dict]:
+    return [{"spec": spec, **_run_isolated(_sweep_case, grid, workers, spec)}]
+
+
+def _report(benchmark, results) -> dict:
+    return {
+        "version": REPORT_VERSION,
+        "benchmark": benchmark,
+        "created_at": datetime.datetime.now().isoformat(timespec='seconds'),
+        "platform": {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+                     "cpus": os.cpu_count()},
+        "results": results,
+    }
+
+
+def _add_spec_arguments(parser, defaults):
+    parser.add_argument("--users", type=int, default=defaults["users"])
+    parser.add_argument("--services", type=int, default=defaults["services"])
+    parser.add_argument("--ratings", type=int, default=defaults["ratings"])
+    parser.add_argument("--components", type=int, default=defaults.get("components", 1))
+    parser.add_argument("--skew", type=float, default=defaults.get("skew", 1.0))
+    parser.add_argument("--fraud-rings", type=int, default=0)
+    parser.add_argument("--ring-size", type=int, default=10)
+    parser.add_argument("--ring-targets", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def _spec(args) -> dict:
+    return {"users": args.users, "services": args.services, "ratings": args.ratings, "components": args.components,
+            "skew": args.skew, "fraud_rings": args.fraud_rings, "ring_size": args.ring_size,
+            "ring_targets": args.ring_targets, "seed": args.seed}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    suite = subparsers.add_parser("suite", help="run preset scenarios")
+    suite.add_argument("--presets", nargs="+", choices=list(PRESETS), default=["small", "fragmented", "fraud"])
+    suite.add_argument("--engines", nargs="+", choices=list(ENGINES), default=["sparse"])
+    suite.add_argument("--workers", type=int, default=1)
+    suite.add_argument("--no-persist", action="store_true")
+
+    run = subparsers.add_parser("run", help="run one custom scenario")
+    _add_spec_arguments(run, PRESETS["small"])
+    run.add_argument("--engines", nargs="+", choices=list(ENGINES), default=["sparse"])
+    run.add_argument("--workers", type=int, default=1)
+    run.add_argument("--no-persist", action="store_true")
+
+    construction = subparsers.add_parser("construction", help="Rev2 graph construction time and peak RSS")
+    _add_spec_arguments(construction, {"users": 200_000, "services": 20_000, "ratings": 1_000_000, "skew": 0.0})
+    construction.add_argument("--paths", nargs="+", choices=list(CONSTRUCTION_PATHS))
+
+    sweep = subparsers.add_parser("sweep", help="gamma sweep on one graph against separate runs")
+    _add_spec_arguments(sweep, PRESETS["medium"])
+    sweep.add_argument("--gamma1", nargs="+", type=float, default=[0.2, 0.35, 0.5, 0.65, 0.8],
+                       help="gamma2 is 1 - gamma1 unless --gamma2 is given")
+    sweep.add_argument("--gamma2", nargs="+", type=float)
+    sweep.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    if args.benchmark == "suite":
+        results = []
+        for preset in args.presets:
+            spec = {**PRESETS[preset]}
+            results.extend({"preset": preset, **result}
+                           for result in rev2_benchmark(spec, args.engines, args.workers, not args.no_persist))
+    elif args.benchmark == "run":
+        results = rev2_benchmark(_spec(args), args.engines, args.workers, not args.no_persist)
+    elif args.benchmark == "construction":
+        results = construction_benchmark(_spec(args), args.paths)
+    else:
+        if args.gamma2 is None:
+            grid = [(gamma1, 1 - gamma1) for gamma1 in args.gamma1]
+        else:
+            grid = [(gamma1, gamma2) for gamma1 in args.gamma1 for gamma2 in args.gamma2]
+        results = sweep_benchmark(_spec(args), grid, args.workers)
+
+    report = json.dumps(_report(args.benchmark, results), indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+from array import array
+from itertools import islice
+from typing import Iterable, List, Tuple
+import numpy as np
+
+USER_INDEX = 0
+SERVICE_INDEX = 1
+RATING_INDEX = 2
+CHUNK_SIZE = 100_000
+
+
+class RatingArrays:
+    """
+    Bipartite rating graph stored as integer-interned arrays, grouped by connected component.
+    Fields:
+    - users (List[str]) / services (List[str]): node ids, sorted by component
+    - edge_user, edge_service (np.ndarray[int64]): positions in `users` / `services` of every rating edge
+    - rating (np.ndarray[float64]): raw rating of every edge
+    - user_component, service_component, edge_component (np.ndarray[int64]): component of every node/edge (sorted)
+    - min_rating / max_rating (float): bounds over every received rating, repeated ones included
+    A repeated (user, service) pair keeps its last rating, like a networkx graph does.
+    """
+
+    def __init__(self, users, services, edge_user, edge_service, rating, user_component, service_component,
+                 edge_component, n_components, min_rating, max_rating):
+        self.users = users
+        self.services = services
+        self.edge_user = edge_user
+        self.edge_service = edge_service
+        self.rating = rating
+        self.user_component = user_component
+        self.service_component = service_component
+        self.edge_component = edge_component
+        self.n_components = n_components
+        self.min_rating = min_rating
+        self.max_rating = max_rating
+
+    def normalized_rating(self) -> np.ndarray:
+        if len(self.rating) == 0:
+            return self.rating
+        if self.max_rating == self.min_rating:
+            # every rating is the same, so they all agree: map them to the middle of the scale instead of 0/0
+            return np.zeros_like(self.rating)
+        return 2 * (self.rating - self.min_rating) / (self.max_rating - self.min_rating) - 1
+
+    def edge_offsets(self) -> np.ndarray:
+        # start of each component in the edge arrays, plus the total edge count
+        return np.searchsorted(self.edge_component, np.arange(self.n_components + 1))
+
+    def component_edges(self, component: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        start, stop = np.searchsorted(self.edge_component, [component, component + 1])
+        return self.edge_user[start:stop], self.edge_service[start:stop], self.rating[start:stop]
+
+
+def build_rating_arrays(ratings: Iterable[Tuple[str, str, float]], chunk_size: int = CHUNK_SIZE) -> RatingArrays:
+    # `ratings` can be a list or any iterator (e.g. a database cursor), it is consumed once
+    users, services, edge_user, edge_service, rating, min_rating, max_rating = intern_ratings(ratings, chunk_size)
+    labels, n_components = union_find_components(edge_user, edge_service, len(users), len(services))
+    user_component = labels[:len(users)]
+    service_component = labels[len(users):]
+
+    user_order = np.argsort(user_component, kind='stable')
+    service_order = np.argsort(service_component, kind='stable')
+    user_position = np.empty_like(user_order)
+    user_position[user_order] = np.arange(len(user_order))
+    service_position = np.empty_like(service_order)
+    service_position[service_order] = np.arange(len(service_order))
+
+    edge_order = np.argsort(user_component[edge_user], kind='stable')
+    edge_user = user_position[edge_user[edge_order]]
+    edge_service = service_position[edge_service[edge_order]]
+    user_component = user_component[user_order]
+    return RatingArrays([users[i] for i in user_order], [services[i] for i in service_order], edge_user, edge_service,
+                        rating[edge_order], user_component, service_component[service_order],
+                        user_component[edge_user], n_components, min_rating, max_rating)
+
+
+def intern_ratings(ratings, chunk_size: int = CHUNK_SIZE):
+    """
+    Single pass over the ratings, `chunk_size` at a time: ids are interned to integers as they arrive,
+    the edges are appended to typed buffers and the rating bounds are updated chunk by chunk,
+    so at most one chunk of rating tuples is alive besides the source.
+    """
+    user_ids = {}
+    service_ids = {}
+    edge_user = array('q')
+    edge_service = array('q')
+    rating = array('d')
+    min_rating = max_rating = None
+    ratings = iter(ratings)
+    while True:
+        chunk = list(islice(ratings, chunk_size))
+        if not chunk:
+            break
+        edge_user.extend(user_ids.setdefault(r[USER_INDEX], len(user_ids)) for r in chunk)
+        edge_service.extend(service_ids.setdefault(r[SERVICE_INDEX], len(service_ids)) for r in chunk)
+        chunk_rating = np.fromiter((r[RATING_INDEX] for r in chunk), dtype=np.float64, count=len(chunk))
+        rating.frombytes(chunk_rating.tobytes())
+        min_rating = float(chunk_rating.min()) if min_rating is None else min(min_rating, float(chunk_rating.min()))
+        max_rating = float(chunk_rating.max()) if max_rating is None else max(max_rating, float(chunk_rating.max()))
+
+    count = len(edge_user)
+    edge_user = np.frombuffer(edge_user, dtype=np.int64)
+    edge_service = np.frombuffer(edge_service, dtype=np.int64)
+    rating = np.frombuffer(rating, dtype=np.float64)
+    keys = edge_user * max(1, len(service_ids)) + edge_service
+    _, last = np.unique(keys[::-1], return_index=True)
+    keep = np.sort(count - 1 - last)
+    return list(user_ids), list(service_ids), edge_user[keep], edge_service[keep], rating[keep], min_rating, max_rating
+
+
+def union_find_components(edge_user, edge_service, n_users, n_services) -> Tuple[np.ndarray, int]:
+    """
+    Labels the connected components of the bipartite graph. Node i < n_users is user i, the
+    rest are services. Union by size with path halving, a single pass over the edges.
+    """
+    parent = list(range(n_users + n_services))
+    size = [1] * (n_users + n_services)
+
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for user, service in zip(edge_user.tolist(), (edge_service + n_users).tolist()):
+        user_root = find(user)
+        service_root = find(service)
+        if user_root == service_root:
+            continue
+        if size[user_root] < size[service_root]:
+            user_root, service_root = service_root, user_root
+        parent[service_root] = user_root
+        size[user_root] += size[service_root]
+
+    roots = np.fromiter((find(node) for node in range(n_users + n_services)), dtype=np.int64, count=n_users + n_services)
+    unique_roots, labels = np.unique(roots, return_inverse=True)
+    return labels, len(unique_roots)
@@ -0,0 +1,169 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+import datetime
+import itertools
+import logging as logger
+import os
+import threading
+import uuid
+
+from lib.new_rev2 import calculate_fairness, get_rev2_engine, DEFAULT_ENGINE, RATINGS_WINDOW_DAYS
+from lib.rev2_telemetry import Rev2RunTelemetry
+
+JOB_WORKERS = int(os.getenv("REV2_JOB_WORKERS", 1))
+CACHED_RESULTS = int(os.getenv("REV2_CACHED_RESULTS", 4))
+MAX_JOBS = 100
+
+
+class Rev2Job:
+    """
+    On-demand Rev2 run executed in the background.
+    Fields:
+    - job_id: str
+    - key: tuple: (engine, ratings window in days, window end date, gamma1, gamma2, diff), the cache key of the results
+    - status: str: queued | running | finished | failed | expired (finished, its results were evicted from the cache)
+    - progress: dict: current stage and convergence of the iteration so far
+    - results: dict: {uuid: fairness} sorted by fairness, once finished
+    """
+
+    def __init__(self, key: Tuple):
+        self.job_id = str(uuid.uuid4())
+        self.key = key
+        self.status = "queued"
+        self.progress = {"stage": "queued"}
+        self.results: Optional[Dict[str, float]] = None
+        self.error = None
+        self.run_id = None
+        self.created_at = datetime.datetime.now().isoformat(timespec='seconds')
+        self.finished_at = None
+
+    def summary(self, with_results: bool = False) -> Dict:
+        engine, window_days, window_end, gamma1, gamma2, diff = self.key
+        summary = {
+            "job_id": self.job_id,
+            "status": self.status,
+            "engine": engine,
+            "window": {"days": window_days, "end": window_end},
+            "params": {"gamma1": gamma1, "gamma2": gamma2, "diff": diff},
+            "progress": self.progress,
+            "error": self.error,
+            "run_id": self.run_id,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at
+        }
+        if with_results and self.status == "finished":
+            summary["results"] = self.results
+        return summary
+
+
+class Rev2JobManager:
+    """
+    Runs Rev2 requests on a small thread pool so they never hold a request worker.
+    Jobs with the same key (ratings window, day and parameters) are single-flight: while one is queued
+    or running it is returned instead of starting another, and the last `cached_results` finished
+    keys are served from memory until the day (the end of the ratings window) changes.
+    `fetch_ratings(max_delta_days)` returns the ratings the engines are built from, any iterable (see new_rev2.recent_ratings).
+    """
+
+    def __init__(self, fetch_ratings: Callable[[int], Iterable], workers: int = JOB_WORKERS, cached_results: int = CACHED_RESULTS):
+        self.fetch_ratings = fetch_ratings
+        self.cached_results = cached_results
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="rev2-job")
+        self._jobs: OrderedDict[str, Rev2Job] = OrderedDict()
+        self._by_key: OrderedDict[Tuple, Rev2Job] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, engine: Optional[str] = None, max_delta_days: int = RATINGS_WINDOW_DAYS,
+            gamma1=0.5, gamma2=0.5, diff=0.01) -> Tuple:
+        get_rev2_engine(engine)  # raises ValueError on unknown engines
+        return (engine or DEFAULT_ENGINE, max_delta_days, datetime.date.today().isoformat(),
+                float(gamma1), float(gamma2), float(diff))
+
+    def cached(self, key: Tuple) -> Optional[Rev2Job]:
+        with self._lock:
+            job = self._by_key.get(key)
+            return job if job is not None and job.status == "finished" else None
+
+    def submit(self, key: Tuple) -> Rev2Job:
+        with self._lock:
+            job = self._by_key.get(key)
+            if job is not None and job.status != "failed":
+                self._by_key.move_to_end(key)
+                return job
+            job = Rev2Job(key)
+            self._jobs[job.job_id] = job
+            self._by_key[key] = job
+            self._evict()
+        self._executor.submit(self._run, job)
+        logger.info(f"Rev2 job {job.job_id} queued")
+        return job
+
+    def get(self, job_id: str) -> Optional[Rev2Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, job: Rev2Job):
+        engine, max_delta_days, _, gamma1, gamma2, diff = job.key
+        job.status = "running"
+        try:
+            job.progress = {"stage": "fetching ratings"}
+            ratings_iterator = iter(self.fetch_ratings(max_delta_days))
+            first_rating = next(ratings_iterator, None)
+            if first_rating is None:
+                raise ValueError("No ratings found")
+            job.progress = {"stage": "building graph"}
+            counted = _Counted(itertools.chain([first_rating], ratings_iterator))
+            rev2_graph = get_rev2_engine(engine)(counted)
+            ratings = counted.count
+            # a list from the client is only referenced by the iterator
+            del ratings_iterator, counted
+            telemetry = Rev2RunTelemetry(engine, int(sum(rev2_graph.component_edges())), gamma1, gamma2, diff)
+            telemetry.subscribe(lambda t: self._update_progress(job, t))
+            job.run_id = telemetry.run_id
+            results = calculate_fairness(rev2_graph, telemetry=telemetry, gamma1=gamma1, gamma2=gamma2, diff=diff)
+            job.results = dict(sorted(((key[1:], value) for key, value in results.items()), key=lambda item: item[1]))
+            job.progress = {"stage": "done", "ratings": ratings, "iterations": len(telemetry.iterations),
+                            "tasks": len(telemetry.tasks)}
+            job.status = "finished"
+        except Exception as e:
+            logger.error(f"Rev2 job {job.job_id} failed: {e}")
+            job.error = str(e)
+            job.status = "failed"
+        job.finished_at = datetime.datetime.now().isoformat(timespec='seconds')
+
+    def _update_progress(self, job: Rev2Job, telemetry: Rev2RunTelemetry):
+        progress = {"stage": "iterating", "iterations": len(telemetry.iterations), "tasks": len(telemetry.tasks)}
+        if telemetry.iterations:
+            last = telemetry.iterations[-1]
+            progress.update({key: last[key] for key in ("max_diff_fairness", "max_diff_goodness", "max_diff_reliability", "active_components")})
+        job.progress = progress
+
+    def _evict(self):
+        # keeps the last `cached_results` finished keys and `MAX_JOBS` jobs, never dropping queued or running ones
+        finished = [key for key, job in self._by_key.items() if job.status in ("finished", "failed")]
+        for key in finished[:max(0, len(finished) - self.cached_results)]:
+            job = self._by_key.pop(key)
+            if job.status == "finished":
+                job.status = "expired"
+                job.results = None
+        while len(self._jobs) > MAX_JOBS:
+            job_id, job = next(iter(self._jobs.items()))
+            if job.status in ("queued", "running"):
+                break
+            del self._jobs[job_id]
+
+
+class _Counted:
+    # iterates `ratings` once counting them, the engines consume them in a single pass
+    def __init__(self, ratings: Iterator):
+        self.ratings = ratings
+        self.count = 0
+
+    def __iter__(self):
+        for rating in self.ratings:
+            self.count += 1
+            yield rating
@@ -0,0 +1,237 @@
+from typing import Callable, Optional
+import datetime
+import logging as logger
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+
+from sqlalchemy import Column, Float, MetaData, String, Table, or_
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+SCHEDULE = os.getenv("REV2_SCHEDULE", "0 3 1,16 * *")  # twice a month, at 03:00
+RATINGS_TRIGGER = int(os.getenv("REV2_RATINGS_TRIGGER", 0))  # 0 disables the early runs
+POLL_SECONDS = int(os.getenv("REV2_POLL_SECONDS", 600))
+BASE_BACKOFF_SECONDS = int(os.getenv("REV2_BASE_BACKOFF_SECONDS", 60))
+MAX_BACKOFF_SECONDS = int(os.getenv("REV2_MAX_BACKOFF_SECONDS", 6 * 60 * 60))
+LOCK_LEASE_SECONDS = int(os.getenv("REV2_LOCK_LEASE_SECONDS", 6 * 60 * 60))
+MAX_SEARCHED_DAYS = 4 * 366
+
+
+class CronSchedule:
+    """
+    Five field cron expression: minute hour day-of-month month day-of-week (0 or 7 is Sunday).
+    Every field accepts *, numbers, ranges (a-b), lists (a,b) and steps (*/n, a-b/n, a/n).
+    As in cron, when both day fields are restricted a day matching either of them is due.
+    """
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Invalid cron expression '{expression}': expected 5 fields")
+        self.expression = expression
+        self.minutes = sorted(self._parse(fields[0], 0, 59))
+        self.hours = sorted(self._parse(fields[1], 0, 23))
+        self.days = self._parse(fields[2], 1, 31)
+        self.months = self._parse(fields[3], 1, 12)
+        self.weekdays = {weekday % 7 for weekday in self._parse(fields[4], 0, 7)}
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+
+    @staticmethod
+    def _parse(field: str, low: int, high: int) -> set:
+        values = set()
+        for part in field.split(","):
+            value_range, _, step = part.partition("/")
+            try:
+                step = int(step) if step else 1
+                if value_range == "*":
+                    start, stop = low, high
+                elif "-" in value_range:
+                    start, stop = (int(value) for value in value_range.split("-", 1))
+                else:
+                    start = int(value_range)
+                    stop = high if "/" in part else start
+            except ValueError:
+                raise ValueError(f"Invalid cron field '{field}'")
+            if start < low or stop > high or start > stop or step < 1:
+                raise ValueError(f"Invalid cron field '{field}': values must be in [{low}, {high}]")
+            values.update(range(start, stop + 1, step))
+        return values
+
+    def _day_matches(self, day: datetime.date) -> bool:
+        if day.month not in self.months:
+            return False
+        day_match = day.day in self.days
+        weekday_match = (day.weekday() + 1) % 7 in self.weekdays
+        if self._any_day and self._any_weekday:
+            return True
+        if self._any_day:
+            return weekday_match
+        if self._any_weekday:
+            return day_match
+        return day_match or weekday_match
+
+    def next_after(self, moment: datetime.datetime) -> datetime.datetime:
+        start = moment.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        for offset in range(MAX_SEARCHED_DAYS):
+            day = start.date() + datetime.timedelta(days=offset)
+            if not self._day_matches(day):
+                continue
+            for hour in self.hours:
+                for minute in self.minutes:
+                    candidate = datetime.datetime.combine(day, datetime.time(hour, minute))
+                    if candidate >= start:
+                        return candidate
+        raise ValueError(f"Cron expression '{self.expression}' never matches")
+
+
+class Rev2Lock:
+    """
+    Lease held in a database row so only one API replica computes Rev2 at a time.
+    A lease left behind by a crashed replica expires after `lease_seconds`.
+    """
+
+    def __init__(self, engine, name: str = "rev2", lease_seconds: int = LOCK_LEASE_SECONDS):
+        self.engine = engine
+        self.name = name
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        metadata = MetaData()
+        self.locks = Table(
+            'rev2_locks',
+            metadata,
+            Column('name', String, primary_key=True),
+            Column('owner', String),
+            Column('expires_at', Float)
+        )
+        metadata.create_all(self.engine)
+
+    def acquire(self) -> bool:
+        now = time.time()
+        try:
+            with self.engine.begin() as connection:
+                query = self.locks.update().where(self.locks.c.name == self.name).\
+                    where(or_(self.locks.c.expires_at < now, self.locks.c.owner == self.owner)).\
+                    values(owner=self.owner, expires_at=now + self.lease_seconds)
+                if connection.execute(query).rowcount:
+                    return True
+                connection.execute(self.locks.insert().values(name=self.name, owner=self.owner, expires_at=now + self.lease_seconds))
+            return True
+        except IntegrityError:
+            # held by another replica
+            return False
+        except SQLAlchemyError as e:
+            logger.error(f"SQLAlchemyError: {e}")
+            return False
+
+    def release(self):
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(self.locks.delete().where(self.locks.c.name == self.name).where(self.locks.c.owner == self.owner))
+        except SQLAlchemyError as e:
+            logger.error(f"SQLAlchemyError: {e}")
+
+
+class Rev2Scheduler:
+    """
+    Runs `run()` on the cron `schedule`, or earlier once `count_new_ratings(since, limit)` reaches `ratings_trigger`
+    (it is given the trigger as `limit`, so it can stop counting there).
+    - run: () -> bool: one Rev2 update, False when there was nothing to compute (no ratings)
+    - last_run: () -> Optional[datetime]: end of the last successful run, shared by every replica
+    - lock: Rev2Lock: single-flight across replicas
+    Empty or failed runs are retried with exponential backoff and jitter instead of waiting for the next slot.
+    `name` only labels the thread and the logs, so other periodic jobs can be scheduled the same way.
+    """
+
+    def __init__(self, run: Callable[[], bool], last_run: Callable[[], Optional[datetime.datetime]],
+                 count_new_ratings: Callable[[datetime.datetime, int], int], lock: Rev2Lock,
+                 schedule: str = SCHEDULE, ratings_trigger: int = RATINGS_TRIGGER, poll_seconds: int = POLL_SECONDS,
+                 base_backoff: int = BASE_BACKOFF_SECONDS, max_backoff: int = MAX_BACKOFF_SECONDS, name: str = "Rev2"):
+        self.name = name
+        self.run = run
+        self.last_run = last_run
+        self.count_new_ratings = count_new_ratings
+        self.lock = lock
+        self.schedule = CronSchedule(schedule)
+        self.ratings_trigger = ratings_trigger
+        self.poll_seconds = poll_seconds
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.retry_at: Optional[datetime.datetime] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run_forever, name=f"{self.name.lower()}-scheduler", daemon=True)
+        self._thread.start()
+        logger.info(f"{self.name} scheduler started ('{self.schedule.expression}')")
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        logger.info(f"{self.name} scheduler stopped")
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            try:
+                self.tick(datetime.datetime.now())
+            except Exception as e:
+                logger.error(f"{self.name} scheduler error: {e}")
+            self._stop.wait(self.seconds_to_wait(datetime.datetime.now()))
+
+    def seconds_to_wait(self, now: datetime.datetime) -> float:
+        if self.retry_at is not None:
+            wake_up = self.retry_at
+        else:
+            wake_up = now + datetime.timedelta(seconds=self.poll_seconds)
+            last_run = self.last_run()
+            if last_run is not None:
+                wake_up = min(wake_up, self.schedule.next_after(last_run))
+        return max(0.0, (wake_up - now).total_seconds())
+
+    def due(self, now: datetime.datetime) -> Optional[str]:
+        if self.retry_at is not None and now < self.retry_at:
+            return None
+        if self.failures:
+            return "retry"
+        last_run = self.last_run()
+        if last_run is None or self.schedule.next_after(last_run) <= now:
+            return "schedule"
+        if self.ratings_trigger > 0 and self.count_new_ratings(last_run, self.ratings_trigger) >= self.ratings_trigger:
+            return "new ratings"
+        return None
+
+    def tick(self, now: datetime.datetime) -> bool:
+        # returns whether a run was attempted
+        reason = self.due(now)
+        if reason is None:
+            return False
+        if not self.lock.acquire():
+            logger.info(f"{self.name} is being calculated by another replica")
+            return False
+        logger.info(f"{self.name} run started ({reason})")
+        try:
+            succeeded = self.run()
+        except Exception as e:
+            logger.error(f"{self.name} run failed: {e}")
+            succeeded = False
+        finally:
+            self.lock.release()
+        if succeeded:
+            self.failures = 0
+            self.retry_at = None
+        else:
+            self.failures += 1
+            backoff = min(self.max_backoff, self.base_backoff * 2 ** (self.failures - 1)) * random.uniform(0.5, 1.5)
+            self.retry_at = now + datetime.timedelta(seconds=backoff)
+            logger.info(f"{self.name} run will be retried in {round(backoff)} seconds")
+        return True
@@ -0,0 +1,113 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Optional, Sequence, Tuple
+import logging as logger
+import time
+import numpy as np
+from scipy.stats import rankdata
+
+from lib.score_summary import score_summary
+from lib.sparse_rev2 import SparseRev2Graph, sparse_rev2
+from lib.rev2_workers import WORKERS
+
+SHARED_ARRAYS = ('edge_user', 'edge_service', 'score', 'user_component', 'service_component', 'edge_component')
+ALIGNMENT = 8
+
+
+class SharedArrays:
+    """
+    Read-only numpy arrays copied once into a single shared memory block.
+    Worker processes attach to it by `name` with `layout` and get views instead of pickled copies.
+    """
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        self.layout = {}
+        offset = 0
+        for name, array in arrays.items():
+            self.layout[name] = (offset, array.dtype.str, array.shape)
+            offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+        self._memory = SharedMemory(create=True, size=max(1, offset))
+        for name, array in arrays.items():
+            self._view(self._memory, name)[...] = array
+
+    @property
+    def name(self) -> str:
+        return self._memory.name
+
+    def close(self):
+        self._memory.close()
+        self._memory.unlink()
+
+    def _view(self, memory: SharedMemory, name: str) -> np.ndarray:
+        offset, dtype, shape = self.layout[name]
+        return np.ndarray(shape, dtype=dtype, buffer=memory.buf, offset=offset)
+
+    @staticmethod
+    def attach(name: str, layout: Dict) -> Tuple[SharedMemory, Dict[str, np.ndarray]]:
+        # pool workers share the resource tracker of the creating process, which unlinks the block in close()
+        memory = SharedMemory(name=name)
+        arrays = {}
+        for array_name, (offset, dtype, shape) in layout.items():
+            arrays[array_name] = np.ndarray(shape, dtype=dtype, buffer=memory.buf, offset=offset)
+            arrays[array_name].flags.writeable = False
+        return memory, arrays
+
+
+_worker_memory: Optional[SharedMemory] = None
+_worker_arrays: Dict[str, np.ndarray] = {}
+
+def _attach_worker(name: str, layout: Dict):
+    global _worker_memory, _worker_arrays
+    _worker_memory, _worker_arrays = SharedArrays.attach(name, layout)
+
+def _run_setting(gamma1: float, gamma2: float, diff: float, arrays: Optional[Dict[str, np.ndarray]] = None):
+    arrays = arrays if arrays is not None else _worker_arrays
+    start = time.perf_counter()
+    fairness, _, _, iterations = sparse_rev2(*(arrays[name] for name in SHARED_ARRAYS), gamma1, gamma2, diff)
+    return fairness, iterations, time.perf_counter() - start
+
+
+def rev2_sweep(rev2_graph: SparseRev2Graph, grid: Sequence[Tuple[float, float]], diff=0.01, workers: int = WORKERS) -> Dict:
+    """
+    Runs Rev2 on an already built graph for every (gamma1, gamma2) in `grid`, in parallel on `workers`
+    processes that share the graph arrays, and compares the resulting fairness.
+    Returns:
+    - users: List[str]: order of the fairness columns
+    - settings: per (gamma1, gamma2): iterations, seconds and the fairness distribution (mean, std, percentiles, histogram)
+    - rank_correlation: Spearman correlation between the fairness rankings of every pair of settings
+    - fairness: np.ndarray: one row per setting
+    """
+    grid = [(float(gamma1), float(gamma2)) for gamma1, gamma2 in grid]
+    if not grid:
+        raise ValueError("The sweep grid is empty")
+    arrays = {name: getattr(rev2_graph, name) for name in SHARED_ARRAYS}
+    workers = max(1, min(workers, len(grid)))
+    logger.info(f"Rev2 sweep of {len(grid)} settings on {workers} workers")
+
+    if workers == 1 or not rev2_graph.users:
+        runs = [_run_setting(gamma1, gamma2, diff, arrays) for gamma1, gamma2 in grid]
+    else:
+        shared = SharedArrays(arrays)
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_attach_worker, initargs=(shared.name, shared.layout)) as executor:
+                futures = [executor.submit(_run_setting, gamma1, gamma2, diff) for gamma1, gamma2 in grid]
+                runs = [future.result() for future in futures]
+        finally:
+            shared.close()
+
+    fairness = np.vstack([run[0] for run in runs]) if rev2_graph.users else np.zeros((len(grid), 0))
+    settings = [{"gamma1": gamma1, "gamma2": gamma2, "iterations": int(iterations.max(initial=0)),
+                 "seconds": round(seconds, 4), "fairness": score_summary(values)}
+                for (gamma1, gamma2), (values, iterations, seconds) in zip(grid, runs)]
+    return {"users": rev2_graph.users, "settings": settings, "rank_correlation": rank_correlation(fairness),
+            "fairness": fairness}
+
+
+def rank_correlation(fairness: np.ndarray) -> List[List[Optional[float]]]:
+    # Spearman: Pearson correlation of the (tie averaged) ranks, None when a setting gives every user the same fairness
+    if fairness.shape[1] < 2:
+        return [[None] * len(fairness) for _ in fairness]
+    ranks = np.vstack([rankdata(row) for row in fairness])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlation = np.corrcoef(ranks)
+    return [[None if np.isnan(value) else round(float(value), 6) for value in row] for row in np.atleast_2d(correlation)]
@@ -0,0 +1,178 @@
+from collections import deque
+from typing import Dict, List, Optional
+import datetime
+import json
+import logging as logger
+import os
+import threading
+import time
+import uuid
+
+MAX_RUNS = int(os.getenv("REV2_MAX_RUNS", 50))
+RUNS_PATH = os.getenv("REV2_RUNS_PATH", os.path.join(os.getenv("LOCAL_STORAGE_PATH", "/tmp"), "rev2_runs.jsonl"))
+SLOWEST_COMPONENTS = 10
+
+
+class Rev2RunTelemetry:
+    """
+    Structured record of one Rev2 run.
+    Fields:
+    - run_id: str: unique id of the run
+    - engine: str: Rev2 engine used
+    - params: dict: gamma1, gamma2 and diff
+    - status: str: running | finished | failed
+    - iterations: List[Dict]: per-iteration seconds, max diffs, edges processed per second and active components
+    - tasks: List[Dict]: per-task summaries when the run is split across a worker pool
+    - components: dict: component count, iterations statistics and the slowest components
+    """
+
+    def __init__(self, engine: str, edges: int, gamma1=0.5, gamma2=0.5, diff=0.01):
+        self.run_id = str(uuid.uuid4())
+        self.engine = engine
+        self.edges = edges
+        self.params = {"gamma1": gamma1, "gamma2": gamma2, "diff": diff}
+        self.status = "running"
+        self.error = None
+        self.started_at = datetime.datetime.now().isoformat(timespec='seconds')
+        self.finished_at = None
+        self.seconds = None
+        self.iterations: List[Dict] = []
+        self.tasks: List[Dict] = []
+        self.components: Dict = {}
+        self._start = time.perf_counter()
+        self._listeners = []
+
+    def subscribe(self, listener):
+        # listener(telemetry) is called after every recorded iteration or task
+        self._listeners.append(listener)
+
+    def record_iteration(self, seconds: float, max_diff_fairness: float, max_diff_goodness: float,
+                         max_diff_reliability: float, edges: int, active_components: Optional[int] = None):
+        iteration = {
+            "iteration": len(self.iterations) + 1,
+            "seconds": round(seconds, 6),
+            "max_diff_fairness": float(max_diff_fairness),
+            "max_diff_goodness": float(max_diff_goodness),
+            "max_diff_reliability": float(max_diff_reliability),
+            "edges_per_second": round(edges / seconds, 1) if seconds > 0 else None,
+            "active_components": active_components
+        }
+        self.iterations.append(iteration)
+        logger.info(f"[REV2] {self.engine} iteration {iteration['iteration']}: "
+                    f"max_diff_fairness={max_diff_fairness:.4f} max_diff_goodness={max_diff_goodness:.4f} "
+                    f"max_diff_reliability={max_diff_reliability:.4f} ({iteration['edges_per_second']} edges/s)")
+        self._notify()
+
+    def record_task(self, components: int, edges: int, seconds: float, iterations: List[Dict]):
+        self.tasks.append({
+            "components": components,
+            "edges": edges,
+            "seconds": round(seconds, 6),
+            "iterations": len(iterations),
+            "final_max_diffs": {key: iterations[-1][key] for key in ("max_diff_fairness", "max_diff_goodness", "max_diff_reliability")}
+            if iterations else None
+        })
+        logger.info(f"[REV2] task with {components} components and {edges} edges finished in "
+                    f"{seconds:.3f}s after {len(iterations)} iterations")
+        self._notify()
+
+    def finish(self, component_iterations, component_edges):
+        component_iterations = [int(i) for i in component_iterations]
+        component_edges = [int(e) for e in component_edges]
+        slowest = sorted(range(len(component_iterations)), key=lambda c: (component_iterations[c], component_edges[c]), reverse=True)
+        self.components = {
+            "count": len(component_iterations),
+            "max_iterations": max(component_iterations, default=0),
+            "mean_iterations": round(sum(component_iterations) / len(component_iterations), 2) if component_iterations else 0,
+            "slowest": [{"component": c, "iterations": component_iterations[c], "edges": component_edges[c]}
+                        for c in slowest[:SLOWEST_COMPONENTS]]
+        }
+        self._close("finished")
+        logger.info(f"[REV2] run {self.run_id} finished in {self.seconds}s, "
+                    f"{self.components['count']} components, up to {self.components['max_iterations']} iterations")
+
+    def fail(self, error: Exception):
+        self.error = str(error)
+        self._close("failed")
+        logger.error(f"[REV2] run {self.run_id} failed: {error}")
+
+    def _close(self, status: str):
+        self.status = status
+        self.seconds = round(time.perf_counter() - self._start, 3)
+        self.finished_at = datetime.datetime.now().isoformat(timespec='seconds')
+
+    def _notify(self):
+        for listener in self._listeners:
+            listener(self)
+
+    def to_dict(self) -> Dict:
+        return {
+            "run_id": self.run_id,
+            "engine": self.engine,
+            "edges": self.edges,
+            "params": self.params,
+            "status": self.status,
+            "error": self.error,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "seconds": self.seconds,
+            "iterations": self.iterations,
+            "tasks": self.tasks,
+            "components": self.components
+        }
+
+
+class Rev2RunHistory:
+    """
+    Last `max_runs` Rev2 runs. When `path` is set they are also appended to a JSON lines file,
+    so runs made by the background calculator process are visible to the API process.
+    """
+
+    def __init__(self, path: Optional[str] = RUNS_PATH, max_runs: int = MAX_RUNS):
+        self.path = path
+        self.max_runs = max_runs
+        self._runs = deque(maxlen=max_runs)
+        self._lock = threading.Lock()
+
+    def append(self, telemetry: Rev2RunTelemetry):
+        run = telemetry.to_dict()
+        with self._lock:
+            self._runs.append(run)
+            if self.path:
+                try:
+                    self._append_to_file(run)
+                except OSError as e:
+                    logger.error(f"Error saving Rev2 run to '{self.path}': {e}")
+
+    def last(self, n: int) -> List[Dict]:
+        with self._lock:
+            runs = list(self._runs)
+            if self.path and os.path.exists(self.path):
+                try:
+                    runs = self._read_file()
+                except (OSError, ValueError) as e:
+                    logger.error(f"Error reading Rev2 runs from '{self.path}': {e}")
+        return list(reversed(runs[-n:])) if n > 0 else []
+
+    def _read_file(self) -> List[Dict]:
+        with open(self.path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def _append_to_file(self, run: Dict):
+        if not os.path.exists(os.path.dirname(self.path) or '.'):
+            os.makedirs(os.path.dirname(self.path))
+        runs = self._read_file() if os.path.exists(self.path) else []
+        runs = (runs + [run])[-self.max_runs:]
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.writelines(json.dumps(r) + "\n" for r in runs)
+        os.replace(tmp_path, self.path)
+
+
+_run_history: Optional[Rev2RunHistory] = None
+
+def get_run_history() -> Rev2RunHistory:
+    global _run_history
+    if _run_history is None:
+        _run_history = Rev2RunHistory()
+    return _run_history
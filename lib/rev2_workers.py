@@ -0,0 +1,141 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional
+import atexit
+import logging as logger
+import os
+import time
+import numpy as np
+
+from lib.rev2_telemetry import Rev2RunTelemetry
+from lib.sparse_rev2 import sparse_rev2, _segment_offsets
+
+MAX_DEFAULT_WORKERS = 4
+WORKERS = int(os.getenv("REV2_WORKERS", min(MAX_DEFAULT_WORKERS, os.cpu_count() or 1)))
+BATCH_EDGES = int(os.getenv("REV2_BATCH_EDGES", 50_000))
+
+
+class Rev2Task:
+    """
+    Contiguous run of components (in component order) sent to a worker as plain numpy slices.
+    Small components are packed together up to `BATCH_EDGES` edges, large ones get a task of their own.
+    """
+    __slots__ = ('components', 'users', 'services', 'edges')
+
+    def __init__(self, components: slice, users: slice, services: slice, edges: slice):
+        self.components = components
+        self.users = users
+        self.services = services
+        self.edges = edges
+
+    @property
+    def size(self) -> int:
+        return self.edges.stop - self.edges.start
+
+
+class Rev2WorkerPool:
+    """
+    Long-lived process pool that runs the sparse Rev2 iteration of independent components in parallel.
+    The processes are created on first use and reused by every run until `close()`.
+    """
+
+    def __init__(self, workers: int = WORKERS, batch_edges: int = BATCH_EDGES):
+        self.workers = max(1, workers)
+        self.batch_edges = max(1, batch_edges)
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def run(self, edge_user, edge_service, score, user_component, service_component, edge_component,
+            gamma1, gamma2, diff, fairness=None, goodness=None, reliability=None, active=None, telemetry=None):
+        """
+        Same contract as `sparse_rev2`, with the components split into tasks that run in the pool.
+        Tasks iterate independently, so `telemetry` gets one summary per task instead of global iterations.
+        """
+        fairness = np.ones(len(user_component), score.dtype) if fairness is None else fairness.astype(score.dtype)
+        goodness = np.ones(len(service_component), score.dtype) if goodness is None else goodness.astype(score.dtype)
+        reliability = np.ones(len(score), score.dtype) if reliability is None else reliability.astype(score.dtype)
+        n_components = int(user_component[-1]) + 1 if len(user_component) else 0
+        active = np.ones(n_components, dtype=bool) if active is None else active
+        iterations = np.zeros(n_components, dtype=np.int64)
+
+        tasks = [task for task in self.plan(user_component, service_component, edge_component) if active[task.components].any()]
+        # largest first so the big components do not end up alone at the tail of the run
+        tasks.sort(key=lambda task: task.size, reverse=True)
+        logger.info(f"Running {len(tasks)} Rev2 tasks on {self.workers} workers")
+
+        executor = self._get_executor()
+        try:
+            futures = []
+            for task in tasks:
+                payload = (edge_user[task.edges] - task.users.start, edge_service[task.edges] - task.services.start,
+                           score[task.edges], user_component[task.users] - task.components.start,
+                           service_component[task.services] - task.components.start,
+                           edge_component[task.edges] - task.components.start, gamma1, gamma2, diff,
+                           fairness[task.users], goodness[task.services], reliability[task.edges], active[task.components])
+                futures.append((task, executor.submit(_run_task, *payload)))
+
+            for task, future in futures:
+                results, seconds, task_iterations = future.result()
+                fairness[task.users], goodness[task.services], reliability[task.edges], iterations[task.components] = results
+                if telemetry is not None:
+                    telemetry.record_task(task.components.stop - task.components.start, task.size, seconds, task_iterations)
+        except BrokenProcessPool:
+            # a worker died (e.g. OOM killed), drop the pool so the next run starts a fresh one
+            logger.error("Rev2 worker pool is broken, it will be recreated on the next run")
+            executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            raise
+        return fairness, goodness, reliability, iterations
+
+    def is_worth_it(self, edge_user, user_component, service_component, edge_component) -> bool:
+        # small graphs run faster in this process than shipped to workers
+        return (self.workers > 1 and len(edge_user) > self.batch_edges
+                and len(self.plan(user_component, service_component, edge_component)) > 1)
+
+    def plan(self, user_component, service_component, edge_component) -> List[Rev2Task]:
+        user_offsets = np.r_[_segment_offsets(user_component), len(user_component)]
+        service_offsets = np.r_[_segment_offsets(service_component), len(service_component)]
+        edge_offsets = np.r_[_segment_offsets(edge_component), len(edge_component)]
+        tasks = []
+        start = 0
+        for component in range(len(edge_offsets) - 1):
+            size = edge_offsets[component + 1] - edge_offsets[component]
+            pending = edge_offsets[component] - edge_offsets[start]
+            if start < component and (size >= self.batch_edges or pending + size > self.batch_edges):
+                tasks.append(self._task(start, component, user_offsets, service_offsets, edge_offsets))
+                start = component
+        if len(edge_offsets) > 1:
+            tasks.append(self._task(start, len(edge_offsets) - 1, user_offsets, service_offsets, edge_offsets))
+        return tasks
+
+    def _task(self, start, stop, user_offsets, service_offsets, edge_offsets) -> Rev2Task:
+        return Rev2Task(slice(start, stop), slice(int(user_offsets[start]), int(user_offsets[stop])),
+                        slice(int(service_offsets[start]), int(service_offsets[stop])),
+                        slice(int(edge_offsets[start]), int(edge_offsets[stop])))
+
+
+def _run_task(*payload):
+    # runs in a worker process, the iterations go back to the parent with the results
+    telemetry = Rev2RunTelemetry("sparse-task", len(payload[0]))
+    start = time.perf_counter()
+    results = sparse_rev2(*payload, telemetry=telemetry)
+    return results, time.perf_counter() - start, telemetry.iterations
+
+
+_worker_pool: Optional[Rev2WorkerPool] = None
+
+def get_worker_pool() -> Rev2WorkerPool:
+    global _worker_pool
+    if _worker_pool is None:
+        _worker_pool = Rev2WorkerPool()
+        atexit.register(_worker_pool.close)
+    return _worker_pool
@@ -0,0 +1,42 @@
+from typing import Dict, Iterable
+import numpy as np
+
+PERCENTILES = (1, 5, 10, 25, 50, 75, 90, 95, 99)
+HISTOGRAM_BINS = 20
+
+
+def score_summary(scores: Iterable[float]) -> Dict:
+    """
+    Distribution of scores in [0, 1] (REV2 fairness, reviewer scores), shared by the gamma sweep and /fairness/db
+    so both report the same statistics over the same bins.
+    Percentiles are linearly interpolated and out of range scores are counted in the first / last bin.
+    Returns:
+    - count, avg, std, median, min, max: None values when there are no scores
+    - percentiles (Dict[str, float]): {"1": ..., "50": ..., "99": ...}
+    - histogram: {"edges": HISTOGRAM_BINS + 1 bin edges, "counts": HISTOGRAM_BINS counts}
+    """
+    scores = np.fromiter(scores, dtype=np.float64)
+    edges = np.linspace(0, 1, HISTOGRAM_BINS + 1)
+    counts = np.bincount(np.clip((scores * HISTOGRAM_BINS).astype(np.int64), 0, HISTOGRAM_BINS - 1),
+                         minlength=HISTOGRAM_BINS)
+    summary = {
+        "count": len(scores),
+        "avg": None,
+        "std": None,
+        "median": None,
+        "min": None,
+        "max": None,
+        "percentiles": {},
+        "histogram": {"edges": edges.tolist(), "counts": counts.tolist()}
+    }
+    if len(scores):
+        percentiles = np.percentile(scores, PERCENTILES)
+        summary.update({
+            "avg": float(scores.mean()),
+            "std": float(scores.std()),
+            "median": float(np.median(scores)),
+            "min": float(scores.min()),
+            "max": float(scores.max()),
+            "percentiles": {str(p): float(v) for p, v in zip(PERCENTILES, percentiles)}
+        })
+    return summary
@@ -0,0 +1,150 @@
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from scipy.sparse import csr_matrix, diags
+
+from lib.interest_prediction import CLIENT_INDEX, SERVICE_INDEX
+
+ALPHA = 0.8
+CHUNK_SIZE = 256  # folders scored together, bounds the size of the intermediate matrices
+
+
+class SparseInterestPredictor:
+    """
+    Interest prediction engine that keeps the folder x service incidence as a sparse matrix instead of networkx graphs.
+    Scores are the ones `InterestPredictor` gets from `nx.common_neighbor_centrality` (alpha 0.8) on the graph
+    of folder-service edges plus an edge between every two folders that share a service:
+    - common neighbors of (folder, service): the other folders that share a service with `folder_name` and have `service`,
+      a row of the folder co-occurrence product B·Bᵀ times B
+    - shortest path: 2 when there are common neighbors, otherwise found with a breadth-first search over the
+      bipartite graph (a path of length 2k+1 there is a path of length k+1 with the folder-folder edges)
+    Nothing quadratic in the folders of a popular service is built, so it is cheap per request.
+    `get_interest_predictions` scores several folders (e.g. every folder of a client) with the same sparse products,
+    CHUNK_SIZE at a time, and with a limit the search stops as soon as each folder has enough candidates.
+    """
+
+    def __init__(self, reviews: List[Tuple[str, str]], folder_name: Optional[str] = None, alpha: float = ALPHA):
+        self.folder_name = folder_name
+        self.alpha = alpha
+        self.folders = list(dict.fromkeys(r[CLIENT_INDEX] for r in reviews))
+        self.services = list(dict.fromkeys(r[SERVICE_INDEX] for r in reviews))
+        self.folder_index = folder_index = {folder: i for i, folder in enumerate(self.folders)}
+        service_index = {service: i for i, service in enumerate(self.services)}
+        rows = np.fromiter((folder_index[r[CLIENT_INDEX]] for r in reviews), dtype=np.int64, count=len(reviews))
+        cols = np.fromiter((service_index[r[SERVICE_INDEX]] for r in reviews), dtype=np.int64, count=len(reviews))
+        incidence = csr_matrix((np.ones(len(reviews), dtype=np.int64), (rows, cols)),
+                               shape=(len(self.folders), len(self.services)))
+        incidence.data[:] = 1  # repeated (folder, service) pairs are a single edge
+        self.incidence = incidence
+        # nodes of the networkx graph, a folder and a service with the same name are one node
+        self.n_nodes = len(set(self.folders) | set(self.services))
+
+    def get_interest_prediction(self, limit: Optional[int] = None) -> Dict[str, float]:
+        """
+        {service: score} for every service not yet in the folder, or for the `limit` best ones (highest score first).
+        A folder without saved services has no neighbors, so there is nothing to predict.
+        """
+        return self.get_interest_predictions([self.folder_name], limit).get(self.folder_name, {})
+
+    def get_interest_predictions(self, folder_names: List[str], limit: Optional[int] = None) -> Dict[str, Dict[str, float]]:
+        # {folder_name: predictions} of the given folders that have saved services, scored CHUNK_SIZE folders at a time
+        names = [name for name in dict.fromkeys(folder_names) if name in self.folder_index]
+        predictions = {}
+        for start in range(0, len(names), CHUNK_SIZE):
+            chunk = names[start:start + CHUNK_SIZE]
+            predictions.update(self._predict_chunk(chunk, np.array([self.folder_index[name] for name in chunk]), limit))
+        return predictions
+
+    def _predict_chunk(self, names: List[str], folders: np.ndarray, limit: Optional[int]) -> Dict[str, Dict[str, float]]:
+        rows = self.incidence[folders]
+        co_folders, common = self._common_neighbors(folders, rows)
+        lengths = self._path_lengths(folders, rows, co_folders, common, limit)
+        predictions = {}
+        for i, name in enumerate(names):
+            own = rows.indices[rows.indptr[i]:rows.indptr[i + 1]]
+            reached = lengths.indices[lengths.indptr[i]:lengths.indptr[i + 1]]
+            path_length = lengths.data[lengths.indptr[i]:lengths.indptr[i + 1]]
+            counts = _row_values(common, i, reached)
+            scores = self.alpha * counts + (1 - self.alpha) * self.n_nodes / path_length
+            predictions[name] = self._top(reached, scores, own, limit)
+        return predictions
+
+    def _top(self, reached: np.ndarray, scores: np.ndarray, own: np.ndarray, limit: Optional[int]) -> Dict[str, float]:
+        # reached services by score (then by index), followed by the unreachable ones, which score 0
+        if limit is not None and limit < len(reached):
+            # every service tied with the limit-th score, so ties are still broken by index
+            threshold = -np.partition(-scores, limit - 1)[limit - 1]
+            best = np.flatnonzero(scores >= threshold)
+            best = best[np.lexsort((reached[best], -scores[best]))][:limit]
+        else:
+            best = np.lexsort((reached, -scores))
+        top = {self.services[i]: float(scores[i_best]) for i_best, i in zip(best, reached[best])}
+        missing = None if limit is None else limit - len(top)
+        if missing is None or missing > 0:
+            unreachable = np.setdiff1d(np.arange(len(self.services)), np.concatenate([own, reached]), assume_unique=True)
+            top.update((self.services[i], 0.0) for i in unreachable[:missing])
+        return top
+
+    def _common_neighbors(self, folders: np.ndarray, rows: csr_matrix) -> Tuple[csr_matrix, csr_matrix]:
+        # folders sharing at least one service with each folder (itself excluded), then how many of them have each service
+        co_folders = _binary(rows @ self.incidence.T)
+        co_folders = _minus(co_folders, self._folders_matrix(folders))
+        common = (co_folders @ self.incidence).tocsr()
+        common.sort_indices()
+        return co_folders, common
+
+    def _path_lengths(self, folders: np.ndarray, rows: csr_matrix, co_folders: csr_matrix, common: csr_matrix,
+                      limit: Optional[int]) -> csr_matrix:
+        """
+        Path length of every candidate service reached from each folder, as a sparse chunk x services matrix.
+        Candidates with common neighbors are at 2; the others are found with a breadth-first search run for
+        the whole chunk at once with sparse products (services, then the folders that saved them, one level
+        per step). With a `limit` the search stops for a folder as soon as it has reached `limit` candidates:
+        farther candidates score less than any of them.
+        """
+        visited_services = _binary(rows + common)
+        visited_folders = _binary(co_folders + self._folders_matrix(folders))
+        frontier = _minus(_binary(common), rows)
+        lengths = frontier * 2
+        found = frontier.getnnz(axis=1)
+        length = 2
+        while True:
+            if limit is not None:
+                frontier = diags((found < limit).astype(np.int64), dtype=np.int64) @ frontier
+            frontier.eliminate_zeros()
+            if frontier.nnz == 0:
+                return lengths.tocsr()
+            length += 1
+            new_folders = _minus(_binary(frontier @ self.incidence.T), visited_folders)
+            visited_folders = visited_folders + new_folders
+            frontier = _minus(_binary(new_folders @ self.incidence), visited_services)
+            visited_services = visited_services + frontier
+            lengths = lengths + frontier * length
+            found = found + frontier.getnnz(axis=1)
+
+    def _folders_matrix(self, folders: np.ndarray) -> csr_matrix:
+        # row i marks folder folders[i]
+        return csr_matrix((np.ones(len(folders), dtype=np.int64), (np.arange(len(folders)), folders)),
+                          shape=(len(folders), len(self.folders)))
+
+
+def _binary(matrix) -> csr_matrix:
+    matrix = csr_matrix(matrix, copy=True)
+    matrix.data[:] = 1
+    return matrix
+
+def _minus(matrix: csr_matrix, other: csr_matrix) -> csr_matrix:
+    # entries of a binary matrix that are not in `other`
+    result = (matrix - matrix.multiply(other)).tocsr()
+    result.eliminate_zeros()
+    return result
+
+def _row_values(matrix: csr_matrix, row: int, columns: np.ndarray) -> np.ndarray:
+    # matrix[row, columns] of a matrix with sorted indices, without densifying the row
+    indices = matrix.indices[matrix.indptr[row]:matrix.indptr[row + 1]]
+    data = matrix.data[matrix.indptr[row]:matrix.indptr[row + 1]]
+    values = np.zeros(len(columns))
+    positions = np.minimum(np.searchsorted(indices, columns), max(len(indices) - 1, 0))
+    if len(indices):
+        found = indices[positions] == columns
+        values[found] = data[positions[found]]
+    return values
@@ -0,0 +1,253 @@
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import logging as logger
+import os
+import time
+import zipfile
+import numpy as np
+
+from lib.rev2_graph_builder import build_rating_arrays
+
+PRECISION = os.getenv("REV2_PRECISION", "float64")
+PRECISIONS = ("float64", "float32")
+
+
+class SparseRev2Graph:
+    """
+    Rev2 engine that keeps the bipartite rating graph as COO arrays instead of a networkx graph.
+    Arrays (one entry per rating edge, sorted by connected component):
+    - edge_user: int: index of the reviewer in `users`
+    - edge_service: int: index of the reviewed service in `services`
+    - score: float: rating normalized to [-1, 1]
+    Every update of the fixed-point iteration is a segment reduction over these arrays, and each
+    connected component stops iterating on its own once it converges, as `Rev2Graph` does.
+    Node and component indexes are int32 (when they fit) and `precision` ("float64" or "float32",
+    default REV2_PRECISION) is the dtype of the scores and of every value computed from them.
+    """
+
+    def __init__(self, ratings_list: List[Tuple[str, str, float]], precision: Optional[str] = None):
+        # ratings list format -> [(f"U{r['user_uuid']}", f"S{r['service_uuid']}", float(r['rating'])) for r in results]
+        precision = precision or PRECISION
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown Rev2 precision '{precision}' (valid precisions: {', '.join(PRECISIONS)})")
+        arrays = build_rating_arrays(ratings_list)
+        index_type = np.int32 if max(len(arrays.users), len(arrays.services)) < np.iinfo(np.int32).max else np.int64
+        self.users = arrays.users
+        self.services = arrays.services
+        self.edge_user = arrays.edge_user.astype(index_type)
+        self.edge_service = arrays.edge_service.astype(index_type)
+        self.score = arrays.normalized_rating().astype(precision)
+        self.user_component = arrays.user_component.astype(index_type)
+        self.service_component = arrays.service_component.astype(index_type)
+        self.edge_component = arrays.edge_component.astype(index_type)
+        self.n_components = arrays.n_components
+
+    def calculate(self, gamma1=0.5, gamma2=0.5, diff=0.01, previous_state: Optional['Rev2State'] = None,
+                  seed_fairness: Optional[Dict[str, float]] = None, pool=None, telemetry=None) -> Dict[str, float]:
+        """
+        Components are iterated in this process, or split across `pool` (a `Rev2WorkerPool`) when given.
+        Without `previous_state` every component starts from fairness = goodness = reliability = 1.
+        With it (warm start), components whose ratings did not change since that state keep their
+        previous values without iterating, and changed components start from the previous
+        goodness/reliability and from `seed_fairness` (falling back to the previous fairness).
+        The resulting state is left in `self.state` so it can be saved for the next run.
+        Per-iteration timings and max diffs are recorded in `telemetry` (a `Rev2RunTelemetry`) when given.
+        """
+        if not self.users:
+            self.state = None
+            self.iterations = np.zeros(0, dtype=np.int64)
+            return {}
+        digests = self._component_digests()
+        fairness = goodness = reliability = active = None
+        if previous_state is not None and previous_state.params != (gamma1, gamma2, diff):
+            logger.info("Rev2 state was computed with other parameters, ignoring it")
+            previous_state = None
+        if previous_state is not None or seed_fairness:
+            fairness, goodness, reliability, active = self._warm_start(digests, previous_state, seed_fairness or {})
+            logger.info(f"Rev2 warm start: {int(active.sum())} of {self.n_components} components changed")
+
+        run = pool.run if pool is not None else sparse_rev2
+        fairness, goodness, reliability, self.iterations = run(self.edge_user, self.edge_service, self.score,
+                                                 self.user_component, self.service_component, self.edge_component,
+                                                 gamma1, gamma2, diff, fairness, goodness, reliability, active,
+                                                 telemetry=telemetry)
+        self.state = Rev2State(self.users, fairness, self.services, goodness, self.edge_user, self.edge_service,
+                               reliability, digests, (gamma1, gamma2, diff))
+        return dict(zip(self.users, fairness.tolist()))
+
+    def component_edges(self) -> np.ndarray:
+        return np.bincount(self.edge_component, minlength=self.n_components)
+
+    def _component_digests(self) -> np.ndarray:
+        # order independent digest of the (user, service, score) edges of each component
+        user_hash = _key_hashes(self.users)
+        service_hash = _key_hashes(self.services)
+        edge_hash = _mix(user_hash[self.edge_user] ^ _mix(service_hash[self.edge_service] ^ _mix(self.score.astype(np.float64).view(np.uint64))))
+        return np.add.reduceat(edge_hash, _segment_offsets(self.edge_component))
+
+    def _warm_start(self, digests, previous_state, seed_fairness):
+        fairness = np.ones(len(self.users))
+        goodness = np.ones(len(self.services))
+        reliability = np.ones(len(self.score))
+        active = np.ones(self.n_components, dtype=bool)
+
+        if previous_state is not None:
+            user_match = previous_state.user_positions(self.users)
+            service_match = previous_state.service_positions(self.services)
+            edge_match = previous_state.edge_positions(user_match[self.edge_user], service_match[self.edge_service])
+            fairness = np.where(user_match >= 0, previous_state.fairness[user_match], fairness)
+            goodness = np.where(service_match >= 0, previous_state.goodness[service_match], goodness)
+            reliability = np.where(edge_match >= 0, previous_state.reliability[edge_match], reliability)
+            active = ~np.isin(digests, previous_state.component_digests)
+
+        seeded = np.array([user in seed_fairness for user in self.users], dtype=bool) & active[self.user_component]
+        fairness[seeded] = [seed_fairness[user] for user in np.array(self.users, dtype=object)[seeded]]
+        return fairness, goodness, reliability, active
+
+
+class Rev2State:
+    """
+    Values of a finished sparse Rev2 run, saved between runs to warm start the next one.
+    """
+
+    def __init__(self, users, fairness, services, goodness, edge_user, edge_service, reliability, component_digests, params):
+        self.users = np.asarray(users, dtype=str)
+        self.fairness = np.asarray(fairness, dtype=np.float64)
+        self.services = np.asarray(services, dtype=str)
+        self.goodness = np.asarray(goodness, dtype=np.float64)
+        self.edge_user = np.asarray(edge_user, dtype=np.int64)
+        self.edge_service = np.asarray(edge_service, dtype=np.int64)
+        self.reliability = np.asarray(reliability, dtype=np.float64)
+        self.component_digests = np.asarray(component_digests, dtype=np.uint64)
+        self.params = tuple(float(p) for p in params)
+
+    def save(self, path: str):
+        if not os.path.exists(os.path.dirname(path) or '.'):
+            os.makedirs(os.path.dirname(path))
+        tmp_path = f"{path}.tmp.npz"
+        np.savez_compressed(tmp_path, users=self.users, fairness=self.fairness, services=self.services,
+                            goodness=self.goodness, edge_user=self.edge_user, edge_service=self.edge_service,
+                            reliability=self.reliability, component_digests=self.component_digests,
+                            params=np.array(self.params))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional['Rev2State']:
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                return cls(data['users'], data['fairness'], data['services'], data['goodness'], data['edge_user'],
+                           data['edge_service'], data['reliability'], data['component_digests'], data['params'])
+        except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile) as e:
+            # a damaged or incompatible state only costs a cold start
+            logger.error(f"Error loading Rev2 state from '{path}': {e}")
+            return None
+
+    def user_positions(self, users: List[str]) -> np.ndarray:
+        return _positions(self.users, users)
+
+    def service_positions(self, services: List[str]) -> np.ndarray:
+        return _positions(self.services, services)
+
+    def edge_positions(self, user_positions: np.ndarray, service_positions: np.ndarray) -> np.ndarray:
+        n_services = max(1, len(self.services))
+        keys = self.edge_user * n_services + self.edge_service
+        order = np.argsort(keys)
+        wanted = user_positions * n_services + service_positions
+        found = np.minimum(np.searchsorted(keys, wanted, sorter=order), len(keys) - 1)
+        match = order[found]
+        return np.where((user_positions >= 0) & (service_positions >= 0) & (keys[match] == wanted), match, -1)
+
+
+def sparse_rev2(edge_user, edge_service, score, user_component, service_component, edge_component, gamma1, gamma2, diff,
+                fairness=None, goodness=None, reliability=None, active=None, telemetry=None):
+    """
+    Runs the Rev2 updates over the COO arrays. Nodes and edges must be sorted by component.
+    Initial values default to 1 and only components flagged in `active` (default: all) are iterated.
+    Every iteration is recorded in `telemetry` when given.
+    Returns (fairness, goodness, reliability, iterations per component).
+    """
+    n_users = len(user_component)
+    n_services = len(service_component)
+    dtype = score.dtype
+    user_degree = np.bincount(edge_user, minlength=n_users)
+    service_degree = np.bincount(edge_service, minlength=n_services)
+    user_offsets = _segment_offsets(user_component)
+    service_offsets = _segment_offsets(service_component)
+    edge_offsets = _segment_offsets(edge_component)
+
+    # copies, the caller arrays are never written; the new_* buffers are swapped with them every iteration
+    fairness = np.ones(n_users, dtype) if fairness is None else np.array(fairness, dtype=dtype)
+    goodness = np.ones(n_services, dtype) if goodness is None else np.array(goodness, dtype=dtype)
+    reliability = np.ones(len(score), dtype) if reliability is None else np.array(reliability, dtype=dtype)
+    new_fairness = np.empty_like(fairness)
+    new_goodness = np.empty_like(goodness)
+    new_reliability = np.empty_like(reliability)
+    user_diff = np.empty_like(fairness)
+    service_diff = np.empty_like(goodness)
+    edge_diff = np.empty_like(reliability)
+    active = np.ones(len(user_offsets), dtype=bool) if active is None else active.copy()
+    iterations = np.zeros(len(user_offsets), dtype=np.int64)
+
+    edge_counts = np.diff(np.r_[edge_offsets, len(score)])
+    while active.any():
+        iteration_start = time.perf_counter()
+        iterations += active
+        np.divide(np.bincount(edge_user, weights=reliability, minlength=n_users), user_degree, out=new_fairness)
+        np.divide(np.bincount(edge_service, weights=score * fairness[edge_user], minlength=n_services), service_degree, out=new_goodness)
+        # 1 / (gamma1 + gamma2) * (gamma1 * fairness + gamma2 * (1 - |score - goodness| / 2))
+        np.subtract(score, new_goodness[edge_service], out=new_reliability)
+        np.abs(new_reliability, out=new_reliability)
+        new_reliability *= -gamma2 / 2
+        new_reliability += gamma2
+        new_reliability += gamma1 * new_fairness[edge_user]
+        new_reliability /= gamma1 + gamma2
+
+        # converged components keep their last values
+        np.copyto(new_fairness, fairness, where=~active[user_component])
+        np.copyto(new_goodness, goodness, where=~active[service_component])
+        np.copyto(new_reliability, reliability, where=~active[edge_component])
+
+        max_diff_fairness = np.maximum.reduceat(np.abs(np.subtract(new_fairness, fairness, out=user_diff), out=user_diff), user_offsets)
+        max_diff_goodness = np.maximum.reduceat(np.abs(np.subtract(new_goodness, goodness, out=service_diff), out=service_diff), service_offsets)
+        max_diff_reliability = np.maximum.reduceat(np.abs(np.subtract(new_reliability, reliability, out=edge_diff), out=edge_diff), edge_offsets)
+        if telemetry is not None:
+            telemetry.record_iteration(time.perf_counter() - iteration_start, max_diff_fairness[active].max(),
+                                       max_diff_goodness[active].max(), max_diff_reliability[active].max(),
+                                       int(edge_counts[active].sum()), int(active.sum()))
+        active &= (max_diff_fairness > diff) | (max_diff_goodness > diff) | (max_diff_reliability > diff)
+
+        fairness, new_fairness = new_fairness, fairness
+        goodness, new_goodness = new_goodness, goodness
+        reliability, new_reliability = new_reliability, reliability
+
+    return fairness, goodness, reliability, iterations
+
+
+def _segment_offsets(sorted_labels):
+    return np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+
+
+def _key_hashes(keys) -> np.ndarray:
+    # stable across processes, unlike hash()
+    return np.fromiter((int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') for key in keys),
+                       dtype=np.uint64, count=len(keys))
+
+
+def _mix(values: np.ndarray) -> np.ndarray:
+    # splitmix64 finalizer
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return values ^ (values >> np.uint64(31))
+
+
+def _positions(known: np.ndarray, keys: List[str]) -> np.ndarray:
+    # index of each key in `known`, -1 when missing
+    if len(known) == 0:
+        return np.full(len(keys), -1, dtype=np.int64)
+    order = np.argsort(known)
+    keys = np.asarray(keys, dtype=str)
+    found = np.minimum(np.searchsorted(known, keys, sorter=order), len(known) - 1)
+    match = order[found]
+    return np.where(known[match] == keys, match, -1)
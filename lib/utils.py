@@ -1,4 +1,7 @@
+import base64
+import binascii
 import datetime
+import json
 import os
 import time
 from typing import Optional, Union
@@ -27,6 +30,19 @@ def get_engine() -> Optional[create_engine]:
         echo=True
     )
 
+def encode_cursor(values: list) -> str:
+    # opaque pagination cursor with the sort key of the last (or first) item of a page
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor: str, size: int) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Invalid cursor")
+    return values
+
 def get_test_engine():
     database_url = os.getenv('DATABASE_URL', 'sqlite:///test.db')  # Default to a SQLite database for testing
     return create_engine(database_url)